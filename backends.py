@@ -0,0 +1,272 @@
+import os
+import json
+import shutil
+import asyncio
+import logging
+import multiprocessing
+import concurrent.futures
+import http_client
+from jobs import WORKFLOW_TIMEOUT_MINUTES
+from extractor import TooLarge, cli_args, download_fitting, open_ydl
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_BACKEND = os.getenv('DOWNLOAD_BACKEND', 'github')
+LOCAL_WORKERS    = int(os.getenv('LOCAL_WORKERS', 2))
+LOCAL_DIR        = os.getenv('LOCAL_DOWNLOAD_DIR', 'local_downloads')
+# Сколько ждать попутные задачи перед запуском воркфлоу и сколько их брать в один прогон
+BATCH_WINDOW = float(os.getenv('BATCH_WINDOW', 2))
+BATCH_MAX    = int(os.getenv('BATCH_MAX', 8))
+
+PROGRESS_INTERVAL = 3.0
+
+
+class DownloadError(Exception):
+    pass
+
+
+class GitHubActionsBackend:
+    """Dispatch download.yml; the worker delivers the files and reports back to /report.
+
+    Most of a run is runner setup (ffmpeg, yt-dlp, the PO token provider),
+    so jobs submitted within BATCH_WINDOW seconds of each other share one
+    run: they are sent as a JSON list in the `jobs` input, up to BATCH_MAX
+    per run. submit() resolves when the batch has been dispatched; close()
+dispatches whatever is still waiting for its window.
+    """
+
+    name = 'github'
+
+    def __init__(self, repo, token, bot_token, admin_id=None, report_url=None,
+                 window: float = BATCH_WINDOW, batch_max: int = BATCH_MAX):
+        self.repo = repo
+        self.token = token
+        self.bot_token = bot_token
+        self.admin_id = admin_id
+        self.report_url = report_url
+        self.window = window
+        self.batch_max = batch_max
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, job: dict) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((job, future))
+        if len(self._pending) >= self.batch_max:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            task = loop.create_task(self._dispatch(self._take()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif self._timer is None:
+            self._timer = loop.create_task(self._flush_later())
+        return await future
+
+    def _take(self) -> list:
+        batch, self._pending = self._pending[:self.batch_max], self._pending[self.batch_max:]
+        return batch
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self._dispatch(self._take())
+
+    async def _dispatch(self, batch: list):
+        if not batch:
+            return
+        jobs = [{
+            "job_id":     job['id'],
+            "url":        job['url'],
+            "quality":    job['quality'],
+            "chat_id":    str(job['chat_id']),
+            "message_id": str(job['message_id']) if job.get('message_id') else "",
+        } for job, _ in batch]
+        try:
+            inputs = {
+                "jobs":       json.dumps(jobs, ensure_ascii=False, separators=(',', ':')),
+                "bot_token":  self.bot_token,
+                "admin_id":   str(self.admin_id) if self.admin_id else "",
+                "report_url": self.report_url or "",
+                "timeout_minutes": str(WORKFLOW_TIMEOUT_MINUTES),
+            }
+            status = await http_client.github_dispatch(self.repo, self.token, 'download.yml', inputs)
+            logger.info(f"GitHub Action: {len(jobs)} job(s), chats={[j['chat_id'] for j in jobs]}, status={status}")
+            ok = status == 204
+        except Exception as e:
+            logger.error(f"Error triggering GitHub action: {e}")
+            ok = False
+        for _, future in batch:
+            if not future.done():
+                future.set_result(ok)
+
+    async def close(self):
+        # Задачи из окна пакета запускаем сразу: отказ оставил бы их строки в dispatched, а ждущим пришла бы ошибка
+        if self._timer:
+            # Таймер ещё спит — _flush_later обнуляет его перед отправкой
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            await self._dispatch(self._take())
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# --- Local backend (runs inside pool processes) ---
+
+_ydl_cache = {}
+_progress = None
+
+
+def _warm_up():
+    # Импорт yt-dlp и загрузка экстракторов один раз на процесс пула
+    import yt_dlp
+    yt_dlp.YoutubeDL({'quiet': True}).get_info_extractor('Youtube')
+
+
+def _progress_hook(d):
+    if _progress is None:
+        return
+    if d.get('status') == 'downloading':
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        _progress.put((d.get('downloaded_bytes') or 0, total))
+
+
+# Те же флаги, что у воркера download.yml: превью сохраняем рядом с видео в jpg
+LOCAL_ARGS = ['-o', '%(id)s.%(ext)s', '--write-thumbnail', '--convert-thumbnails', 'jpg']
+
+
+def _get_ydl(url: str, out_dir: str):
+    # Один YoutubeDL на набор флагов платформы: экстракторы и их кэши остаются тёплыми, формат выбирается на задачу
+    key = tuple(cli_args(url))
+    if key not in _ydl_cache:
+        _ydl_cache[key] = open_ydl(url, LOCAL_ARGS)
+        _ydl_cache[key].add_progress_hook(_progress_hook)
+    ydl = _ydl_cache[key]
+    ydl.params['paths'] = {'home': out_dir}
+    return ydl
+
+
+def download_media(url: str, quality: str, out_dir: str, progress=None) -> dict:
+    """Download one URL into out_dir within Telegram's size limit. Runs in a pool process."""
+    global _progress
+    _progress = progress
+    os.makedirs(out_dir, exist_ok=True)
+    ydl = _get_ydl(url, out_dir)
+    try:
+        info = ydl.extract_info(url, download=False)
+        info, path = download_fitting(ydl, info, url, quality)
+    except TooLarge as e:
+        return {'error': 'too_large', 'size_mb': e.size_mb}
+    except Exception as e:
+        # Исключения yt-dlp не всегда сериализуются — в родительский процесс отдаём текст
+        return {'error': 'failed', 'message': str(e)[:300]}
+    finally:
+        _progress = None
+    thumbs = [t.get('filepath') for t in info.get('thumbnails') or [] if t.get('filepath')]
+    return {
+        'path':      path,
+        'thumbnail': thumbs[0] if thumbs and os.path.exists(thumbs[0]) else None,
+        'title':     (info.get('title') or 'Unknown')[:100],
+        'duration':  int(info['duration']) if info.get('duration') else None,
+        'thumb_url': info.get('thumbnail'),
+    }
+
+
+class LocalBackend:
+    """Download on the bot host with the yt-dlp Python API in a bounded process pool.
+
+    Pool processes stay alive between jobs, so yt-dlp and its extractors are
+    imported once. Progress is streamed back through a manager queue and
+    shown by editing the status message. After upload `on_done` is called
+    with the same payload the GitHub worker posts to /report.
+    """
+
+    name = 'local'
+
+    def __init__(self, bot, on_done, admin_id=None, workers: int = LOCAL_WORKERS, download_dir: str = LOCAL_DIR):
+        self.bot = bot
+        self.on_done = on_done
+        self.admin_id = admin_id
+        self.download_dir = download_dir
+        ctx = multiprocessing.get_context('spawn')
+        self._manager = ctx.Manager()
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_warm_up)
+        self._tasks = set()
+        self._seq = 0
+
+    async def submit(self, job: dict) -> bool:
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _edit_status(self, job: dict, text: str):
+        try:
+            if job.get('inline_message_id'):
+                await self.bot.edit_message_text(text, inline_message_id=job['inline_message_id'], parse_mode='HTML')
+            elif job.get('message_id'):
+                await self.bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'], parse_mode='HTML')
+        except Exception:
+            pass
+
+    async def _run(self, job: dict):
+        self._seq += 1
+        out_dir = os.path.join(self.download_dir, str(self._seq))
+        progress = self._manager.Queue()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._pool, download_media, job['url'], job['quality'], out_dir, progress)
+        try:
+            last_text = None
+            while not future.done():
+                await asyncio.wait({future}, timeout=PROGRESS_INTERVAL)
+                done, total = None, 0
+                while not progress.empty():
+                    done, total = progress.get_nowait()
+                if done is not None:
+                    text = f"⏳ <b>Скачиваю {job['quality']}...</b> {done / 1024 / 1024:.1f} МБ"
+                    if total:
+                        text += f" ({done * 100 // total}%)"
+                    if text != last_text:
+                        last_text = text
+                        await self._edit_status(job, text)
+            result = future.result()
+            if result.get('error') == 'failed':
+                raise RuntimeError(result['message'])
+            if result.get('error') == 'too_large':
+                raise DownloadError(f"⚠️ <b>Ошибка:</b> Размер видео превышает лимит Telegram в 50 МБ (Ожидаемый вес: ~{result['size_mb']} МБ).")
+            with open(result['path'], 'rb') as video:
+                thumb = open(result['thumbnail'], 'rb') if result['thumbnail'] else None
+                try:
+                    message = await self.bot.send_video(job['chat_id'], video, supports_streaming=True, thumbnail=thumb,
+                                                        reply_to_message_id=job.get('message_id'),
+                                                        read_timeout=120, write_timeout=120)
+                finally:
+                    if thumb:
+                        thumb.close()
+            await self.on_done({
+                'url': job['url'], 'quality': job['quality'], 'job_id': job['id'],
+                'file_id':   message.video.file_id if message.video else None,
+                'title':     result['title'],
+                'duration':  result['duration'],
+                'thumbnail': result['thumb_url'],
+            })
+        except Exception as e:
+            logger.error(f"Local download failed for {job['url']}: {e}")
+            text = str(e) if isinstance(e, DownloadError) else "❌ Ошибка при скачивании. Попробуй другое видео или качество."
+            try:
+                await self.bot.send_message(job['chat_id'], text, parse_mode='HTML', reply_to_message_id=job.get('message_id'))
+                if self.admin_id and not isinstance(e, DownloadError):
+                    await self.bot.send_message(self.admin_id, f"🚨 <b>Ошибка загрузки!</b>\n👤 User: <code>{job['chat_id']}</code>\n🔗 URL: {job['url']}", parse_mode='HTML')
+            except Exception:
+                pass
+            await self.on_done({'url': job['url'], 'quality': job['quality'], 'job_id': job['id'], 'error': 'failed'})
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
@@ -0,0 +1,982 @@
+"""Throughput and latency benchmark for the bot's update handlers.
+
+Builds the real application from main.build_application() and feeds it
+synthetic Updates (links in private chats, group mentions, inline
+queries, quality button presses). Telegram is replaced by a fake request
+layer that answers every Bot API method locally, and GitHub by a stub
+HTTP server for the dispatch and contents APIs. The bot works in a
+temporary directory with its own DB.
+
+--mode direct calls Application.process_update with --concurrency updates
+in flight and measures handler latency. --mode polling and --mode webhook
+run the bot as in production: updates arrive at --rate per second, either
+from the fake getUpdates or POSTed to the bot's own webhook route over
+--concurrency connections, and latency is measured from arrival until the
+update processor finished the update.
+
+--mode storage writes a message mix (every message registers its user,
+every third records a download) from --threads threads, first through
+per-call connect-and-commit helpers as main.py had them, then through
+Storage, and reports messages/sec of both. --mode tokens stores --links
+button links the old way (md5[:8] in two dicts) and through TokenStore and
+reports Python heap, DB size and how many old tokens still resolve.
+--mode broadcast sends to --recipients chats through a fake bot with a
+flood limit, random 429s and blocked chats: once with the old sequential
+loop, once with Broadcaster stopped halfway and resumed from the DB.
+--mode admin fills an old-schema DB with 10k, 100k, ... --rows-max
+downloads and times the old get_stats, the migration in init_db and the
+/admin queries on the rollups. --mode slideshow generates --images photos,
+serves each under --variants URLs from a local CDN and builds the post's
+video with the old worker code and with slideshow.py.
+
+    python bench.py --updates 5000 --concurrency 32 --out bench.json
+    python bench.py --baseline bench.json
+    python bench.py --mode polling --rate 300 --out polling.json
+    python bench.py --mode webhook --rate 300 --baseline polling.json
+    python bench.py --mode storage --updates 20000 --threads 8
+    python bench.py --mode tokens --links 1000000
+    python bench.py --mode broadcast --recipients 2000 --api-latency 20
+    python bench.py --mode admin --rows-max 10000000
+    python bench.py --mode slideshow --images 30 --image-latency 80
+
+Results (updates/sec, p50/p95/p99 handler latency per update kind, DB
+write ops and outbound API calls per update) are written as JSON
+together with the git commit, so runs can be compared between commits.
+"""
+import os
+import sys
+import json
+import time
+import random
+import string
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.server
+from collections import Counter, deque
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_USERNAME = 'bench_bot'
+KIND_WEIGHTS = {'message': 0.4, 'group': 0.1, 'inline': 0.2, 'callback': 0.3}
+
+
+class GitHubStub(http.server.BaseHTTPRequestHandler):
+    """Dispatch -> 204, contents GET -> 404 (no snapshot yet), contents PUT -> 201."""
+
+    calls = Counter()
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: dict | None = None):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.latency:
+            time.sleep(self.latency)
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        kind = 'dispatch' if self.path.endswith('/dispatches') else 'other'
+        self.calls[f'POST {kind}'] += 1
+        self._reply(204 if kind == 'dispatch' else 404)
+
+    def do_GET(self):
+        self.calls['GET contents'] += 1
+        self._reply(404, {'message': 'Not Found'})
+
+    def do_PUT(self):
+        self.calls['PUT contents'] += 1
+        self._reply(201, {'content': {'sha': 'bench'}})
+
+
+def start_github_stub(latency: float) -> str:
+    GitHubStub.latency = latency
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GitHubStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def make_fake_request(latency: float):
+    from telegram.request import BaseRequest
+
+    class FakeTelegramRequest(BaseRequest):
+        """Answers Bot API calls locally and counts them per method."""
+
+        def __init__(self):
+            self.calls = Counter()
+            self._message_id = 1000
+            # Апдейты, которые отдаст getUpdates в режиме polling
+            self.updates = []
+            self.arrived = asyncio.Event()
+
+        def push_update(self, data: dict):
+            self.updates.append(data)
+            self.arrived.set()
+
+        async def get_updates(self, params: dict) -> list:
+            offset = int(params.get('offset') or 0)
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            if not self.updates:
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), float(params.get('timeout') or 0))
+                except asyncio.TimeoutError:
+                    pass
+            return self.updates[:int(params.get('limit') or 100)]
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _message(self, params: dict) -> dict:
+            self._message_id += 1
+            return {'message_id': self._message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': int(params.get('chat_id') or 1), 'type': 'private'}}
+
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            api_method = url.rsplit('/', 1)[-1]
+            params = request_data.parameters if request_data else {}
+            self.calls[api_method] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            if api_method == 'getUpdates':
+                result = await self.get_updates(params)
+            elif api_method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': BOT_USERNAME}
+            elif api_method in ('sendMessage', 'sendVideo') or (api_method == 'editMessageText' and 'chat_id' in params):
+                result = self._message(params)
+            elif api_method == 'getFile':
+                result = {'file_id': params.get('file_id'), 'file_unique_id': 'u', 'file_path': 'documents/file.txt'}
+            elif api_method == 'file.txt':
+                # Скачивание файла по file_path — отдаём его содержимое
+                return 200, b'# Netscape HTTP Cookie File\n'
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return FakeTelegramRequest()
+
+
+def synthetic_urls(n: int) -> list:
+    urls = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            urls.append(f'https://youtu.be/{i:011d}?si=share{i}')
+        elif kind == 1:
+            urls.append(f'https://www.tiktok.com/@user{i}/video/{7300000000000000000 + i}?is_from_webapp=1')
+        elif kind == 2:
+            urls.append(f'https://www.instagram.com/reel/C{i:010d}/?igsh=abc')
+        else:
+            urls.append(f'https://x.com/user{i}/status/{1700000000000000000 + i}')
+    return urls
+
+
+def make_update(kind: str, i: int, url: str, chat_id: int, token: str, quality: str = '720') -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'U{chat_id}', 'username': f'user{chat_id}'}
+    now = int(time.time())
+    if kind == 'message':
+        return {'update_id': i, 'message': {'message_id': i, 'date': now, 'from': user, 'text': f'глянь {url}',
+                                            'chat': {'id': chat_id, 'type': 'private'}}}
+    if kind == 'group':
+        return {'update_id': i, 'message': {'message_id': i, 'date': now, 'from': user,
+                                            'text': f'@{BOT_USERNAME} {url}',
+                                            'chat': {'id': -1000000000 - chat_id % 50, 'type': 'supergroup'}}}
+    if kind == 'inline':
+        return {'update_id': i, 'inline_query': {'id': str(i), 'from': user, 'query': url, 'offset': ''}}
+    return {'update_id': i, 'callback_query': {
+        'id': str(i), 'from': user, 'chat_instance': str(chat_id), 'data': f'd_{token}_{quality}',
+        'message': {'message_id': i, 'date': now, 'chat': {'id': chat_id, 'type': 'private'}, 'text': 'q'}}}
+
+
+# (платформа, вид, алфавит и длина id, как ссылку присылают, каноническая форма)
+LINK_FORMS = [
+    ('YouTube', 'video', (string.ascii_letters + string.digits + '_-', 11),
+     ['https://youtu.be/{id}?si=Ab12', 'https://www.youtube.com/watch?v={id}&t=42', 'https://m.youtube.com/shorts/{id}',
+      'https://music.youtube.com/watch?feature=share&v={id}', 'https://youtube.com/embed/{id}'],
+     'https://www.youtube.com/watch?v={id}'),
+    ('TikTok', 'video', (string.digits, 19),
+     ['https://www.tiktok.com/@user/video/{id}?is_from_webapp=1', 'https://m.tiktok.com/@user/video/{id}'],
+     'https://www.tiktok.com/@user/video/{id}'),
+    ('TikTok', 'photo', (string.digits, 19),
+     ['https://www.tiktok.com/@user/photo/{id}?lang=ru'], 'https://www.tiktok.com/@user/photo/{id}'),
+    ('Instagram', 'video', (string.ascii_letters + string.digits + '_-', 11),
+     ['https://www.instagram.com/reel/{id}/?igsh=x1', 'https://instagram.com/p/{id}'], 'https://www.instagram.com/p/{id}/'),
+    ('Twitter/X', 'video', (string.digits, 19),
+     ['https://twitter.com/user/status/{id}?s=20', 'https://x.com/user/status/{id}', 'https://mobile.twitter.com/user/status/{id}/video/1'],
+     'https://x.com/i/status/{id}'),
+    ('Twitch', 'clip', (string.ascii_letters, 16),
+     ['https://clips.twitch.tv/{id}', 'https://www.twitch.tv/streamer/clip/{id}?filter=clips'], 'https://clips.twitch.tv/{id}'),
+    ('Rutube', 'video', (string.hexdigits[:16], 32), ['https://rutube.ru/video/{id}/?r=wd'], 'https://rutube.ru/video/{id}/'),
+    ('Vimeo', 'video', (string.digits, 9), ['https://vimeo.com/{id}', 'https://www.vimeo.com/{id}?share=copy'], 'https://vimeo.com/{id}'),
+]
+# Хосты, которые подстрокой похожи на поддерживаемые, но ими не являются
+LOOKALIKES = ['https://box.com/s/{id}', 'https://notyoutube.com/watch?v={id}', 'https://youtube.com.evil.io/watch?v={id}',
+              'https://x.company.com/user/status/{id}', 'https://mytiktok.com/@user/video/{id}', 'https://ex.com/{id}',
+              'https://example.org/{id}.mp4']
+# Битые хосты: urlsplit на них падает, классификатор должен просто сказать «не ссылка»
+MALFORMED = ['https://[www.youtube.com/x{id}', 'https://[youtube.com/watch?v=dQw4w9WgXcQ&n={id}',
+             'https://www.tiktok.com]/@user/video/{id}', 'https://[::1/{id}', 'https://a\ufe6bvimeo.com/channel/{id}',
+             'https://a\uff03youtube.com/@user/{id}']
+CHATTER = ['привет', 'ок.', 'т.е.', 'смотри', 'лол', 'это', 'вот', 'видео', 'норм', '...', 'ну', 'да!', '1.5', 'см.', 'завтра']
+
+
+def link_corpus(rng, n: int) -> list:
+    """(message, expected (platform, kind, media_id, canonical) or None, scheme in text) triples."""
+    corpus = []
+    for i in range(n):
+        words = rng.sample(CHATTER, rng.randrange(0, 5))
+        roll = rng.random()
+        if roll < 0.5:
+            platform, kind, (alphabet, length), forms, canonical = rng.choice(LINK_FORMS)
+            media_id = ''.join(rng.choice(alphabet) for _ in range(length))
+            url = rng.choice(forms).format(id=media_id)
+            expected = (platform, kind, media_id, canonical.format(id=media_id))
+        elif roll < 0.65:
+            url, expected = rng.choice(LOOKALIKES).format(id=i), None
+        elif roll < 0.7:
+            # Без схемы «[» срезается как скобка из текста — битый хост шлём только со схемой
+            url = rng.choice(MALFORMED).format(id=i)
+            words.insert(rng.randrange(len(words) + 1), url)
+            corpus.append((' '.join(words), None, True))
+            continue
+        else:
+            corpus.append((' '.join(words) or 'привет', None, True))
+            continue
+        with_scheme = rng.random() < 0.8
+        if not with_scheme:
+            url = url.split('://', 1)[1]
+        elif rng.random() < 0.3:
+            url = 'http' + url[5:]
+        # «ссылка:youtu.be/…» без схемы неотличимо от текста, такую склейку даём только со схемой
+        url = rng.choice(['{}', '({})', '{}.', '{}!', '"{}"'] + ['ссылка:{}'] * with_scheme).format(url)
+        words.insert(rng.randrange(len(words) + 1), url)
+        corpus.append((' '.join(words), expected, with_scheme))
+    return corpus
+
+
+def run_classify(args) -> dict:
+    from urls import find_link
+    # Свойства классификатора на этом же корпусе проверяет tests/test_urls.py; здесь только скорость
+    corpus = link_corpus(random.Random(args.seed), 20_000)
+    messages = [text for text, _, _ in corpus]
+    started = time.perf_counter()
+    found = 0
+    for i in range(args.messages):
+        if find_link(messages[i % len(messages)]) is not None:
+            found += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'mode': 'classify',
+        'corpus': len(corpus),
+        'messages': args.messages,
+        'seconds': round(elapsed, 3),
+        'messages_per_sec': round(args.messages / elapsed),
+        'us_per_message': round(elapsed / args.messages * 1e6, 3),
+        'links_found_share': round(found / args.messages, 3),
+    }
+
+
+# Как писали в базу до Storage: своё соединение и коммит на каждый вызов
+LEGACY_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS users (chat_id INTEGER PRIMARY KEY, username TEXT, joined_date TEXT, request_count INTEGER DEFAULT 0)',
+    'CREATE TABLE IF NOT EXISTS downloads (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, url TEXT, quality TEXT, timestamp TEXT, platform TEXT)',
+]
+
+
+def legacy_message(db_name: str, chat_id: int, url: str, download: bool):
+    import sqlite3
+    now = time.strftime("%Y-%m-%d %H:%M:%S")
+    conn = sqlite3.connect(db_name)
+    conn.execute('''
+        INSERT INTO users (chat_id, username, joined_date) VALUES (?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET username = excluded.username
+    ''', (chat_id, f'user{chat_id}', now))
+    conn.commit()
+    conn.close()
+    if download:
+        conn = sqlite3.connect(db_name)
+        conn.execute('INSERT INTO downloads (chat_id, url, quality, timestamp, platform) VALUES (?, ?, ?, ?, ?)',
+                     (chat_id, url, '720', now, 'YouTube'))
+        conn.execute('UPDATE users SET request_count = request_count + 1 WHERE chat_id = ?', (chat_id,))
+        conn.commit()
+        conn.close()
+
+
+def run_storage(args) -> dict:
+    """Every message registers its user, every third one records a download, from --threads threads at once."""
+    import sqlite3
+    import concurrent.futures
+    from storage import Storage
+    workdir = tempfile.mkdtemp(prefix='bot-bench-storage-')
+    rng = random.Random(args.seed)
+    messages = [(10_000 + rng.randrange(args.users), f'https://youtu.be/{i:011d}', i % 3 == 0) for i in range(args.updates)]
+
+    def timed(handle) -> tuple[float, int]:
+        errors = 0
+
+        def worker(chunk):
+            nonlocal errors
+            for chat_id, url, download in chunk:
+                try:
+                    handle(chat_id, url, download)
+                except sqlite3.OperationalError:
+                    errors += 1
+        chunks = [messages[i::args.threads] for i in range(args.threads)]
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(worker, chunks))
+        return time.perf_counter() - started, errors
+
+    legacy_db = os.path.join(workdir, 'legacy.db')
+    conn = sqlite3.connect(legacy_db)
+    for sql in LEGACY_SCHEMA:
+        conn.execute(sql)
+    conn.close()
+    legacy_seconds, legacy_errors = timed(lambda chat_id, url, download: legacy_message(legacy_db, chat_id, url, download))
+
+    storage = Storage(os.path.join(workdir, 'bot.db'))
+    storage.init_db()
+    storage.start()
+
+    def handle(chat_id, url, download):
+        storage.register_user(chat_id, f'user{chat_id}')
+        if download:
+            storage.record_download(chat_id, url, '720', 'YouTube')
+    seconds, errors = timed(handle)
+    # Честное сравнение: ждём, пока писатель закоммитит всё поставленное
+    started = time.perf_counter()
+    storage.wait()
+    seconds += time.perf_counter() - started
+    storage.close()
+    downloads = storage._read().execute('SELECT COUNT(*) FROM downloads').fetchone()[0]
+    return {
+        'mode': 'storage',
+        'messages': len(messages),
+        'threads': args.threads,
+        'legacy': {'seconds': round(legacy_seconds, 3), 'messages_per_sec': round(len(messages) / legacy_seconds),
+                   'locked_errors': legacy_errors},
+        'storage': {'seconds': round(seconds, 3), 'messages_per_sec': round(len(messages) / seconds),
+                    'locked_errors': errors, 'downloads_committed': downloads},
+        'messages_per_sec': round(len(messages) / seconds),
+        'speedup': round(legacy_seconds / seconds, 1),
+    }
+
+
+def run_tokens(args) -> dict:
+    """Memory and speed of storing --links button links: old two dicts vs TokenStore."""
+    import hashlib
+    import tracemalloc
+    from storage import Storage
+    from cache import TokenStore
+    workdir = tempfile.mkdtemp(prefix='bot-bench-tokens-')
+    urls = synthetic_urls(args.links)
+
+    # Как было: md5[:8] в url_cache и в bot_data, без вытеснения
+    tracemalloc.start()
+    url_cache, bot_data = {}, {}
+    for url in urls:
+        url_hash = hashlib.md5(url.encode()).hexdigest()[:8]
+        url_cache[url_hash] = url
+        bot_data[url_hash] = url
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    collisions = len(urls) - len(url_cache)
+    del url_cache, bot_data
+
+    storage = Storage(os.path.join(workdir, 'bot.db'))
+    storage.init_db()
+    storage.start()
+    tokens = TokenStore(storage)
+    rng = random.Random(args.seed)
+    sample = set(rng.sample(range(len(urls)), 2000))
+    issued = {}
+    tracemalloc.start()
+    started = time.perf_counter()
+    for i, url in enumerate(urls):
+        token = tokens.issue(url)
+        if i in sample:
+            issued[i] = token
+        # Миллион ссылок разом бот не получает — даём писателю успевать, как в жизни
+        if i % 10_000 == 0:
+            storage.wait()
+    storage.wait()
+    tokens.prune()
+    storage.wait()
+    issue_seconds = time.perf_counter() - started
+    store_bytes, store_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Старые кнопки: токены не из горячего кэша читаются из базы
+    started = time.perf_counter()
+    resolved = sum(tokens.resolve(issued[i]) == urls[i] for i in sample)
+    resolve_seconds = time.perf_counter() - started
+    storage.close()
+    rows = storage._read().execute('SELECT COUNT(*) FROM url_tokens').fetchone()[0]
+    # Токены самых старых ссылок вытеснены лимитом TOKEN_STORE_SIZE — в выборке это ожидаемые промахи
+    kept = sum(i >= len(urls) - tokens.max_size for i in sample)
+    return {
+        'mode': 'tokens',
+        'links': len(urls),
+        'legacy': {'python_heap_mb': round(legacy_bytes / 1024 / 1024, 1), 'md5_8_collisions': collisions},
+        'token_store': {
+            'python_heap_mb': round(store_bytes / 1024 / 1024, 1),
+            'python_heap_peak_mb': round(store_peak / 1024 / 1024, 1),
+            'db_rows': rows, 'db_mb': round(os.path.getsize(storage.db_name) / 1024 / 1024, 1),
+            'issue_per_sec': round(len(urls) / issue_seconds),
+            'resolve_us': round(resolve_seconds / len(sample) * 1e6, 1),
+            'resolved_share': round(resolved / len(sample), 3), 'expected_share': round(kept / len(sample), 3),
+        },
+        'heap_mb': round(store_bytes / 1024 / 1024, 1),
+    }
+
+
+class FloodBot:
+    """Bot API stand-in for broadcasts: a global per-second flood limit, random 429s and chats that blocked the bot."""
+
+    def __init__(self, limit: float, inject_429: float, blocked: set, latency: float, seed: int):
+        self.limit = limit
+        self.inject_429 = inject_429
+        self.blocked = blocked
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.sent = Counter()
+        self.window = deque()
+        self.retry_after = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        from types import SimpleNamespace
+        from telegram.error import Forbidden, RetryAfter
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if chat_id in self.blocked:
+            raise Forbidden('Forbidden: bot was blocked by the user')
+        now = time.monotonic()
+        while self.window and now - self.window[0] > 1.0:
+            self.window.popleft()
+        if len(self.window) >= self.limit or self.rng.random() < self.inject_429:
+            self.retry_after += 1
+            raise RetryAfter(1)
+        self.window.append(now)
+        self.sent[chat_id] += 1
+        return SimpleNamespace(message_id=len(self.window))
+
+    async def edit_message_text(self, text, **kwargs):
+        pass
+
+
+async def run_broadcast(args) -> dict:
+    """/broadcast to --recipients chats: the old sequential loop vs Broadcaster, stopped halfway and resumed."""
+    from storage import Storage
+    from broadcast import Broadcaster
+    workdir = tempfile.mkdtemp(prefix='bot-bench-broadcast-')
+    storage = Storage(os.path.join(workdir, 'bot.db'))
+    storage.init_db()
+    storage.start()
+    rng = random.Random(args.seed)
+    chats = list(range(100_000, 100_000 + args.recipients))
+    for chat_id in chats:
+        storage.register_user(chat_id)
+    await asyncio.to_thread(storage.wait)
+    blocked = set(rng.sample(chats, args.recipients // 50))
+    admin = 1
+    latency = args.api_latency / 1000
+
+    # Как было: по одному сообщению, любые ошибки (включая 429) молча теряются
+    bot = FloodBot(args.flood_limit, args.inject_429, blocked, latency, args.seed)
+    started = time.perf_counter()
+    for chat_id in storage.get_all_users():
+        try:
+            await bot.send_message(chat_id, 'bench')
+        except Exception:
+            pass
+    legacy = {'seconds': round(time.perf_counter() - started, 3),
+              'delivered': len(bot.sent), 'lost': args.recipients - len(blocked) - len(bot.sent)}
+
+    bot = FloodBot(args.flood_limit, args.inject_429, blocked, latency, args.seed)
+    first = Broadcaster(storage, rate=args.broadcast_rate)
+    first.bot = bot
+    started = time.perf_counter()
+    await first.start('bench', admin)
+    while sum(bot.sent.values()) < args.recipients // 2:
+        await asyncio.sleep(0.05)
+    # «Рестарт» посреди рассылки: прогресс уже в базе, новый экземпляр продолжает с оставшихся
+    task = first.active
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await asyncio.to_thread(storage.wait)
+    second = Broadcaster(storage, rate=args.broadcast_rate)
+    second.bot = bot
+    await second.resume()
+    if second.active:
+        await second.active
+    seconds = time.perf_counter() - started
+    await asyncio.to_thread(storage.wait)
+    storage.close()
+    marked = storage._read().execute('SELECT COUNT(*) FROM users WHERE blocked = 1').fetchone()[0]
+    delivered = sum(1 for chat_id in bot.sent if chat_id != admin)
+    return {
+        'mode': 'broadcast',
+        'recipients': args.recipients,
+        'blocked': len(blocked),
+        'legacy': legacy,
+        'broadcaster': {
+            'seconds': round(seconds, 3), 'delivered': delivered,
+            'duplicates': sum(n - 1 for chat_id, n in bot.sent.items() if chat_id != admin),
+            'lost': args.recipients - len(blocked) - delivered,
+            'retry_after_429s': bot.retry_after, 'blocked_marked': marked,
+            'messages_per_sec': round(delivered / seconds, 1),
+        },
+        'messages_per_sec': round(delivered / seconds, 1),
+    }
+
+
+def legacy_get_stats(conn) -> tuple:
+    """get_stats() as main.py had it: LIKE on the TEXT timestamp and full GROUP BY scans of downloads."""
+    cursor = conn.cursor()
+    total_users = cursor.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    today = time.strftime("%Y-%m-%d")
+    downloads_today = cursor.execute('SELECT COUNT(*) FROM downloads WHERE timestamp LIKE ?', (f'{today}%',)).fetchone()[0]
+    today_stats = dict(cursor.execute('SELECT platform, COUNT(*) FROM downloads WHERE platform IS NOT NULL AND timestamp LIKE ? '
+                                      'GROUP BY platform', (f'{today}%',)).fetchall())
+    total_stats = dict(cursor.execute('SELECT platform, COUNT(*) FROM downloads WHERE platform IS NOT NULL GROUP BY platform').fetchall())
+    top = cursor.execute('SELECT username, chat_id, request_count FROM users ORDER BY request_count DESC LIMIT 20').fetchall()
+    return total_users, downloads_today, today_stats, total_stats, top
+
+
+def fill_legacy_db(path: str, rows: int, rng) -> int:
+    """Old-schema DB with `rows` downloads spread over the last 90 days."""
+    import sqlite3
+    platforms = ['YouTube', 'TikTok', 'Instagram', 'Twitter/X', 'Rutube', 'Twitch']
+    users = max(100, min(rows // 20, 200_000))
+    now = time.time()
+    conn = sqlite3.connect(path)
+    for sql in LEGACY_SCHEMA:
+        conn.execute(sql)
+    with conn:
+        conn.executemany('INSERT INTO users (chat_id, username, joined_date, request_count) VALUES (?, ?, ?, ?)',
+                         ((10_000 + i, f'user{i}', '2024-01-01 00:00:00', rng.randrange(1000)) for i in range(users)))
+        conn.executemany('INSERT INTO downloads (chat_id, url, quality, timestamp, platform) VALUES (?, ?, ?, ?, ?)',
+                         ((10_000 + rng.randrange(users), f'https://youtu.be/{i:011d}', '720',
+                           time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - rng.random() * 90 * 86400)),
+                           rng.choice(platforms)) for i in range(rows)))
+    conn.close()
+    return users
+
+
+def run_admin(args) -> dict:
+    """/admin queries on 10k, 100k, ... --rows-max downloads: legacy get_stats vs rollups."""
+    import sqlite3
+    import statistics
+    from storage import Storage
+    workdir = tempfile.mkdtemp(prefix='bot-bench-admin-')
+    rng = random.Random(args.seed)
+
+    def median_ms(call, repeats: int) -> float:
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - started)
+        return round(statistics.median(samples) * 1000, 3)
+
+    sizes, rows = [], 10_000
+    while rows <= args.rows_max:
+        path = os.path.join(workdir, f'admin{rows}.db')
+        started = time.perf_counter()
+        fill_legacy_db(path, rows, rng)
+        fill_seconds = time.perf_counter() - started
+        conn = sqlite3.connect(path)
+        legacy_ms = median_ms(lambda: legacy_get_stats(conn), 5)
+        conn.close()
+
+        # Миграция старой базы (ts, индексы, роллапы) — один раз при первом запуске новой версии
+        storage = Storage(path)
+        started = time.perf_counter()
+        storage.init_db()
+        migrate_seconds = time.perf_counter() - started
+        admin_ms = median_ms(lambda: (storage.get_stats(), storage.get_trends()), 50)
+        sizes.append({'rows': rows, 'fill_seconds': round(fill_seconds, 1), 'migrate_seconds': round(migrate_seconds, 1),
+                      'legacy_get_stats_ms': legacy_ms, 'admin_ms': admin_ms})
+        print(json.dumps(sizes[-1]), flush=True)
+        os.remove(path)
+        rows *= 10
+    return {
+        'mode': 'admin',
+        'sizes': sizes,
+        'admin_ms': sizes[-1]['admin_ms'],
+        'admin_growth': round(sizes[-1]['admin_ms'] / sizes[0]['admin_ms'], 2),
+        'legacy_growth': round(sizes[-1]['legacy_get_stats_ms'] / sizes[0]['legacy_get_stats_ms'], 1),
+    }
+
+
+class PhotoCDN(http.server.BaseHTTPRequestHandler):
+    """Any /<id>~<template>.<ext> path -> bytes of photo <id>, after `latency` seconds."""
+
+    photos = {}
+    latency = 0.0
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        from slideshow import image_key
+        type(self).requests += 1
+        time.sleep(self.latency)
+        data = self.photos.get(image_key(self.path))
+        self.send_response(200 if data else 404)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data or b'')))
+        self.end_headers()
+        self.wfile.write(data or b'')
+
+
+def legacy_slideshow(thumbnails: list, audio: str, out_dir: str) -> tuple:
+    """Slideshow as the old worker built it: every listed thumbnail fetched one by one, concat list, 25 fps."""
+    import requests
+    started = time.perf_counter()
+    images = []
+    for i, thumb in enumerate(thumbnails):
+        resp = requests.get(thumb['url'], timeout=30)
+        if resp.status_code == 200:
+            path = os.path.join(out_dir, f'img_{i:03d}.jpg')
+            with open(path, 'wb') as f:
+                f.write(resp.content)
+            images.append(path)
+    fetch_seconds = time.perf_counter() - started
+    concat = os.path.join(out_dir, 'concat.txt')
+    with open(concat, 'w') as f:
+        for path in images:
+            f.write(f"file '{os.path.basename(path)}'\nduration 3\n")
+        f.write(f"file '{os.path.basename(images[-1])}'\n")
+    output = os.path.join(out_dir, 'legacy.mp4')
+    subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-f', 'concat', '-i', concat, '-i', audio,
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-r', '25', '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+        '-c:a', 'aac', '-shortest', '-y', output,
+    ], check=True)
+    return output, fetch_seconds
+
+
+def run_slideshow(args) -> dict:
+    """A TikTok photo post of --images photos, --variants URLs each, from a local CDN: old worker code vs slideshow.py."""
+    import shutil
+    import slideshow
+    from extractor import probe_duration
+    if not shutil.which('ffmpeg'):
+        raise SystemExit('ffmpeg is required for --mode slideshow')
+    workdir = tempfile.mkdtemp(prefix='bot-bench-slideshow-')
+    # Разные кадры testsrc2 — чтобы кодеку не достались одинаковые картинки
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=1080x1440:rate=1',
+                    '-frames:v', str(args.images), '-q:v', '3', os.path.join(workdir, 'photo%03d.jpg')], check=True)
+    audio = os.path.join(workdir, 'audio.m4a')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={args.images * 2}',
+                    '-c:a', 'aac', audio], check=True)
+    for i in range(args.images):
+        with open(os.path.join(workdir, f'photo{i + 1:03d}.jpg'), 'rb') as f:
+            PhotoCDN.photos[f'photo{i}'] = f.read()
+    PhotoCDN.latency = args.image_latency / 1000
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PhotoCDN)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cdn = f'http://127.0.0.1:{server.server_port}'
+    templates = ['tplv-photomode-image.jpeg', 'tplv-photomode-image-v1:1080.webp', 'tplv-photomode-image-v2:720.jpeg']
+    thumbnails = [{'url': f'{cdn}/tos-maliva/photo{i}~{templates[v % len(templates)]}?x-expires={v}'}
+                  for i in range(args.images) for v in range(args.variants)]
+
+    results = {'mode': 'slideshow', 'images': args.images, 'thumbnails': len(thumbnails)}
+    for name in ('legacy', 'slideshow'):
+        PhotoCDN.requests = 0
+        started = time.perf_counter()
+        if name == 'legacy':
+            output, fetch = legacy_slideshow(thumbnails, audio, workdir)
+        else:
+            images = slideshow.fetch_images(slideshow.image_groups(thumbnails))
+            fetch = time.perf_counter() - started
+            output = slideshow.encode(images, audio, os.path.join(workdir, 'slideshow.mp4'))
+        total = time.perf_counter() - started
+        results[name] = {'seconds': round(total, 2), 'fetch_seconds': round(fetch, 2), 'encode_seconds': round(total - fetch, 2),
+                         'image_requests': PhotoCDN.requests, 'video_seconds': probe_duration(output),
+                         'size_kb': os.path.getsize(output) // 1024}
+        print(json.dumps({name: results[name]}), flush=True)
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    results['seconds'] = results['slideshow']['seconds']
+    results['speedup'] = round(results['legacy']['seconds'] / results['slideshow']['seconds'], 1)
+    return results
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def latency_summary(values: list) -> dict:
+    return {'count': len(values), 'p50': round(percentile(values, 0.50) * 1000, 3),
+            'p95': round(percentile(values, 0.95) * 1000, 3), 'p99': round(percentile(values, 0.99) * 1000, 3),
+            'max': round(max(values, default=0) * 1000, 3)}
+
+
+async def feed_direct(app, updates: list, latencies: dict, concurrency: int) -> float:
+    """Call Application.process_update directly; latency is the handler time of each update."""
+    from telegram import Update
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(kind, data):
+        async with semaphore:
+            update = Update.de_json(data, app.bot)
+            start = time.perf_counter()
+            await app.process_update(update)
+            latencies[kind].append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(kind, data) for kind, data in updates))
+    return time.perf_counter() - started
+
+
+async def feed_live(app, fake, updates: list, latencies: dict, args) -> float:
+    """Run the bot with polling or its webhook server; latency is from arrival until the update is processed."""
+    import main
+    import aiohttp
+
+    arrived, kinds = {}, {}
+    all_done = asyncio.Event()
+    processor = app.update_processor
+    process = processor.do_process_update
+
+    async def timed(update, coroutine):
+        await process(update, coroutine)
+        uid = update.update_id
+        latencies[kinds[uid]].append(time.perf_counter() - arrived[uid])
+        if sum(map(len, latencies.values())) == len(updates):
+            all_done.set()
+    processor.do_process_update = timed
+
+    runner = None
+    if args.mode == 'webhook':
+        runner = await main.start_web_server('127.0.0.1', 0)
+        webhook_url = f"http://127.0.0.1:{runner.addresses[0][1]}{main.WEBHOOK_PATH}"
+    await app.start()
+    await main.start_receiving(app)
+
+    # Как Telegram: не больше --concurrency одновременных соединений к вебхуку
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency))
+    headers = {'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET}
+    posts = []
+
+    async def post(data):
+        async with session.post(webhook_url, json=data, headers=headers) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"webhook answered {resp.status}")
+
+    started = time.perf_counter()
+    for i, (kind, data) in enumerate(updates):
+        delay = started + i / args.rate - time.perf_counter() if args.rate else 0
+        if delay > 0:
+            await asyncio.sleep(delay)
+        uid = data['update_id']
+        kinds[uid], arrived[uid] = kind, time.perf_counter()
+        if args.mode == 'webhook':
+            posts.append(asyncio.ensure_future(post(data)))
+        else:
+            fake.push_update(data)
+    await asyncio.gather(*posts)
+    await asyncio.wait_for(all_done.wait(), 120)
+    elapsed = time.perf_counter() - started
+
+    await session.close()
+    await main.stop_receiving(app)
+    await app.stop()
+    if runner:
+        await runner.cleanup()
+    return elapsed
+
+
+async def run(args) -> dict:
+    import main
+    from urls import canonicalize
+
+    fake = make_fake_request(args.api_latency / 1000)
+    from telegram.ext import ApplicationBuilder
+    app = main.build_application(ApplicationBuilder().token(main.TOKEN).request(fake).get_updates_request(fake))
+    await app.initialize()
+    await main.on_startup(app)
+
+    db_ops = Counter()
+    submit = main.storage.submit
+
+    def counting_submit(ops):
+        db_ops['ops'] += len(ops)
+        submit(ops)
+    main.storage.submit = counting_submit
+
+    rng = random.Random(args.seed)
+    urls = synthetic_urls(args.urls)
+    tokens = [main.url_tokens.issue(canonicalize(url)) for url in urls]
+    kinds = list(KIND_WEIGHTS)
+    updates = []
+    for i in range(args.updates):
+        kind = rng.choices(kinds, weights=list(KIND_WEIGHTS.values()))[0]
+        n = rng.randrange(len(urls))
+        chat_id = 10_000 + rng.randrange(args.users)
+        updates.append((kind, make_update(kind, i + 1, urls[n], chat_id, tokens[n], rng.choice(('720', '480')))))
+
+    latencies = {kind: [] for kind in kinds}
+    fake.calls.clear()
+    GitHubStub.calls.clear()
+    if args.mode == 'direct':
+        elapsed = await feed_direct(app, updates, latencies, args.concurrency)
+    else:
+        elapsed = await feed_live(app, fake, updates, latencies, args)
+
+    # Даём отработать пакетной отправке задач и писателю базы, затем снимаем счётчики
+    await asyncio.sleep(float(os.environ['BATCH_WINDOW']) * 2 + 0.2)
+    await asyncio.to_thread(main.storage.wait)
+    telegram_calls = dict(fake.calls)
+    github_calls = dict(GitHubStub.calls)
+    queued, running = main.scheduler.depth(), len(main.scheduler.running)
+
+    await main.on_shutdown(app)
+    await app.shutdown()
+
+    n = len(updates)
+    return {
+        'mode': args.mode,
+        'updates': n,
+        'concurrency': args.concurrency,
+        'rate': args.rate if args.mode != 'direct' else None,
+        'seconds': round(elapsed, 3),
+        'updates_per_sec': round(n / elapsed, 1),
+        'latency_ms': {'all': latency_summary([v for values in latencies.values() for v in values]),
+                       **{kind: latency_summary(values) for kind, values in latencies.items()}},
+        'db_write_ops_per_update': round(db_ops['ops'] / n, 3),
+        'telegram_calls_per_update': {k: round(v / n, 3) for k, v in sorted(telegram_calls.items())},
+        'github_calls_per_update': {k: round(v / n, 4) for k, v in sorted(github_calls.items())},
+        'jobs_left': {'queued': queued, 'running': running},
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result: dict, baseline: dict):
+    rows = [('updates/sec', ['updates_per_sec'], True),
+            ('p50 ms', ['latency_ms', 'all', 'p50'], False),
+            ('p95 ms', ['latency_ms', 'all', 'p95'], False),
+            ('p99 ms', ['latency_ms', 'all', 'p99'], False),
+            ('db ops/update', ['db_write_ops_per_update'], False)]
+    if result['results'].get('mode') == 'classify':
+        rows = [('messages/sec', ['messages_per_sec'], True), ('us/message', ['us_per_message'], False)]
+    elif result['results'].get('mode') == 'storage':
+        rows = [('messages/sec', ['messages_per_sec'], True), ('speedup', ['speedup'], True)]
+    elif result['results'].get('mode') == 'broadcast':
+        rows = [('messages/sec', ['messages_per_sec'], True), ('lost', ['broadcaster', 'lost'], False)]
+    elif result['results'].get('mode') == 'slideshow':
+        rows = [('seconds', ['seconds'], False), ('speedup', ['speedup'], True)]
+    elif result['results'].get('mode') == 'admin':
+        rows = [('admin ms', ['admin_ms'], False), ('growth', ['admin_growth'], False)]
+    elif result['results'].get('mode') == 'tokens':
+        rows = [('heap MB', ['heap_mb'], False), ('issue/sec', ['token_store', 'issue_per_sec'], True)]
+    print(f"\nvs baseline {baseline.get('commit')}:")
+    for name, path, higher_is_better in rows:
+        old, new = baseline['results'], result['results']
+        for key in path:
+            old, new = old.get(key, 0), new.get(key, 0)
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        flag = '  <- regression' if worse and abs(change) > 10 else ''
+        print(f"  {name:<15} {old:>10} -> {new:<10} ({change:+.1f}%){flag}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--mode', choices=('direct', 'polling', 'webhook', 'classify', 'storage', 'tokens', 'broadcast', 'admin', 'slideshow'), default='direct')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='direct: updates processed at once; webhook: connections to the webhook')
+    parser.add_argument('--rate', type=float, default=300, help='polling/webhook: updates arriving per second, 0 = all at once')
+    parser.add_argument('--urls', type=int, default=2000, help='distinct links in the mix')
+    parser.add_argument('--users', type=int, default=500, help='distinct chats in the mix')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='simulated Telegram API latency, ms')
+    parser.add_argument('--github-latency', type=float, default=0.0, help='simulated GitHub API latency, ms')
+    parser.add_argument('--messages', type=int, default=2_000_000, help='classify: messages to classify')
+    parser.add_argument('--threads', type=int, default=8, help='storage: threads writing at once')
+    parser.add_argument('--links', type=int, default=1_000_000, help='tokens: links to store')
+    parser.add_argument('--recipients', type=int, default=2000, help='broadcast: chats to send to')
+    parser.add_argument('--broadcast-rate', type=float, default=25, help='broadcast: Broadcaster messages per second')
+    parser.add_argument('--flood-limit', type=float, default=30, help='broadcast: fake Telegram messages per second before 429')
+    parser.add_argument('--inject-429', type=float, default=0.01, help='broadcast: share of sends answered 429 at random')
+    parser.add_argument('--rows-max', type=int, default=10_000_000, help='admin: largest downloads table, from 10k up by 10x')
+    parser.add_argument('--images', type=int, default=30, help='slideshow: photos in the post')
+    parser.add_argument('--variants', type=int, default=3, help='slideshow: URLs listed per photo')
+    parser.add_argument('--image-latency', type=float, default=80, help='slideshow: simulated CDN latency, ms')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write results JSON here')
+    parser.add_argument('--baseline', help='earlier results JSON to compare with')
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    sys.path.insert(0, REPO_DIR)
+    if args.mode == 'classify':
+        results = run_classify(args)
+    elif args.mode == 'storage':
+        results = run_storage(args)
+    elif args.mode == 'tokens':
+        results = run_tokens(args)
+    elif args.mode == 'broadcast':
+        results = asyncio.run(run_broadcast(args))
+    elif args.mode == 'admin':
+        results = run_admin(args)
+    elif args.mode == 'slideshow':
+        results = run_slideshow(args)
+    else:
+        prepare_bot_env(args)
+        results = asyncio.run(run(args))
+    result = {'commit': git_commit(), 'timestamp': int(time.time()), 'python': sys.version.split()[0],
+              'params': vars(args), 'results': results}
+    print(json.dumps(result['results'], indent=2, ensure_ascii=False))
+    if args.out:
+        with open(os.path.join(cwd, args.out), 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    if args.baseline:
+        with open(os.path.join(cwd, args.baseline)) as f:
+            compare(result, json.load(f))
+
+
+def prepare_bot_env(args):
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    os.environ.update({
+        'BOT_TOKEN': '123456:BENCH', 'GITHUB_TOKEN': 'bench', 'GITHUB_REPO': 'bench/bot',
+        'GITHUB_API_URL': start_github_stub(args.github_latency / 1000),
+        'PREVIEW_METADATA': '0', 'DOWNLOAD_BACKEND': 'github',
+        'METADATA_DIR': os.path.join(workdir, 'metadata_cache'),
+        'DB_SYNC_INTERVAL': '3600',
+        'BOT_MODE': 'webhook' if args.mode == 'webhook' else 'polling', 'PUBLIC_URL': 'http://127.0.0.1',
+    })
+    os.environ.setdefault('BATCH_WINDOW', '0.05')
+    # База и кэши бота — во временном каталоге
+    os.chdir(workdir)
+
+
+if __name__ == '__main__':
+    main_cli()
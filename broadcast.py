@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from jobs import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram пропускает ~30 сообщений в секунду на бота; держимся чуть ниже
+BROADCAST_RATE        = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+MAX_ATTEMPTS = 5
+PROGRESS_INTERVAL = 3.0
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class Broadcaster:
+    """Concurrent, resumable /broadcast.
+
+    Sends go through one token bucket (BROADCAST_RATE per second) shared by
+    BROADCAST_CONCURRENCY senders; a RetryAfter pauses every sender for the
+    time Telegram asks. Each recipient's outcome is written to
+    broadcast_recipients in batches, so after a restart resume() continues
+    with the recipients that are still pending. Chats that blocked the bot
+    are marked in users and skipped by later broadcasts.
+    """
+
+    def __init__(self, storage, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY):
+        self.storage = storage
+        self.bot = None
+        self.rate = rate
+        self.concurrency = concurrency
+        self.active = None
+        self._pause_until = 0.0
+
+    async def _acquire(self, bucket: TokenBucket):
+        while True:
+            now = time.monotonic()
+            if now < self._pause_until:
+                await asyncio.sleep(self._pause_until - now)
+                continue
+            if bucket.take(now):
+                return
+            await asyncio.sleep(bucket.wait_time(now))
+
+    async def _send(self, bucket, chat_id, text) -> str:
+        for attempt in range(MAX_ATTEMPTS):
+            await self._acquire(bucket)
+            try:
+                await self.bot.send_message(chat_id, text, parse_mode='HTML')
+                return 'sent'
+            except RetryAfter as e:
+                self._pause_until = max(self._pause_until, time.monotonic() + _seconds(e.retry_after))
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                return 'blocked' if 'chat not found' in str(e).lower() else 'failed'
+            except NetworkError:
+                await asyncio.sleep(1 + attempt)
+            except Exception as e:
+                logger.warning(f"Broadcast to {chat_id} failed: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def start(self, text: str, admin_chat_id: int) -> bool:
+        if self.active:
+            return False
+        recipients = self.storage.get_all_users()
+        status = await self.bot.send_message(admin_chat_id, "⏳ <b>Начинаю рассылку...</b>", parse_mode='HTML')
+        bc = {
+            'id': int(time.time() * 1000), 'text': text,
+            'admin_chat_id': admin_chat_id, 'status_message_id': status.message_id,
+        }
+        self.storage.create_broadcast(bc)
+        self._launch(bc, recipients, {})
+        return True
+
+    async def resume(self):
+        for bc in self.storage.load_unfinished_broadcasts():
+            pending = self.storage.get_broadcast_recipients(bc['id'], 'pending')
+            counts = self.storage.get_broadcast_counts(bc['id'])
+            logger.info(f"Resuming broadcast {bc['id']}: {len(pending)} recipients left.")
+            self._launch(bc, pending, counts)
+            break
+
+    def _launch(self, bc, recipients, counts):
+        self.active = asyncio.get_running_loop().create_task(self._run(bc, recipients, counts))
+        self.active.add_done_callback(lambda _: setattr(self, 'active', None))
+
+    async def _run(self, bc: dict, recipients: list, counts: dict):
+        bucket = TokenBucket(self.rate, max(1, int(self.rate)))
+        queue = deque(recipients)
+        total = len(recipients) + sum(counts.values()) - counts.get('pending', 0)
+        results = {'sent': [], 'failed': [], 'blocked': []}
+        done = {state: counts.get(state, 0) for state in results}
+
+        def flush():
+            for state, chat_ids in results.items():
+                if chat_ids:
+                    self.storage.mark_broadcast_recipients(bc['id'], state, chat_ids)
+                    if state == 'blocked':
+                        self.storage.mark_blocked(chat_ids)
+                    done[state] += len(chat_ids)
+                    results[state] = []
+
+        async def sender():
+            while queue:
+                chat_id = queue.popleft()
+                results[await self._send(bucket, chat_id, bc['text'])].append(chat_id)
+
+        async def report(final=False):
+            sent = done['sent'] + len(results['sent'])
+            processed = sent + done['failed'] + len(results['failed']) + done['blocked'] + len(results['blocked'])
+            blocked = done['blocked'] + len(results['blocked'])
+            if final:
+                text = f"✅ <b>Рассылка завершена.</b>\nДоставлено: <b>{sent}</b> из <b>{total}</b>."
+            else:
+                text = f"⏳ <b>Рассылка:</b> {processed} из {total}\nДоставлено: <b>{sent}</b>"
+            if blocked:
+                text += f"\nЗаблокировали бота: {blocked}"
+            try:
+                await self.bot.edit_message_text(text, chat_id=bc['admin_chat_id'],
+                                                 message_id=bc['status_message_id'], parse_mode='HTML')
+            except Exception:
+                pass
+
+        senders = [asyncio.create_task(sender()) for _ in range(min(self.concurrency, len(queue)) or 1)]
+        try:
+            while not all(task.done() for task in senders):
+                await asyncio.wait(senders, timeout=PROGRESS_INTERVAL)
+                await report()
+                flush()
+        finally:
+            for task in senders:
+                task.cancel()
+            flush()
+        self.storage.finish_broadcast(bc['id'])
+        await report(final=True)
@@ -0,0 +1,137 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+FILE_CACHE_SIZE = int(os.getenv('FILE_CACHE_SIZE', 5000))
+FILE_CACHE_TTL  = int(os.getenv('FILE_CACHE_TTL', 30 * 24 * 3600))
+
+TOKEN_STORE_SIZE = int(os.getenv('TOKEN_STORE_SIZE', 500_000))
+TOKEN_TTL        = int(os.getenv('TOKEN_TTL', 90 * 24 * 3600))
+TOKEN_HOT_SIZE   = int(os.getenv('TOKEN_HOT_SIZE', 10_000))
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or time.time() - item[0] > self.ttl:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, created: float | None = None):
+        with self._lock:
+            self._data[key] = (created or time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item else None
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class FileIdCache:
+    """Telegram file_id of already uploaded results, keyed by URL and quality.
+
+    Lives in memory as an LRU and is persisted to the file_cache table so
+    that it survives restarts (and is synced to GitHub with the rest of the DB).
+    """
+
+    def __init__(self, storage, max_size: int = FILE_CACHE_SIZE, ttl: float = FILE_CACHE_TTL):
+        self.storage = storage
+        self.lru = LRUCache(max_size, ttl)
+
+    @staticmethod
+    def key(url: str, quality: str) -> str:
+        return f"{url}|{quality}"
+
+    def load(self):
+        for key, created, info in self.storage.load_file_cache(self.lru.max_size, time.time() - self.lru.ttl):
+            self.lru.put(key, info, created)
+
+    def get(self, url: str, quality: str) -> dict | None:
+        return self.lru.get(self.key(url, quality))
+
+    def put(self, url: str, quality: str, info: dict):
+        key = self.key(url, quality)
+        self.lru.put(key, info)
+        self.storage.save_file_cache(key, info)
+
+    def invalidate(self, url: str, quality: str):
+        key = self.key(url, quality)
+        self.lru.pop(key)
+        self.storage.delete_file_cache(key)
+
+
+class TokenStore:
+    """Short tokens for callback_data that map back to the canonical URL.
+
+    A token is 96 bits of SHA-256 of the URL in hex (24 chars, so
+    "d_<token>_720" stays far below the 64-byte callback_data limit and
+    collisions are negligible). Tokens live in the url_tokens table so old
+    buttons keep working after a restart; recently used ones are also kept
+    in a small in-memory LRU. The table is capped by TOKEN_STORE_SIZE rows
+    and TOKEN_TTL seconds.
+    """
+
+    PRUNE_EVERY = 10_000
+
+    def __init__(self, storage, max_size: int = TOKEN_STORE_SIZE, ttl: float = TOKEN_TTL,
+                 hot_size: int = TOKEN_HOT_SIZE):
+        self.storage = storage
+        self.max_size = max_size
+        self.ttl = ttl
+        # Короткий TTL горячего кэша: повторная выдача токена раз в сутки продлевает его в базе
+        self.hot = LRUCache(hot_size, min(ttl, 24 * 3600))
+        self._issued = 0
+
+    @staticmethod
+    def token(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()[:24]
+
+    def issue(self, url: str) -> str:
+        token = self.token(url)
+        if self.hot.get(token) is None:
+            self.hot.put(token, url)
+            self.storage.save_url_token(token, url)
+            self._issued += 1
+            if self._issued % self.PRUNE_EVERY == 0:
+                self.prune()
+        return token
+
+    def resolve(self, token: str) -> str | None:
+        url = self.hot.get(token)
+        if url is None:
+            url = self.storage.load_url_token(token, time.time() - self.ttl)
+            if url is not None:
+                self.hot.put(token, url)
+        return url
+
+    def prune(self):
+        self.storage.prune_url_tokens(self.max_size, time.time() - self.ttl)
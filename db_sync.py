@@ -0,0 +1,216 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import tempfile
+import threading
+import http_client
+
+logger = logging.getLogger(__name__)
+
+# Как часто журнал изменений уходит на GitHub (секунды) и после скольких
+# записей журнал сворачивается в полный снапшот базы.
+SYNC_INTERVAL   = int(os.getenv('DB_SYNC_INTERVAL', 30))
+COMPACT_ENTRIES = int(os.getenv('DB_COMPACT_ENTRIES', 1000))
+SQLITE_HEADER   = b'SQLite format 3\x00'
+
+
+class DBSync:
+    """Write-behind sync of the SQLite database to the GitHub repo.
+
+    Every committed write batch is appended to an in-memory journal.
+    A background task uploads the journal (only the entries since the last
+    snapshot) at most once per SYNC_INTERVAL and only when something changed.
+    When the journal reaches COMPACT_ENTRIES the whole database is uploaded as
+    a snapshot that remembers the last journal seq it contains, and the
+    journal is truncated.
+
+    Data loss bound: a hard kill loses at most the writes of the last
+    SYNC_INTERVAL seconds; a clean shutdown loses nothing (close() flushes).
+    """
+
+    def __init__(self, db_name: str, repo: str | None, token: str | None):
+        self.db_name = db_name
+        self.journal_name = f'{db_name}.journal'
+        self.repo = repo
+        self.token = token
+        self.enabled = bool(repo and token)
+        # Локальный коммит и запись в журнал идут под одним локом, поэтому
+        # снапшот всегда согласован с номером последней записи журнала.
+        self.lock = threading.RLock()
+        self.flush_lock = asyncio.Lock()
+        self.entries = []
+        self.seq = 0
+        self.dirty = False
+        self.api_calls = 0
+        self._shas = {}
+        self._task = None
+        self._closed = False
+
+    # --- GitHub contents API ---
+
+    async def _get(self, filename, with_content: bool = True) -> bytes | None:
+        # Большой файл приходит вторым запросом (raw) — считаем оба
+        self.api_calls += 1
+        content, self._shas[filename] = await http_client.github_get_file(self.repo, self.token, filename, with_content)
+        if content is not None and len(content) > 1024 * 1024:
+            self.api_calls += 1
+        return content
+
+    async def _put(self, filename, content: bytes) -> bool:
+        if filename not in self._shas:
+            await self._get(filename, with_content=False)
+        for attempt in range(2):
+            self.api_calls += 1
+            status, sha = await http_client.github_put_file(
+                self.repo, self.token, filename, content,
+                sha=self._shas.get(filename), message=f"Sync {filename} via Telegram bot")
+            if sha:
+                self._shas[filename] = sha
+                return True
+            # Закешированный sha устарел (файл меняли в обход бота) — перечитываем
+            if status in [409, 422] and attempt == 0:
+                await self._get(filename, with_content=False)
+                continue
+            logger.warning(f"DB sync: PUT {filename} failed (status {status}).")
+            return False
+        return False
+
+    # --- Journal ---
+
+    def record(self, ops):
+        """Append already committed (sql, params) ops as one journal entry."""
+        # Без GitHub журнал некому отправлять и он только рос бы в памяти
+        if not self.enabled:
+            return
+        with self.lock:
+            self.seq += 1
+            self.entries.append({"seq": self.seq, "ops": [[sql, list(params)] for sql, params in ops]})
+            self.dirty = True
+
+    def _snapshot(self) -> tuple[int, bytes]:
+        with self.lock:
+            seq = self.seq
+            conn = sqlite3.connect(self.db_name)
+            try:
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value INTEGER)')
+                    conn.execute("INSERT OR REPLACE INTO sync_meta (key, value) VALUES ('journal_seq', ?)", (seq,))
+                fd, path = tempfile.mkstemp(suffix='.db')
+                os.close(fd)
+                try:
+                    dst = sqlite3.connect(path)
+                    conn.backup(dst)
+                    dst.close()
+                    with open(path, 'rb') as f:
+                        return seq, f.read()
+                finally:
+                    os.remove(path)
+            finally:
+                conn.close()
+
+    async def flush(self, compact: bool = False):
+        if not self.enabled:
+            return
+        async with self.flush_lock:
+            with self.lock:
+                if not self.dirty and not compact:
+                    return
+                self.dirty = False
+                pending = len(self.entries)
+            try:
+                if compact or pending >= COMPACT_ENTRIES:
+                    seq, content = await asyncio.to_thread(self._snapshot)
+                    if await self._put(self.db_name, content):
+                        with self.lock:
+                            self.entries = [e for e in self.entries if e['seq'] > seq]
+                        logger.info(f"DB sync: snapshot uploaded (journal seq {seq}).")
+                with self.lock:
+                    body = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in self.entries)
+                ok = await self._put(self.journal_name, body.encode('utf-8'))
+            except Exception as e:
+                logger.error(f"DB sync error: {e}")
+                ok = False
+            if not ok:
+                with self.lock:
+                    self.dirty = True
+
+    # --- Startup / shutdown ---
+
+    def _give_up(self, reason: str):
+        # Без полной копии с GitHub наша база неполная: выгрузив её, мы бы затёрли хорошую копию
+        logger.error(f"{reason} Keeping the local database; DB sync is off until restart.")
+        self.enabled = False
+
+    async def download_snapshot(self):
+        if not self.enabled:
+            logger.warning("GH_REPO or GH_TOKEN not set, skipping DB download.")
+            return
+        try:
+            content = await self._get(self.db_name)
+        except Exception as e:
+            self._give_up(f"Error downloading DB from GitHub: {e}")
+            return
+        if content is None:
+            logger.warning("Database snapshot not found on GitHub.")
+            return
+        # Пустой или обрезанный ответ не должен затереть локальную базу
+        if not content.startswith(SQLITE_HEADER):
+            self._give_up(f"Database snapshot on GitHub is not a SQLite file ({len(content)} bytes).")
+            return
+        # Старые WAL-файлы от прошлого запуска не должны накатиться на новый снапшот
+        for suffix in ['-wal', '-shm']:
+            if os.path.exists(self.db_name + suffix):
+                os.remove(self.db_name + suffix)
+        tmp = f'{self.db_name}.download'
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, self.db_name)
+        logger.info(f"Database snapshot downloaded from GitHub ({len(content) // 1024} KB).")
+
+    async def replay_journal(self):
+        """Apply journal entries newer than the local snapshot. Call after init_db()."""
+        if not self.enabled:
+            return
+        try:
+            content = await self._get(self.journal_name)
+        except Exception as e:
+            self._give_up(f"Error downloading DB journal from GitHub: {e}")
+            return
+        conn = sqlite3.connect(self.db_name)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS sync_meta (key TEXT PRIMARY KEY, value INTEGER)')
+                row = conn.execute("SELECT value FROM sync_meta WHERE key = 'journal_seq'").fetchone()
+                base = row[0] if row else 0
+                entries = [json.loads(line) for line in (content or b'').decode('utf-8').splitlines() if line.strip()]
+                entries = [e for e in entries if e['seq'] > base]
+                for e in entries:
+                    for sql, params in e['ops']:
+                        conn.execute(sql, params)
+        finally:
+            conn.close()
+        with self.lock:
+            # Воспроизведённые записи ещё не в снапшоте — оставляем их в журнале
+            self.entries = entries
+            self.seq = entries[-1]['seq'] if entries else base
+        logger.info(f"DB journal replayed: {len(entries)} entries after seq {base}.")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(SYNC_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+        await self.flush()
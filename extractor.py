@@ -0,0 +1,321 @@
+import os
+import re
+import glob
+import json
+import time
+import hashlib
+import logging
+import subprocess
+from urls import canonicalize, classify
+
+logger = logging.getLogger(__name__)
+
+METADATA_DIR = os.getenv('METADATA_DIR', 'metadata_cache')
+METADATA_TTL = int(os.getenv('METADATA_TTL', 6 * 3600))
+METADATA_MAX_FILES = int(os.getenv('METADATA_MAX_FILES', 5000))
+POT_PROVIDER_URL = os.getenv('POT_PROVIDER_URL', 'http://127.0.0.1:4416')
+# Зависшее соединение не должно держать поток извлечения метаданных дольше этого (секунды)
+METADATA_SOCKET_TIMEOUT = int(os.getenv('METADATA_SOCKET_TIMEOUT', 10))
+
+# Telegram принимает до 50 МБ; бюджет с запасом на контейнер и погрешность оценок
+SIZE_BUDGET = int(float(os.getenv('SIZE_BUDGET_MB', 49)) * 1024 * 1024)
+# Перекодирование: дольше этого не ужимаем, ниже этого битрейта видео смотреть невозможно
+REENCODE_MAX_DURATION = int(os.getenv('REENCODE_MAX_DURATION', 3 * 3600))
+REENCODE_MIN_KBPS = 120
+REENCODE_AUDIO_KBPS = 64
+
+
+def is_youtube(url: str) -> bool:
+    link = classify(url)
+    return link is not None and link.platform == 'YouTube'
+
+
+def cli_args(url: str) -> list:
+    """The same yt-dlp flags download.yml used per platform, from the link's extraction hints."""
+    link = classify(url)
+    hints = link.hints if link else {}
+    args = []
+    if hints.get('po_token'):
+        args = [
+            '--extractor-args', 'youtube:player_client=default,ios',
+            '--extractor-args', f'youtubepot-bgutilhttp:base_url={POT_PROVIDER_URL}',
+            '--js-runtimes', 'node', '--remote-components', 'ejs:github',
+        ]
+    cookies = hints.get('cookies')
+    if cookies and os.path.exists(cookies) and os.path.getsize(cookies) > 0:
+        args += ['--cookies', cookies]
+    return args + ['--no-playlist']
+
+
+def ydl_options(url: str, extra_args: list = ()) -> dict:
+    import yt_dlp
+    opts = yt_dlp.parse_options(cli_args(url) + list(extra_args)).ydl_opts
+    # CLI по умолчанию глотает ошибки (ignoreerrors='only_download'), воркеру нужны исключения
+    opts.update({'quiet': True, 'no_warnings': True, 'noprogress': True, 'ignoreerrors': False})
+    return opts
+
+
+def open_ydl(url: str, extra_args: list = ()):
+    """YoutubeDL with ydl_options(url, extra_args) that reads the cookie file but never writes it back."""
+    import yt_dlp
+    ydl = yt_dlp.YoutubeDL(ydl_options(url, extra_args))
+    # yt-dlp переписывает файл cookies при закрытии, а читают его параллельные задачи и потоки —
+    # кто-то загрузил бы его наполовину записанным. Свежие cookies приходят только через /update_cookie
+    ydl.save_cookies = lambda: None
+    return ydl
+
+
+def select_format(url: str, quality: str) -> tuple[str, str | None]:
+    """Return (format, merge_output_format) for a quality button."""
+    if quality == '1080' and is_youtube(url):
+        return ("bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/bestvideo[height<=1080]+bestaudio", 'mp4')
+    return (f"best[height<={quality}]/best", None)
+
+
+def estimate_size(fmt: dict, duration) -> int:
+    """filesize, then filesize_approx, then bitrate x duration."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return int(size)
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return 0
+
+
+def _has_video(f: dict) -> bool:
+    return f.get('vcodec') not in (None, 'none')
+
+
+def _has_audio(f: dict) -> bool:
+    return f.get('acodec') not in (None, 'none')
+
+
+def _is_avc(f: dict) -> bool:
+    return (f.get('vcodec') or '').startswith(('avc1', 'h264'))
+
+
+def choose_formats(formats: list, duration, max_height: int, budget: int = SIZE_BUDGET) -> tuple[str, str | None, int] | None:
+    """Best (format spec, merge_output_format, estimated size) that fits the budget.
+
+    Candidates are progressive formats and video-only + audio-only pairs that
+    merge into mp4, all at most max_height. The highest resolution that fits
+    wins; at equal resolution H.264 (avc1) beats other codecs, since every
+    Telegram client plays it inline, and then the larger (higher bitrate)
+    file does. Formats whose size can't be estimated are skipped. None if
+    nothing fits.
+    """
+    candidates = []
+    audios = [f for f in formats if _has_audio(f) and not _has_video(f)
+              and f.get('ext') in ('m4a', 'mp4') and estimate_size(f, duration)]
+    for f in formats:
+        if not _has_video(f) or (f.get('height') or 0) > max_height:
+            continue
+        size = estimate_size(f, duration)
+        if not size:
+            continue
+        height, avc = f.get('height') or 0, _is_avc(f)
+        if _has_audio(f):
+            candidates.append((height, avc, size, f['format_id'], None))
+        elif f.get('ext') == 'mp4' and audios:
+            # Лучшая дорожка звука, которая ещё влезает вместе с этим видео
+            fitting = [a for a in audios if size + estimate_size(a, duration) <= budget] or audios
+            audio = max(fitting, key=lambda a: (a.get('abr') or a.get('tbr') or 0))
+            candidates.append((height, avc, size + estimate_size(audio, duration),
+                               f"{f['format_id']}+{audio['format_id']}", 'mp4'))
+    fitting = [c for c in candidates if c[2] <= budget]
+    if not fitting:
+        return None
+    height, avc, size, spec, merge = max(fitting, key=lambda c: c[:3])
+    return spec, merge, size
+
+
+def smallest_format(formats: list, duration, max_height: int) -> tuple[str, int] | None:
+    """Smallest progressive format at most max_height: the source for a re-encode."""
+    sized = [(estimate_size(f, duration), f['format_id']) for f in formats
+             if _has_video(f) and _has_audio(f) and (f.get('height') or 0) <= max_height]
+    sized = [c for c in sized if c[0]]
+    if not sized:
+        return None
+    size, spec = min(sized)
+    return spec, size
+
+
+def selected_size(info: dict) -> int:
+    """Expected size of the format(s) yt-dlp picked for a processed info dict."""
+    duration = info.get('duration')
+    if info.get('requested_formats'):
+        return sum(estimate_size(f, duration) for f in info['requested_formats'])
+    return estimate_size(info, duration)
+
+
+class TooLarge(Exception):
+    def __init__(self, size_mb: int):
+        super().__init__(f"~{size_mb} MB does not fit")
+        self.size_mb = size_mb
+
+
+def reencode_plan(duration, budget: int = SIZE_BUDGET) -> tuple[int, int] | None:
+    """(video kbps, height) that fits duration into the budget, or None if it would be unwatchable."""
+    if not duration or duration > REENCODE_MAX_DURATION:
+        return None
+    kbps = int(budget * 8 * 0.96 / duration / 1000) - REENCODE_AUDIO_KBPS
+    if kbps < REENCODE_MIN_KBPS:
+        return None
+    for min_kbps, height in ((1500, 720), (700, 480), (350, 360)):
+        if kbps >= min_kbps:
+            return kbps, height
+    return kbps, 240
+
+
+def probe_duration(path: str) -> float | None:
+    # Прямые ссылки приходят без duration — берём её из заголовка файла
+    proc = subprocess.run(['ffmpeg', '-hide_banner', '-i', path], capture_output=True, text=True)
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', proc.stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def reencode(src: str, duration, budget: int = SIZE_BUDGET) -> str:
+    """Two-pass x264 encode of src to a bitrate that fits the budget."""
+    plan = reencode_plan(duration or probe_duration(src), budget)
+    if plan is None:
+        raise TooLarge(os.path.getsize(src) // 1024 // 1024)
+    kbps, height = plan
+    out = os.path.splitext(src)[0] + '.fit.mp4'
+    passlog = os.path.splitext(src)[0] + '.2pass'
+    video = ['-c:v', 'libx264', '-preset', 'veryfast', '-b:v', f'{kbps}k',
+             '-vf', f"scale=-2:'min({height},ih)'", '-pix_fmt', 'yuv420p', '-passlogfile', passlog]
+    logger.info(f"Re-encoding {src} to {kbps}k/{height}p")
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', src, *video, '-pass', '1', '-an', '-f', 'mp4', os.devnull],
+                   check=True)
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', src, *video, '-pass', '2',
+                    '-c:a', 'aac', '-b:a', f'{REENCODE_AUDIO_KBPS}k', '-movflags', '+faststart', out], check=True)
+    for log in glob.glob(passlog + '*'):
+        os.remove(log)
+    if os.path.getsize(out) > budget:
+        raise TooLarge(os.path.getsize(out) // 1024 // 1024)
+    return out
+
+
+def download_fitting(ydl, info: dict, url: str, quality: str, budget: int = SIZE_BUDGET) -> tuple[dict, str]:
+    """Download the best formats of an extracted info that fit the budget; re-encode if none do.
+
+    The quality is an upper bound on height. Returns the processed info and
+    the path of a file no larger than the budget, or raises TooLarge.
+    """
+    formats, duration, max_height = info.get('formats') or [], info.get('duration'), int(quality)
+    chosen = choose_formats(formats, duration, max_height, budget)
+    if chosen:
+        spec, merge, _ = chosen
+    elif any(estimate_size(f, duration) for f in formats):
+        # Ничего не влезает — качаем самый лёгкий вариант и пережимаем его
+        if reencode_plan(duration, budget) is None:
+            raise TooLarge(selected_size(info) // 1024 // 1024)
+        source = smallest_format(formats, duration, max_height)
+        spec, merge = (source[0] if source else 'worstvideo[height>=240]+worstaudio/worst'), None
+    else:
+        # Размеры неизвестны — прежний выбор формата, вес проверим после скачивания
+        spec, merge = select_format(url, quality)
+    ydl.format_selector = ydl.build_format_selector(spec)
+    ydl.params['merge_output_format'] = merge
+    info = ydl.process_ie_result(info, download=True)
+    path = (info.get('requested_downloads') or [{}])[0].get('filepath') or ydl.prepare_filename(info)
+    if os.path.getsize(path) > budget:
+        path = reencode(path, info.get('duration'), budget)
+    return info, path
+
+
+def summarize(info: dict, qualities=('720', '480')) -> dict:
+    """Small JSON-able subset of an info dict: what the bot shows and the worker captions."""
+    duration = info.get('duration')
+    formats = info.get('formats') or []
+    sizes = {}
+    for quality in qualities:
+        chosen = choose_formats(formats, duration, int(quality))
+        if chosen:
+            sizes[quality] = chosen[2]
+    return {
+        'id':        info.get('id'),
+        'title':     (info.get('title') or 'Unknown')[:100],
+        'uploader':  info.get('uploader') or 'Unknown',
+        'duration':  int(duration) if duration else None,
+        'thumbnail': info.get('thumbnail'),
+        'sizes':     sizes,
+    }
+
+
+class MetadataCache:
+    """On-disk cache of summarize() results keyed by canonical URL.
+
+    One small JSON file per URL; entries expire after METADATA_TTL (sizes and
+    thumbnail URLs go stale) and the directory is pruned to METADATA_MAX_FILES.
+    """
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, directory: str = METADATA_DIR, ttl: float = METADATA_TTL, max_files: int = METADATA_MAX_FILES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_files = max_files
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(canonicalize(url).encode()).hexdigest()[:32] + '.json')
+
+    def get(self, url: str) -> dict | None:
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) <= self.ttl:
+                with open(path, encoding='utf-8') as f:
+                    meta = json.load(f)
+                self.hits += 1
+                return meta
+        except (OSError, ValueError):
+            pass
+        self.misses += 1
+        return None
+
+    def put(self, url: str, meta: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(url)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._puts += 1
+        if self._puts % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith('.json')]
+        except OSError:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+        deadline = time.time() - self.ttl
+        for i, entry in enumerate(entries):
+            if i >= self.max_files or entry.stat().st_mtime < deadline:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+
+def fetch_metadata(url: str, cache: MetadataCache | None = None) -> dict:
+    """Summary for a URL, from the cache or with one extraction (blocking)."""
+    cache = cache or MetadataCache()
+    meta = cache.get(url)
+    if meta is None:
+        with open_ydl(url, ['--socket-timeout', str(METADATA_SOCKET_TIMEOUT)]) as ydl:
+            meta = summarize(ydl.extract_info(url, download=False))
+        cache.put(url, meta)
+    return meta
@@ -0,0 +1,168 @@
+import os
+import random
+import asyncio
+import base64
+import time
+import logging
+import httpx
+from metrics import HTTP_SECONDS, HTTP_RESPONSES
+
+logger = logging.getLogger(__name__)
+
+GITHUB_API = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+
+MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 20))
+MAX_CONCURRENCY = int(os.getenv('HTTP_MAX_CONCURRENCY', 10))
+MAX_RETRIES     = int(os.getenv('HTTP_MAX_RETRIES', 3))
+
+# Таймауты по типу запроса: загрузка базы/cookies может быть долгой,
+# диспатч воркфлоу должен отвечать быстро.
+TIMEOUTS = {
+    'github_contents': httpx.Timeout(30.0, connect=5.0),
+    'github_dispatch': httpx.Timeout(10.0, connect=5.0),
+    'default':         httpx.Timeout(10.0, connect=5.0),
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE'}
+# Ошибки, при которых запрос точно не ушёл на сервер — их можно повторять даже для POST
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_client: httpx.AsyncClient | None = None
+_semaphore: asyncio.Semaphore | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """One keep-alive pooled client shared by every side call of the bot."""
+    global _client, _semaphore
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+                keepalive_expiry=60.0,
+            ),
+            timeout=TIMEOUTS['default'],
+        )
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _client
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _backoff(attempt: int, retry_after: str | None = None) -> float:
+    if retry_after:
+        try:
+            return min(60.0, float(retry_after))
+        except ValueError:
+            pass
+    return min(30.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+async def request(method: str, url: str, endpoint: str = 'default', **kwargs) -> httpx.Response:
+    """Send a request through the shared client with retry, backoff and jitter.
+
+    Retries 429/5xx responses and transport errors. Non-idempotent requests
+    (the workflow dispatch POST) are only retried when the request was never
+    sent, so a slow GitHub cannot cause a duplicate download.
+    """
+    client = get_client()
+    timeout = TIMEOUTS.get(endpoint, TIMEOUTS['default'])
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            async with _semaphore:
+                start = time.perf_counter()
+                try:
+                    resp = await client.request(method, url, timeout=timeout, **kwargs)
+                finally:
+                    HTTP_SECONDS.observe(time.perf_counter() - start, endpoint)
+        except httpx.TransportError as e:
+            HTTP_RESPONSES.inc(endpoint, type(e).__name__)
+            retryable = isinstance(e, NOT_SENT_ERRORS) or method.upper() in IDEMPOTENT_METHODS
+            if not retryable or attempt == MAX_RETRIES:
+                raise
+            logger.warning(f"HTTP {method} {endpoint} failed ({e!r}), retry {attempt + 1}/{MAX_RETRIES}")
+        else:
+            HTTP_RESPONSES.inc(endpoint, resp.status_code)
+            if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return resp
+            retry_after = resp.headers.get('Retry-After')
+            logger.warning(f"HTTP {method} {endpoint} status {resp.status_code}, retry {attempt + 1}/{MAX_RETRIES}")
+        await asyncio.sleep(_backoff(attempt, retry_after))
+
+
+# --- GitHub ---
+
+def github_headers(token: str) -> dict:
+    return {
+        "Authorization": f"Bearer {token}",
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": "2022-11-28",
+    }
+
+
+class GitHubError(Exception):
+    pass
+
+
+async def github_get_file(repo: str, token: str, filename: str,
+                          with_content: bool = True) -> tuple[bytes | None, str | None]:
+    """Return (content, sha) of a file in the repo, (None, None) if it does not exist.
+
+    sha and size come from the object media type, which inlines content only
+    up to 1 MB; larger files are fetched again with the raw media type. Any
+    other failure raises GitHubError instead of passing off empty content.
+    """
+    url = f"{GITHUB_API}/repos/{repo}/contents/{filename}"
+    resp = await request('GET', url, endpoint='github_contents',
+                         headers={**github_headers(token), "Accept": "application/vnd.github.object"})
+    if resp.status_code == 404:
+        return None, None
+    if resp.status_code != 200:
+        raise GitHubError(f"GET {filename}: status {resp.status_code}")
+    data = resp.json()
+    if data.get('type') != 'file' or not data.get('sha'):
+        raise GitHubError(f"GET {filename}: not a file")
+    if not with_content:
+        return None, data['sha']
+    size = data.get('size') or 0
+    content = base64.b64decode(data.get('content') or '') if data.get('encoding') == 'base64' else b''
+    if len(content) != size:
+        raw = await request('GET', url, endpoint='github_contents',
+                            headers={**github_headers(token), "Accept": "application/vnd.github.raw"})
+        if raw.status_code != 200:
+            raise GitHubError(f"GET raw {filename}: status {raw.status_code}")
+        content = raw.content
+        if len(content) != size:
+            raise GitHubError(f"GET raw {filename}: {len(content)} of {size} bytes")
+    return content, data['sha']
+
+
+async def github_put_file(repo: str, token: str, filename: str, content: bytes,
+                          sha: str | None = None, message: str | None = None) -> tuple[int, str | None]:
+    """Create or replace a file. Return (status_code, new_sha)."""
+    url = f"{GITHUB_API}/repos/{repo}/contents/{filename}"
+    payload = {
+        "message": message or f"Update {filename} via Telegram bot",
+        "content": base64.b64encode(content).decode('utf-8'),
+        "branch": "main"
+    }
+    if sha:
+        payload["sha"] = sha
+    resp = await request('PUT', url, endpoint='github_contents', json=payload, headers=github_headers(token))
+    if resp.status_code in [200, 201]:
+        return resp.status_code, resp.json().get('content', {}).get('sha')
+    return resp.status_code, None
+
+
+async def github_dispatch(repo: str, token: str, workflow: str, inputs: dict) -> int:
+    url = f"{GITHUB_API}/repos/{repo}/actions/workflows/{workflow}/dispatches"
+    payload = {"ref": "main", "inputs": inputs}
+    resp = await request('POST', url, endpoint='github_dispatch', json=payload, headers=github_headers(token))
+    return resp.status_code
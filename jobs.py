@@ -0,0 +1,290 @@
+import os
+import time
+import asyncio
+import logging
+import secrets
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Лимит прогона download.yml уходит в воркфлоу входом timeout_minutes; задачу считаем потерянной,
+# только когда прогон точно закончился: лимит плюс время, пока прогон ждёт раннер
+WORKFLOW_TIMEOUT_MINUTES = int(os.getenv('WORKFLOW_TIMEOUT_MINUTES', 30))
+RUNNER_QUEUE_MINUTES     = int(os.getenv('RUNNER_QUEUE_MINUTES', 5))
+INFLIGHT_TTL = int(os.getenv('INFLIGHT_TTL', (WORKFLOW_TIMEOUT_MINUTES + RUNNER_QUEUE_MINUTES) * 60))
+
+
+class InflightTable:
+    """Downloads that are queued or running, keyed by canonical URL + quality.
+
+    The first request for a key becomes the owner and queues the job, whose id
+    is then bound to the entry; every later request attaches as a waiter.
+    An entry lives exactly as long as its scheduler job: JobScheduler ends it
+    when the job finishes, fails to dispatch or expires, however long the job
+    waited in the queue.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def attach(self, key: str, chat_id, message_id=None) -> bool:
+        """Register a waiter. Return True if the caller owns a new job and must queue it."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                self._jobs[key] = {'job_id': None, 'waiters': [(chat_id, message_id)]}
+                return True
+            job['waiters'].append((chat_id, message_id))
+            return False
+
+    def bind(self, key: str, job_id: str):
+        """Tie the entry of a key to the scheduler job its owner queued."""
+        with self._lock:
+            if key in self._jobs:
+                self._jobs[key]['job_id'] = job_id
+
+    def finish(self, key: str, job_id: str | None = None) -> list:
+        """Remove the entry and return its waiters, owner first. With job_id only that job's entry is removed."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or (job_id is not None and job['job_id'] != job_id):
+                return []
+            del self._jobs[key]
+            return job['waiters']
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+MAX_RUNNING_JOBS  = int(os.getenv('MAX_RUNNING_JOBS', 10))
+CHAT_RATE_PER_MIN = float(os.getenv('CHAT_RATE_PER_MIN', 3))
+CHAT_BURST        = int(os.getenv('CHAT_BURST', 3))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = None
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float | None = None) -> bool:
+        now = now if now is not None else time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now: float | None = None) -> float:
+        now = now if now is not None else time.monotonic()
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class JobScheduler:
+    """Persistent download queue with per-chat rate limits and round-robin fairness.
+
+    Jobs go through queued -> dispatched -> running -> done/failed and every
+    transition is written to the jobs table, so a restart picks the queue up
+    again. Each chat has a token bucket (CHAT_RATE_PER_MIN, CHAT_BURST);
+    chats with queued jobs are served in turn, one job per turn, and no more
+    than MAX_RUNNING_JOBS jobs run at once. A job that never reports back is
+    failed after INFLIGHT_TTL to free its slot and handed to on_expired.
+    Whenever a job ends, its inflight entry ends with it and the waiters are
+    left in job['waiters'] for the callbacks.
+    """
+
+    def __init__(self, storage, submit, on_dispatched, on_expired=None, max_running: int = MAX_RUNNING_JOBS,
+                 rate_per_min: float = CHAT_RATE_PER_MIN, burst: int = CHAT_BURST, ttl: float = INFLIGHT_TTL,
+                 inflight: InflightTable | None = None):
+        self.storage = storage
+        self.inflight = inflight if inflight is not None else InflightTable()
+        self.submit = submit
+        self.on_dispatched = on_dispatched
+        self.on_expired = on_expired
+        self.max_running = max_running
+        self.rate = rate_per_min / 60
+        self.burst = burst
+        self.ttl = ttl
+        self.queues = {}
+        self.order = deque()
+        self.buckets = {}
+        self.running = {}  # id -> задача: у задач с одним ключом (до склейки после рестарта) свои слоты
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._tasks = set()
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return self.buckets[chat_id]
+
+    def _push(self, job: dict):
+        chat_id = job['chat_id']
+        if chat_id not in self.queues:
+            self.queues[chat_id] = deque()
+            self.order.append(chat_id)
+        self.queues[chat_id].append(job)
+
+    def enqueue(self, job: dict, now: float | None = None) -> tuple[int, float]:
+        """Queue a job. Return (jobs ahead of it, seconds until its chat may dispatch)."""
+        job['id'] = job.get('id') or secrets.token_hex(6)
+        job['state'] = 'queued'
+        job['created'] = int(time.time())
+        self.storage.save_job(job)
+        self._push(job)
+        self._wakeup.set()
+        return self.position(job), self._bucket(job['chat_id']).wait_time(now)
+
+    def position(self, job: dict) -> int:
+        # При круговой очереди перед k-й задачей чата пройдут не больше k задач каждого другого чата
+        own = self.queues.get(job['chat_id'], ())
+        k = next((i for i, j in enumerate(own) if j is job), len(own))
+        others = sum(min(len(q), k + 1) for chat_id, q in self.queues.items() if chat_id != job['chat_id'])
+        return k + others
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def _next_job(self, now: float) -> dict | None:
+        for _ in range(len(self.order)):
+            chat_id = self.order[0]
+            self.order.rotate(-1)
+            if self._bucket(chat_id).take(now):
+                queue = self.queues[chat_id]
+                job = queue.popleft()
+                if not queue:
+                    del self.queues[chat_id]
+                    self.order.remove(chat_id)
+                return job
+        return None
+
+    def _next_wakeup(self, now: float) -> float:
+        waits = [self._bucket(chat_id).wait_time(now) for chat_id in self.order]
+        return min(waits) if waits else 60.0
+
+    def _set_state(self, job: dict, state: str, error: str | None = None):
+        job['state'] = state
+        self.storage.update_job(job['id'], state, int(time.time()), error)
+        if state in ('done', 'failed'):
+            job['waiters'] = self.inflight.finish(job['key'], job['id'])
+
+    async def _dispatch(self, job: dict):
+        self._set_state(job, 'dispatched')
+        try:
+            ok = await self.submit(job)
+        except Exception as e:
+            logger.error(f"Job {job['id']} dispatch error: {e}")
+            ok = False
+        if ok:
+            self._set_state(job, 'running')
+        else:
+            self.running.pop(job['id'], None)
+            self._set_state(job, 'failed', 'dispatch')
+            self._wakeup.set()
+        await self.on_dispatched(job, ok)
+
+    def _expire(self) -> list:
+        deadline = time.time() - self.ttl
+        expired = []
+        for job_id, job in list(self.running.items()):
+            if job['started'] < deadline:
+                self.running.pop(job_id)
+                self._set_state(job, 'failed', 'timeout')
+                expired.append(job)
+        return expired
+
+    def step(self, now: float | None = None) -> list:
+        """Take every job that may start now. Returns them in dispatch order."""
+        now = now if now is not None else time.monotonic()
+        started = []
+        while len(self.running) < self.max_running:
+            job = self._next_job(now)
+            if job is None:
+                break
+            job['started'] = time.time()
+            self.running[job['id']] = job
+            started.append(job)
+        return started
+
+    def finish(self, key: str, ok: bool = True, job_id: str | None = None) -> dict | None:
+        """Free the slot of a running job and return it. Without job_id the oldest running job of the key is taken."""
+        if job_id:
+            job = self.running.get(job_id)
+        else:
+            job = next((j for j in self.running.values() if j['key'] == key), None)
+        if job is None or job['key'] != key:
+            return None
+        del self.running[job['id']]
+        self._set_state(job, 'done' if ok else 'failed')
+        self._wakeup.set()
+        return job
+
+    def restore(self) -> list:
+        """Re-queue jobs persisted before a restart; running ones keep their slot until they report or expire.
+
+        Returns the restored jobs, running ones first, for rebuilding the inflight table.
+        """
+        running, queued = [], []
+        for job in self.storage.load_active_jobs():
+            if job['state'] == 'queued':
+                self._push(job)
+                queued.append(job)
+            else:
+                job['started'] = job.get('dispatched') or job['created']
+                self.running[job['id']] = job
+                running.append(job)
+        return running + queued
+
+    def drop(self, job: dict):
+        """Take a queued job out of the queue: its requester waits for another job of the same key."""
+        queue = self.queues.get(job['chat_id'])
+        if not queue or job not in queue:
+            return
+        queue.remove(job)
+        if not queue:
+            del self.queues[job['chat_id']]
+            self.order.remove(job['chat_id'])
+        self._set_state(job, 'done', 'merged')
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            # Воркер так и не отчитался — ждущим пользователям сообщаем об ошибке
+            for job in self._expire():
+                logger.warning(f"Job {job['id']} expired without a report")
+                if self.on_expired:
+                    self._spawn(self.on_expired(job))
+            for job in self.step():
+                self._spawn(self._dispatch(job))
+            timeout = self._next_wakeup(time.monotonic()) if len(self.running) < self.max_running else 60.0
+            if self.running:
+                timeout = min(timeout, min(job['started'] for job in self.running.values()) + self.ttl - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def drain(self):
+        """Wait for dispatches and expiry notices already started, so their states reach storage before it closes."""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -1,13 +1,23 @@
 import os
-import threading
-import requests
+import time
+import signal
+import asyncio
+import concurrent.futures
+import html
 import hashlib
 import logging
-import sqlite3
-import base64
-import urllib.parse
-from datetime import datetime
-from flask import Flask
+from aiohttp import web
+import http_client
+import metrics
+from db_sync import DBSync
+from storage import Storage
+from cache import FileIdCache, LRUCache, TokenStore
+from jobs import InflightTable, JobScheduler
+from broadcast import Broadcaster
+from backends import DOWNLOAD_BACKEND, GitHubActionsBackend, LocalBackend
+from urls import canonicalize, classify, find_link, platform_name
+from extractor import MetadataCache, fetch_metadata
+from updates import ChatOrderedProcessor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, filters, ContextTypes
 
@@ -21,229 +31,209 @@ TOKEN    = os.getenv('BOT_TOKEN')
 GH_TOKEN = os.getenv('GITHUB_TOKEN')
 GH_REPO  = os.getenv('GITHUB_REPO')
 ADMIN_ID = os.getenv('ADMIN_ID')
+# Публичный адрес бота — воркер присылает сюда file_id загруженного видео
+PUBLIC_URL = os.getenv('PUBLIC_URL') or os.getenv('RENDER_EXTERNAL_URL')
+REPORT_SECRET = hashlib.sha256((TOKEN or '').encode()).hexdigest()
+# Показывать название и вес до выбора качества (одно извлечение yt-dlp на ссылку, дальше из кэша)
+PREVIEW_METADATA = os.getenv('PREVIEW_METADATA', '1') == '1'
+PREVIEW_TIMEOUT  = float(os.getenv('PREVIEW_TIMEOUT', 20))
+PREVIEW_WORKERS  = int(os.getenv('PREVIEW_WORKERS', 4))
+# Inline: готовые ответы живут INLINE_CACHE_TIME и у нас, и у Telegram; извлечение — только
+# если пользователь перестал печатать на INLINE_DEBOUNCE секунд, ответ ждёт его не дольше INLINE_WAIT
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', 2000))
+INLINE_DEBOUNCE   = float(os.getenv('INLINE_DEBOUNCE', 0.7))
+INLINE_WAIT       = float(os.getenv('INLINE_WAIT', 6))
+INLINE_QUALITIES  = ('720', '480')
+# Если задан — /metrics отдаётся только с заголовком Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# polling — getUpdates; webhook — Telegram сам присылает апдейты на PUBLIC_URL/telegram
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+PORT = int(os.getenv('PORT', 8080))
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET = hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+WEBHOOK_CONNECTIONS = int(os.getenv('WEBHOOK_CONNECTIONS', 40))
 
 # --- Database Setup ---
 DB_NAME = 'bot_database.db'
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            chat_id INTEGER PRIMARY KEY,
-            username TEXT,
-            joined_date TEXT,
-            request_count INTEGER DEFAULT 0
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS downloads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            url TEXT,
-            quality TEXT,
-            timestamp TEXT,
-            platform TEXT
-        )
-    ''')
-    # Migrate old schema if needed
+db_sync = DBSync(DB_NAME, GH_REPO, GH_TOKEN)
+storage = Storage(DB_NAME, journal=db_sync)
+file_cache = FileIdCache(storage)
+url_tokens = TokenStore(storage)
+inflight = InflightTable()
+metadata = MetadataCache()
+# Извлечения идут в своём пуле потоков: слот занят, пока поток работает, даже если ждущий сдался
+metadata_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix='metadata')
+preview_slots = asyncio.Semaphore(PREVIEW_WORKERS)
+# Извлечения метаданных в процессе: ссылка -> задача, её ждут все, кому нужна эта ссылка
+metadata_fetches = {}
+inline_results = LRUCache(INLINE_CACHE_SIZE, INLINE_CACHE_TIME)
+# Последний inline-запрос пользователя: старые ответы после паузы уже никто не увидит
+inline_latest = {}
+bot_app = None
+backend = None
+
+async def submit_job(job: dict) -> bool:
+    return await backend.submit(job)
+
+async def on_job_dispatched(job: dict, ok: bool):
+    if ok:
+        storage.record_download(job['chat_id'], job['url'], job['quality'], platform_name(job['url']))
+        # Задача ждала в очереди — меняем «в очереди» на «скачиваю»
+        if job.get('queued'):
+            text = downloading_text(job['quality'], inline=not job.get('message_id'))
+            try:
+                if job.get('inline_message_id'):
+                    await bot_app.bot.edit_message_text(text, inline_message_id=job['inline_message_id'], parse_mode='HTML')
+                else:
+                    await bot_app.bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'], parse_mode='HTML')
+            except Exception:
+                pass
+    else:
+        await deliver_to_waiters(job['waiters'], None, "❌ <b>Не удалось запустить задачу.</b>")
+
+async def on_job_expired(job: dict):
+    metrics.JOB_SECONDS.observe(time.time() - job['created'], 'timeout')
+    await deliver_to_waiters(job['waiters'], None,
+                             "⌛ <b>Загрузка не завершилась вовремя.</b> Попробуй ещё раз.")
+
+scheduler = JobScheduler(storage, submit_job, on_job_dispatched, on_job_expired, inflight=inflight)
+broadcaster = Broadcaster(storage)
+
+async def home(request):
+    return web.Response(text="I'm alive!")
+
+async def report(request):
+    """Воркер сообщает file_id загруженного видео, чтобы повторные запросы шли из кэша."""
+    if request.headers.get('X-Report-Token') != REPORT_SECRET:
+        return web.Response(status=403, text="Forbidden")
     try:
-        cursor.execute('ALTER TABLE users ADD COLUMN username TEXT')
-    except sqlite3.OperationalError: pass
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not data.get('url') or not data.get('quality') or not (data.get('file_id') or data.get('error')):
+        return web.Response(status=400, text="Bad request")
+    if bot_app is None or not bot_app.running:
+        return web.Response(status=503, text="Not ready")
+    bot_app.create_task(complete_job(data))
+    return web.Response(text="OK")
+
+async def metrics_endpoint(request):
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=403, text="Forbidden")
+    return web.Response(body=metrics.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def telegram_webhook(request):
+    """Апдейт от Telegram кладётся в очередь приложения; ответ не ждёт обработчиков."""
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403, text="Forbidden")
+    # Во время остановки Telegram получит 503 и повторит апдейт уже новому инстансу
+    if bot_app is None or not bot_app.running:
+        return web.Response(status=503, text="Not ready")
+    # Принятых, но не начатых апдейтов уже на весь backlog — не копим дальше, Telegram повторит позже
+    if bot_app.update_queue.qsize() + bot_app.update_processor.pending >= bot_app.update_processor.backlog:
+        return web.Response(status=503, text="Busy")
     try:
-        cursor.execute('ALTER TABLE users ADD COLUMN request_count INTEGER DEFAULT 0')
-    except sqlite3.OperationalError: pass
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400, text="Bad request")
+    await bot_app.update_queue.put(Update.de_json(data, bot_app.bot))
+    return web.Response(text="OK")
+
+def make_web_app() -> web.Application:
+    web_app = web.Application()
+    web_app.router.add_get('/', home)
+    web_app.router.add_post('/report', report)
+    web_app.router.add_get('/metrics', metrics_endpoint)
+    web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+async def start_web_server(host: str = '0.0.0.0', port: int = PORT) -> web.AppRunner:
+    runner = web.AppRunner(make_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def cache_counters(attr: str) -> dict:
+    caches = {'file_id': file_cache.lru, 'url_token': url_tokens.hot, 'metadata': metadata, 'inline': inline_results}
+    return {(name,): getattr(cache, attr) for name, cache in caches.items()}
+
+metrics.Gauge('bot_cache_hits', 'Cache hits since start.', lambda: cache_counters('hits'), ('cache',))
+metrics.Gauge('bot_cache_misses', 'Cache misses since start.', lambda: cache_counters('misses'), ('cache',))
+metrics.Gauge('bot_cache_hit_ratio', 'Cache hit ratio since start.', lambda: cache_counters('hit_rate'), ('cache',))
+metrics.Gauge('bot_queue_depth', 'Jobs waiting in the scheduler queue.', lambda: scheduler.depth())
+metrics.Gauge('bot_jobs_running', 'Jobs dispatched and not yet reported.', lambda: len(scheduler.running))
+metrics.Gauge('bot_inflight_keys', 'Distinct URL+quality downloads in flight.', lambda: len(inflight))
+metrics.Gauge('bot_sqlite_pending_writes', 'Write groups queued for the SQLite writer.', lambda: storage.pending_writes())
+metrics.Gauge('bot_db_sync_journal_entries', 'DB journal entries not yet flushed to GitHub.', lambda: len(db_sync.entries))
+metrics.Gauge('bot_updates_running', 'Update handlers running now.', lambda: bot_app.update_processor.running if bot_app else 0)
+metrics.Gauge('bot_updates_pending', 'Updates accepted and waiting for their chat or a free handler slot.',
+              lambda: bot_app.update_processor.pending + bot_app.update_queue.qsize() if bot_app else 0)
+
+async def update_github_file(content: bytes, filename: str = 'cookies.txt') -> bool:
     try:
-        cursor.execute('ALTER TABLE downloads ADD COLUMN platform TEXT')
-    except sqlite3.OperationalError: pass
-    conn.commit()
-    conn.close()
-
-def download_db_from_github():
-    if not GH_REPO or not GH_TOKEN:
-        logger.warning("GH_REPO or GH_TOKEN not set, skipping DB download.")
-        return
-    try:
-        url = f"https://api.github.com/repos/{GH_REPO}/contents/{DB_NAME}"
-        headers = {"Authorization": f"Bearer {GH_TOKEN}"}
-        resp = requests.get(url, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            content = base64.b64decode(resp.json()['content'])
-            with open(DB_NAME, 'wb') as f:
-                f.write(content)
-            logger.info("Database downloaded from GitHub.")
-        else:
-            logger.warning(f"Database not found on GitHub (status {resp.status_code}).")
-    except Exception as e:
-        logger.error(f"Error downloading DB from GitHub: {e}")
-
-def push_db_to_github():
-    if not GH_REPO or not GH_TOKEN: return
-    try:
-        with open(DB_NAME, 'rb') as f:
-            content = f.read()
-        update_github_file(content, DB_NAME)
-        logger.info("Database pushed to GitHub.")
-    except Exception as e:
-        logger.error(f"Error pushing DB to GitHub: {e}")
-
-download_db_from_github()
-init_db()
-
-def extract_platform(url: str) -> str:
-    try:
-        domain = urllib.parse.urlparse(url).netloc.lower()
-        if 'youtube.com' in domain or 'youtu.be' in domain:
-            return 'YouTube'
-        elif 'instagram.com' in domain:
-            return 'Instagram'
-        elif 'tiktok.com' in domain:
-            return 'TikTok'
-        elif 'twitter.com' in domain or 'x.com' in domain:
-            return 'Twitter/X'
-        elif 'rutube.ru' in domain:
-            return 'Rutube'
-        elif 'twitch.tv' in domain:
-            return 'Twitch'
-        else:
-            return 'Other'
-    except:
-        return 'Unknown'
-
-def register_user(chat_id: int, username: str | None = None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO users (chat_id, username, joined_date) 
-        VALUES (?, ?, ?)
-        ON CONFLICT(chat_id) DO UPDATE SET username = excluded.username
-    ''', (chat_id, username, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-    push_db_to_github()
-
-def record_download(chat_id: int, url: str, quality: str):
-    platform = extract_platform(url)
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO downloads (chat_id, url, quality, timestamp, platform) VALUES (?, ?, ?, ?, ?)',
-                   (chat_id, url, quality, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), platform))
-    cursor.execute('UPDATE users SET request_count = request_count + 1 WHERE chat_id = ?', (chat_id,))
-    conn.commit()
-    conn.close()
-    push_db_to_github()
-
-def get_stats():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    
-    today = datetime.now().strftime("%Y-%m-%d")
-    cursor.execute('SELECT COUNT(*) FROM downloads WHERE timestamp LIKE ?', (f'{today}%',))
-    downloads_today = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT platform, COUNT(*) FROM downloads WHERE platform IS NOT NULL AND timestamp LIKE ? GROUP BY platform', (f'{today}%',))
-    platform_stats_today = dict(cursor.fetchall())
-    
-    cursor.execute('SELECT platform, COUNT(*) FROM downloads WHERE platform IS NOT NULL GROUP BY platform')
-    platform_stats_total = dict(cursor.fetchall())
-    
-    # Get Top-20 users
-    cursor.execute('SELECT username, chat_id, request_count FROM users ORDER BY request_count DESC LIMIT 20')
-    top_users = cursor.fetchall()
-    
-    conn.close()
-    return total_users, downloads_today, platform_stats_today, platform_stats_total, top_users
-
-def get_all_users():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT chat_id FROM users')
-    users = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return users
-
-
-flask_app = Flask(__name__)
-url_cache = {}
-
-@flask_app.route('/')
-def home():
-    return "I'm alive!"
-
-def run_flask():
-    port = int(os.environ.get("PORT", 8080))
-    flask_app.run(host='0.0.0.0', port=port)
-
-SUPPORTED_DOMAINS = [
-    "youtube.com", "youtu.be",
-    "instagram.com", "tiktok.com",
-    "twitter.com", "x.com",
-    "soundcloud.com", "vimeo.com", "facebook.com",
-    "rutube.ru", "twitch.tv", "clips.twitch.tv",
-]
-
-def get_url_hash(url: str) -> str:
-    return hashlib.md5(url.encode()).hexdigest()[:8]
-
-def update_github_file(content: bytes, filename: str = 'cookies.txt') -> bool:
-    try:
-        url = f"https://api.github.com/repos/{GH_REPO}/contents/{filename}"
-        headers = {
-            "Authorization": f"Bearer {GH_TOKEN}",
-            "Accept": "application/vnd.github+json",
-            "X-GitHub-Api-Version": "2022-11-28",
-        }
         # First get the sha of the existing file
-        resp = requests.get(url, headers=headers, timeout=10)
-        sha = resp.json().get('sha') if resp.status_code == 200 else None
-        
-        payload = {
-            "message": f"Update {filename} via Telegram bot",
-            "content": base64.b64encode(content).decode('utf-8'),
-            "branch": "main"
-        }
-        if sha:
-            payload["sha"] = sha
-            
-        put_resp = requests.put(url, json=payload, headers=headers, timeout=10)
-        return put_resp.status_code in [200, 201]
+        _, sha = await http_client.github_get_file(GH_REPO, GH_TOKEN, filename, with_content=False)
+        status, _ = await http_client.github_put_file(GH_REPO, GH_TOKEN, filename, content, sha=sha)
+        return status in [200, 201]
     except Exception as e:
         logger.error(f"Error updating github file: {e}")
         return False
         
-def trigger_github_action(url: str, quality: str, chat_id: str, reply_to_message_id=None) -> bool:
-    try:
-        api_url = f"https://api.github.com/repos/{GH_REPO}/actions/workflows/download.yml/dispatches"
-        headers = {
-            "Authorization": f"Bearer {GH_TOKEN}",
-            "Accept": "application/vnd.github+json",
-            "X-GitHub-Api-Version": "2022-11-28",
-        }
-        payload = {
-            "ref": "main",
-            "inputs": {
-                "url":        url,
-                "quality":    quality,
-                "chat_id":    str(chat_id),
-                "bot_token":  TOKEN,
-                "message_id": str(reply_to_message_id) if reply_to_message_id else "",
-                "admin_id":   str(ADMIN_ID) if ADMIN_ID else ""
-            }
-        }
-        resp = requests.post(api_url, json=payload, headers=headers, timeout=10)
-        logger.info(f"GitHub Action: chat={chat_id}, quality={quality}, status={resp.status_code}")
-        return resp.status_code == 204
-    except Exception as e:
-        logger.error(f"Error triggering GitHub action: {e}")
-        return False
+def make_backend(app):
+    if DOWNLOAD_BACKEND == 'local':
+        return LocalBackend(app.bot, complete_job, ADMIN_ID)
+    # Без отчёта воркера слот задачи не освободится, а ждущие не получат видео
+    return GitHubActionsBackend(GH_REPO, GH_TOKEN, TOKEN, ADMIN_ID, f"{PUBLIC_URL.rstrip('/')}/report")
+
+async def on_startup(app):
+    global bot_app, backend
+    bot_app = app
+    backend = make_backend(app)
+    logger.info(f"Download backend: {backend.name}")
+    # База восстанавливается с GitHub до того, как начнут приходить апдейты
+    await db_sync.download_snapshot()
+    storage.init_db()
+    await db_sync.replay_journal()
+    storage.start()
+    file_cache.load()
+    url_tokens.prune()
+    metadata.prune()
+    storage.prune_jobs(int(time.time()) - 7 * 24 * 3600)
+    db_sync.start()
+    # Очередь и рассылки читаются из уже восстановленной базы
+    # Принятые до рестарта задачи снова собирают попутные запросы; одинаковые из очереди склеиваем
+    for job in scheduler.restore():
+        if inflight.attach(job['key'], job['chat_id'], job['message_id']):
+            inflight.bind(job['key'], job['id'])
+        elif job['state'] == 'queued':
+            scheduler.drop(job)
+    scheduler.start()
+    broadcaster.bot = app.bot
+    await broadcaster.resume()
+
+async def on_shutdown(app):
+    scheduler.stop()
+    if broadcaster.active:
+        # Рассылка должна остановиться до закрытия базы: её отметки о доставке идут через storage
+        task = broadcaster.active
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    if backend:
+        await backend.close()
+    # Запуски задач, начатые до остановки, дописывают свои состояния в базу до её закрытия
+    await scheduler.drain()
+    metadata_pool.shutdown(wait=False, cancel_futures=True)
+    storage.close()
+    await db_sync.close()
+    await http_client.close()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat:
         user = update.effective_user
         username = f"@{user.username}" if user and user.username else (user.full_name if user else None)
-        register_user(update.effective_chat.id, username)
+        storage.register_user(update.effective_chat.id, username)
     await update.message.reply_text(
         "👋 <b>Привет!</b> Я твой медиа-бот!\n\n"
         "🎬 Я умею скачивать видео из <b>YouTube, Instagram, TikTok, Twitter/X, Rutube (полные видео), Twitch (клипы)</b>.\n\n"
@@ -254,17 +244,40 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='HTML'
     )
 
+def sparkline(values: list) -> str:
+    bars = "▁▂▃▄▅▆▇█"
+    top = max(values) or 1
+    return "".join(bars[v * (len(bars) - 1) // top] for v in values)
+
+def trend_arrow(current: int, previous: int) -> str:
+    if not previous:
+        return ""
+    change = (current - previous) * 100 // previous
+    return f"({'▲' if change >= 0 else '▼'} {abs(change)}% к прошлому периоду)"
+
+@metrics.handler('admin_panel')
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     if ADMIN_ID and str(chat_id) != str(ADMIN_ID):
         return
         
-    total_users, today_downloads, p_today, p_total, top_users = get_stats()
+    total_users, today_downloads, p_today, p_total, top_users = storage.get_stats()
     
     stats_today_str = "\n".join([f"  • {p}: {c}" for p, c in p_today.items()]) if p_today else "  Нет данных"
     stats_total_str = "\n".join([f"  • {p}: {c}" for p, c in p_total.items()]) if p_total else "  Нет данных"
     
     top_users_str = "\n".join([f"  • {u or 'Hidden' if u else c}: {r}" for u, c, r in top_users if r > 0]) or "  Нет запросов"
+    hourly, week, month = storage.get_trends()
+    trend_str = (
+        f"  • 24ч по часам: {sparkline(hourly)} (всего {sum(hourly)})\n"
+        f"  • 7 дней: {week[0]} {trend_arrow(*week)}\n"
+        f"  • 30 дней: {month[0]} {trend_arrow(*month)}"
+    )
+    lru = file_cache.lru
+    waits = sorted(storage.get_job_wait_times(int(time.time()) - 24 * 3600))
+    wait_str = f"среднее {sum(waits) / len(waits):.0f} с, p95 {waits[int(len(waits) * 0.95)]} с" if waits else "нет данных"
+    queue_str = f"  • В очереди: {scheduler.depth()}, выполняется: {len(scheduler.running)}\n  • Ожидание за 24ч: {wait_str}"
+    cache_str = f"  • Попаданий: {lru.hits}, промахов: {lru.misses} ({lru.hit_rate:.0%})\n  • Записей: {len(lru)}"
     
     text = (
         "👑 <b>Панель Администратора</b>\n\n"
@@ -272,7 +285,10 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📥 <b>Скачиваний за сегодня:</b> {today_downloads}\n\n"
         f"📊 <b>По платформам (сегодня):</b>\n{stats_today_str}\n\n"
         f"📈 <b>По платформам (всего):</b>\n{stats_total_str}\n\n"
+        f"📉 <b>Динамика:</b>\n{trend_str}\n\n"
         f"🏆 <b>Топ-20 пользователей:</b>\n{top_users_str}\n\n"
+        f"⚡ <b>Кэш готовых видео:</b>\n{cache_str}\n\n"
+        f"📋 <b>Очередь загрузок:</b>\n{queue_str}\n\n"
         "📢 <b>Рассылка:</b>\n<code>/broadcast Текст сообщения</code>\n\n"
         "🍪 <b>Обновление cookies:</b>\nОтправь файл <code>cookies.txt</code> или <code>insta_cookies.txt</code> и в подписи укажи <code>/update_cookie</code>."
     )
@@ -288,17 +304,8 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Введи текст для рассылки после команды `/broadcast`.", parse_mode='Markdown')
         return
         
-    users = get_all_users()
-    sent = 0
-    await update.message.reply_text("⏳ <b>Начинаю рассылку...</b>", parse_mode='HTML')
-    for u in users:
-        try:
-            await context.bot.send_message(u, text, parse_mode='HTML')
-            sent += 1
-        except Exception:
-            pass
-            
-    await update.message.reply_text(f"✅ <b>Рассылка завершена.</b>\nДоставлено: <b>{sent}</b> из <b>{len(users)}</b>.", parse_mode='HTML')
+    if not await broadcaster.start(text, chat_id):
+        await update.message.reply_text("⚠️ Предыдущая рассылка ещё идёт.", parse_mode='HTML')
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
@@ -310,29 +317,34 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if doc.file_name in ['cookies.txt', 'insta_cookies.txt'] and '/update_cookie' in caption:
         status_msg = await update.message.reply_text(f"⏳ Обновляю <code>{doc.file_name}</code> в репозитории...", parse_mode='HTML')
-        try:
-            file = await context.bot.get_file(doc.file_id)
-            import io
-            out = io.BytesIO()
-            await file.download_to_memory(out)
-            content = out.getvalue()
-            
-            success = update_github_file(content, doc.file_name)
-            if success:
-                await status_msg.edit_text(f"✅ Файл <code>{doc.file_name}</code> успешно обновлён в репозитории!", parse_mode='HTML')
-            else:
-                await status_msg.edit_text("❌ Ошибка при обновлении файла на GitHub (проверьте права токена).", parse_mode='HTML')
-        except Exception as e:
-            logger.error(f"Document error: {e}")
-            await status_msg.edit_text("❌ Произошла внутренняя ошибка.", parse_mode='HTML')
+        # Два запроса к GitHub не держат обработчик: апдейты этого чата идут по порядку и ждали бы их
+        context.application.create_task(upload_cookie_file(context.bot, doc, status_msg))
 
+async def upload_cookie_file(bot, doc, status_msg):
+    try:
+        file = await bot.get_file(doc.file_id)
+        import io
+        out = io.BytesIO()
+        await file.download_to_memory(out)
+        content = out.getvalue()
+
+        success = await update_github_file(content, doc.file_name)
+        if success:
+            await status_msg.edit_text(f"✅ Файл <code>{doc.file_name}</code> успешно обновлён в репозитории!", parse_mode='HTML')
+        else:
+            await status_msg.edit_text("❌ Ошибка при обновлении файла на GitHub (проверьте права токена).", parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Document error: {e}")
+        await status_msg.edit_text("❌ Произошла внутренняя ошибка.", parse_mode='HTML')
+
+@metrics.handler('handle_message')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработка обычных сообщений.
     В группе бот реагирует ТОЛЬКО если есть упоминание @бота.
     """
     if update.effective_chat:
-        register_user(update.effective_chat.id)
+        storage.register_user(update.effective_chat.id)
 
     text = update.message.text
     if not text:
@@ -346,97 +358,246 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if bot_username not in text:
             return 
 
-    url = None
-    for word in text.split():
-        if any(domain in word for domain in SUPPORTED_DOMAINS) and "http" in word:
-            url = word
-            break
-
-    if not url:
+    link = find_link(text)
+    if not link:
         return
-        
-    url_str = str(url)
 
-    if 'twitch.tv' in url_str and '/clip/' not in url_str and 'clips.twitch.tv' not in url_str:
+    if not link.downloadable:
         await update.message.reply_text("⚠️ <b>Ошибка:</b> Я могу скачивать только клипы с Twitch, а не полные трансляции.", parse_mode='HTML', reply_to_message_id=update.message.message_id)
         return
 
-    url_hash = get_url_hash(url_str)
-    url_cache[url_hash] = url_str
-    context.application.bot_data[url_hash] = url_str
+    url_str = link.canonical
+    url_hash = url_tokens.issue(url_str)
 
     keyboard = [
-        [InlineKeyboardButton("📺 720p",  callback_data=f'd_{url_hash}_720'),
-         InlineKeyboardButton("📱 480p",  callback_data=f'd_{url_hash}_480')]
+        [InlineKeyboardButton("📺 до 720p", callback_data=f'd_{url_hash}_720'),
+         InlineKeyboardButton("📱 до 480p", callback_data=f'd_{url_hash}_480')]
     ]
 
-    await update.message.reply_text(
-        "🎛 <b>Выбери качество:</b>",
+    meta = metadata.get(url_str)
+    prompt = await update.message.reply_text(
+        quality_prompt(meta),
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='HTML',
         reply_to_message_id=update.message.message_id
     )
+    if meta is None and PREVIEW_METADATA:
+        context.application.create_task(preview_metadata(prompt, url_str, InlineKeyboardMarkup(keyboard)))
+
+def duration_text(seconds: int) -> str:
+    return f"⏱ {seconds // 60}:{seconds % 60:02d}"
+
+def size_text(size: int) -> str:
+    return f"≈ {max(1, size // 1024 // 1024)} МБ"
+
+def quality_prompt(meta: dict | None) -> str:
+    text = "🎛 <b>Выбери качество:</b>"
+    if not meta:
+        return text
+    text += f"\n\n🎬 <b>{html.escape(meta['title'])}</b>"
+    details = []
+    if meta.get('duration'):
+        details.append(duration_text(meta['duration']))
+    for quality, size in (meta.get('sizes') or {}).items():
+        if size:
+            details.append(f"{quality}p {size_text(size)}")
+    if details:
+        text += "\n" + " · ".join(details)
+    return text
+
+async def preview_metadata(prompt, url: str, reply_markup):
+    """Дописывает в сообщение с кнопками название и вес, как только yt-dlp их вернёт."""
+    try:
+        meta = await load_metadata(url)
+        await prompt.edit_text(quality_prompt(meta), reply_markup=reply_markup, parse_mode='HTML')
+    except Exception as e:
+        logger.info(f"No metadata preview for {url}: {e}")
+
+async def load_metadata(url: str) -> dict:
+    """Сводка по канонической ссылке: одно извлечение yt-dlp, сколько бы обработчиков её ни ждали."""
+    task = metadata_fetches.get(url)
+    if task is None:
+        task = metadata_fetches[url] = asyncio.ensure_future(_fetch_metadata(url))
+        task.add_done_callback(lambda _: metadata_fetches.pop(url, None))
+    # shield: ожидающий может сдаться по таймауту, извлечение всё равно заполнит кэш
+    return await asyncio.shield(task)
+
+async def _fetch_metadata(url: str) -> dict:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PREVIEW_TIMEOUT
+    await asyncio.wait_for(preview_slots.acquire(), PREVIEW_TIMEOUT)
+    future = loop.run_in_executor(metadata_pool, fetch_metadata, url, metadata)
+    future.add_done_callback(lambda _: preview_slots.release())
+    # По таймауту сдаёмся только мы: поток доработает, заполнит кэш и лишь тогда отдаст слот
+    return await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
 
 # Я ВЕРНУЛ ЭТУ ФУНКЦИЮ: Она отвечает за всплывающее окошко при вводе @бота
+@metrics.handler('inline_query')
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Inline-запросы (@bot ссылка и ожидание всплывающего окна)."""
     try:
-        query_text = update.inline_query.query
+        query = update.inline_query
+        query_text = query.query
         if not query_text:
             return
 
-        url = None
-        for word in query_text.split():
-            if any(domain in word for domain in SUPPORTED_DOMAINS):
-                url = word
-                break
-
-        if not url:
+        # В inline ссылку часто набирают без https://
+        link = find_link(query_text, require_scheme=False)
+        if not link:
             results = [InlineQueryResultArticle(
                 id='help',
                 title='🔍 Введите ссылку на видео',
                 description='YouTube, TikTok, Insta, Twitter, Rutube, Twitch Клипы',
                 input_message_content=InputTextMessageContent(message_text='Отправь правильную ссылку на видео (@bot ссылка)')
             )]
-            await update.inline_query.answer(results, cache_time=0)
+            await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
             return
             
-        url_str = str(url)
-        if 'twitch.tv' in url_str and '/clip/' not in url_str and 'clips.twitch.tv' not in url_str:
+        if not link.downloadable:
             results = [InlineQueryResultArticle(
                 id='help',
                 title='🔍 Введите ссылку на клип Twitch',
                 description='Принимаются только клипы (не трансляции)',
                 input_message_content=InputTextMessageContent(message_text='Отправь правильную ссылку на клип.')
             )]
-            await update.inline_query.answer(results, cache_time=0)
+            await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False)
             return
             
-        url_hash = get_url_hash(url_str)
-        url_cache[url_hash] = url_str
-        context.application.bot_data[url_hash] = url_str
+        url_str = link.canonical
+        # Ответ не зависит от пользователя: видео по кнопке уходит тому, кто её нажал
+        results = inline_results.get(url_str)
+        cache_time = INLINE_CACHE_TIME
+        if results is None:
+            meta = metadata.get(url_str)
+            if meta is None and PREVIEW_METADATA:
+                inline_latest[query.from_user.id] = query.id
+                context.application.create_task(answer_inline_later(query, url_str))
+                return
+            results = inline_articles(url_str, meta)
+            if meta:
+                inline_results.put(url_str, results)
+            else:
+                cache_time = 0
+        inline_latest.pop(query.from_user.id, None)
+        await query.answer(results, cache_time=cache_time, is_personal=False)
 
-        label   = '720p'
-        short_url = url_str[:50] + '...' if len(url_str) > 50 else url_str
+    except Exception as e:
+        logger.error(f"inline_query error: {e}", exc_info=True)
 
-        # Кнопка под inline сообщением
+async def answer_inline_later(query, url: str):
+    """Ответ на запрос без метаданных: после паузы в наборе, с одним извлечением на ссылку."""
+    try:
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        # Пользователь ещё печатает — этот запрос устарел, ссылка в нём скорее всего неполная
+        if inline_latest.get(query.from_user.id) != query.id:
+            return
+        del inline_latest[query.from_user.id]
+        try:
+            meta = await asyncio.wait_for(load_metadata(url), INLINE_WAIT)
+        except Exception as e:
+            logger.info(f"No inline metadata for {url} yet: {e}")
+            meta = None
+        results = inline_articles(url, meta)
+        if meta:
+            inline_results.put(url, results)
+        # Без метаданных ответ временный — Telegram не должен его кэшировать
+        await query.answer(results, cache_time=INLINE_CACHE_TIME if meta else 0, is_personal=False)
+    except Exception as e:
+        logger.info(f"Inline answer for {url} failed: {e}")
+
+def inline_thumbnail(url: str, meta: dict) -> str | None:
+    link = classify(url)
+    # Превью результата должно быть JPEG, у YouTube основная обложка — webp
+    if link and link.platform == 'YouTube' and link.media_id:
+        return f"https://i.ytimg.com/vi/{link.media_id}/hqdefault.jpg"
+    return meta.get('thumbnail')
+
+def inline_articles(url: str, meta: dict | None) -> list:
+    """По результату на качество: название, вес и обложка — из метаданных, если они уже есть."""
+    url_hash = url_tokens.issue(url)
+    short_url = url[:50] + '...' if len(url) > 50 else url
+    results = []
+    for quality in INLINE_QUALITIES:
+        label = f'до {quality}p'
         keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton(f"📥 Скачать {label}", callback_data=f'd_{url_hash}_720')
+            InlineKeyboardButton(f"📥 Скачать {label}", callback_data=f'd_{url_hash}_{quality}')
         ]])
-
-        results = [InlineQueryResultArticle(
-            id=url_hash,
-            title=f'📥 Скачать видео ({label})',
-            description=short_url,
+        if meta:
+            details = [label]
+            size = (meta.get('sizes') or {}).get(quality)
+            if size:
+                details.append(size_text(size))
+            if meta.get('duration'):
+                details.append(duration_text(meta['duration']))
+            title, description, thumbnail = meta['title'], ' · '.join(details), inline_thumbnail(url, meta)
+        else:
+            title, description, thumbnail = f'📥 Скачать видео ({label})', short_url, None
+        results.append(InlineQueryResultArticle(
+            id=f'{url_hash}_{quality}',
+            title=title,
+            description=description,
+            thumbnail_url=thumbnail,
             input_message_content=InputTextMessageContent(message_text=url),
             reply_markup=keyboard
-        )]
-
-        await update.inline_query.answer(results, cache_time=0)
+        ))
+    return results
+
+async def complete_job(data: dict):
+    """Итог завершённой задачи: от воркера через /report или от локального бэкенда."""
+    if data.get('meta'):
+        metadata.put(data['url'], data['meta'])
+    if data.get('file_id'):
+        duration = data.get('duration')
+        file_cache.put(data['url'], data['quality'], {
+            'file_id':   data['file_id'],
+            'title':     data.get('title'),
+            'duration':  int(duration) if duration else None,
+            'thumbnail': data.get('thumbnail'),
+        })
+    job_key = FileIdCache.key(data['url'], data['quality'])
+    job = scheduler.finish(job_key, ok=bool(data.get('file_id')), job_id=data.get('job_id'))
+    if job:
+        metrics.JOB_SECONDS.observe(time.time() - job['created'], 'done' if data.get('file_id') else data.get('error') or 'failed')
+    for stage, seconds in (data.get('timings') or {}).items():
+        metrics.WORKER_SECONDS.observe(float(seconds), stage)
+    # Владельцу задачи видео уже отправил воркер, остальным рассылаем сами
+    waiters = job['waiters'][1:] if job else []
+    if data.get('error') == 'too_large':
+        await deliver_to_waiters(waiters, None, "⚠️ <b>Ошибка:</b> Размер видео превышает лимит Telegram в 50 МБ.")
+    else:
+        await deliver_to_waiters(waiters, data.get('file_id'))
+
+async def deliver_to_waiters(waiters: list, file_id: str | None,
+                             error_text: str = "❌ Ошибка при скачивании. Попробуй другое видео или качество."):
+    for chat_id, message_id in waiters:
+        try:
+            if file_id:
+                await bot_app.bot.send_video(chat_id, file_id, supports_streaming=True, reply_to_message_id=message_id)
+            else:
+                await bot_app.bot.send_message(chat_id, error_text, parse_mode='HTML', reply_to_message_id=message_id)
+        except Exception as e:
+            logger.warning(f"Failed to deliver result to {chat_id}: {e}")
 
+async def send_cached(context: ContextTypes.DEFAULT_TYPE, url: str, quality: str, chat_id, reply_to_message_id=None) -> bool:
+    cached = file_cache.get(url, quality)
+    if not cached:
+        return False
+    try:
+        await context.bot.send_video(chat_id, cached['file_id'], supports_streaming=True,
+                                     reply_to_message_id=reply_to_message_id)
+        return True
     except Exception as e:
-        logger.error(f"inline_query error: {e}", exc_info=True)
+        # file_id больше не валиден — забываем его и качаем заново
+        logger.warning(f"Cached file_id failed for {url}: {e}")
+        file_cache.invalidate(url, quality)
+        return False
+
+def downloading_text(quality: str, inline: bool) -> str:
+    if inline:
+        return f"⏳ <b>Запускаю скачивание {quality}...</b>\n<i>Внимание: Файл придёт тебе в ЛС.</i>"
+    return f"⏳ <b>Скачиваю {quality}...</b>\n<i>Файл придёт сюда через 1-2 минуты.</i>"
 
+@metrics.handler('download_callback')
 async def download_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Единый обработчик для всех кнопок."""
     try:
@@ -449,38 +610,61 @@ async def download_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
         url_hash, quality = parts[1], parts[2]
 
-        url = context.application.bot_data.get(url_hash) or url_cache.get(url_hash)
+        url = url_tokens.resolve(url_hash)
         if not url:
             await query.edit_message_text("⚠️ Ссылка устарела. Отправь её заново.")
             return
             
-        url_str = str(url)
+        url_str = canonicalize(str(url))
 
         # Если кнопка была под ОБЫЧНЫМ сообщением (в ЛС или группе)
         if query.message:
             chat_id = query.message.chat_id
             message_id = query.message.message_id
-            await query.edit_message_text(f"⏳ <b>Скачиваю {quality}...</b>\n<i>Файл придёт сюда через 1-2 минуты.</i>", parse_mode='HTML')
-            
         # Если кнопка была под INLINE (всплывающим) сообщением
         else:
             chat_id = query.from_user.id # Telegram скрывает ID группы, отправляем в ЛС
             message_id = None
-            await query.edit_message_text(f"⏳ <b>Запускаю скачивание {quality}...</b>\n<i>Внимание: Файл придёт тебе в ЛС.</i>", parse_mode='HTML')
 
-        # Запускаем GitHub Action
-        success = trigger_github_action(url_str, quality, str(chat_id), message_id)
-        if success:
-            record_download(chat_id, url_str, quality)
+        # Это видео уже загружалось — отправляем по file_id без нового скачивания
+        if await send_cached(context, url_str, quality, chat_id, message_id):
+            await query.edit_message_text(f"✅ <b>Готово ({quality})</b>", parse_mode='HTML')
+            storage.record_download(chat_id, url_str, quality, platform_name(url_str))
+            return
+
+        # Такое же видео уже качается — ждём его результат вместо нового запуска
+        job_key = FileIdCache.key(url_str, quality)
+        if not inflight.attach(job_key, chat_id, message_id):
+            await query.edit_message_text(downloading_text(quality, inline=not query.message), parse_mode='HTML')
+            storage.record_download(chat_id, url_str, quality, platform_name(url_str))
+            return
+
+        # Ставим в очередь; запуск (GitHub Action или локально) делает планировщик
+        job = {
+            'key': job_key, 'url': url_str, 'quality': quality, 'chat_id': chat_id, 'message_id': message_id,
+            'inline_message_id': query.inline_message_id,
+        }
+        position, wait = scheduler.enqueue(job)
+        # Запись ждущих живёт, пока жива задача, сколько бы та ни стояла в очереди
+        inflight.bind(job_key, job['id'])
+        if position or wait > 0 or len(scheduler.running) >= scheduler.max_running:
+            job['queued'] = True
+            await query.edit_message_text(
+                f"🕒 <b>Ты в очереди: {position + 1}</b>\n<i>Слишком много запросов — скачивание начнётся автоматически.</i>",
+                parse_mode='HTML')
         else:
-            await context.bot.send_message(chat_id, "❌ <b>Не удалось запустить задачу.</b>", parse_mode='HTML')
+            await query.edit_message_text(downloading_text(quality, inline=not query.message), parse_mode='HTML')
 
     except Exception as e:
         logger.error(f"download_callback error: {e}", exc_info=True)
 
-if __name__ == '__main__':
-    threading.Thread(target=run_flask, daemon=True).start()
-    app = ApplicationBuilder().token(TOKEN).build()
+def build_application(builder=None):
+    """Приложение со всеми обработчиками; bench.py и тесты собирают его с поддельным слоем запросов."""
+    app = (
+        (builder or ApplicationBuilder().token(TOKEN).connection_pool_size(http_client.MAX_CONNECTIONS))
+        .concurrent_updates(ChatOrderedProcessor())
+        .build()
+    )
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", start))
@@ -493,5 +677,50 @@ if __name__ == '__main__':
     app.add_handler(CallbackQueryHandler(download_callback, pattern='^d_'))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    
-    app.run_polling()
\ No newline at end of file
+    return app
+
+async def start_receiving(app):
+    if BOT_MODE == 'webhook':
+        await app.bot.set_webhook(f"{PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES, max_connections=WEBHOOK_CONNECTIONS)
+    else:
+        # start_polling сам снимает вебхук, оставшийся от webhook-режима
+        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+async def stop_receiving(app):
+    # Вебхук не снимаем: пока идёт остановка, Telegram получает 503 и придержит апдейты для нового инстанса
+    if app.updater.running:
+        await app.updater.stop()
+
+async def serve():
+    """Один цикл событий на всё: aiohttp отдаёт /, /report, /metrics и вебхук рядом с ботом."""
+    app = build_application()
+    # Порт открываем сразу — health-check проходит, пока база восстанавливается
+    runner = await start_web_server()
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    await start_receiving(app)
+    logger.info(f"Bot is running in {BOT_MODE} mode")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    # Новые апдейты больше не принимаем, уже принятые дорабатывают до конца
+    await stop_receiving(app)
+    processor = app.update_processor
+    logger.info(f"Stopping: draining {app.update_queue.qsize() + processor.current_concurrent_updates} updates")
+    await app.stop()
+    await runner.cleanup()
+    await on_shutdown(app)
+    await app.shutdown()
+
+if __name__ == '__main__':
+    if BOT_MODE == 'webhook' and not PUBLIC_URL:
+        raise SystemExit("BOT_MODE=webhook needs PUBLIC_URL")
+    if DOWNLOAD_BACKEND == 'github' and not PUBLIC_URL:
+        raise SystemExit("DOWNLOAD_BACKEND=github needs PUBLIC_URL: the worker reports results to /report")
+    asyncio.run(serve())
@@ -0,0 +1,158 @@
+import time
+import bisect
+import logging
+import functools
+import threading
+import inspect
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = []
+SLOW_HANDLER_SECONDS = 1.0
+
+# Обработчики и SQLite — миллисекунды, GitHub API — сотни мс, задачи — минуты
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS  = (1, 2.5, 5, 15, 30, 60, 90, 120, 180, 300, 600, 900, 1800)
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _labels(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}', *self.samples()]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, n: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [f'{self.name}{self._labels(labels)} {value}' for labels, value in items]
+
+
+class Histogram(_Metric):
+    """Histogram with fixed buckets; observe() is a bisect and three additions under a lock."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = FAST_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self.values.get(labels)
+            if series is None:
+                # Счётчики по корзинам (+Inf последней), затем сумма
+                series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """Decorator timing a sync or async function into this histogram."""
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, *labels)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, *labels)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self.values.items()]
+        lines = []
+        for labels, series in items:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._labels(labels, le)} {total}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {total}')
+        return lines
+
+
+class Gauge(_Metric):
+    """Value read at scrape time: fn() returns a number or a {labels tuple: number} dict."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, fn, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} failed: {e}")
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f'{self.name}{self._labels(labels)} {v}' for labels, v in value.items()]
+
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', 'Telegram update handler latency.', ('handler',))
+HANDLER_ERRORS  = Counter('bot_handler_errors_total', 'Exceptions escaping update handlers.', ('handler',))
+HTTP_SECONDS    = Histogram('bot_http_request_seconds', 'Outgoing HTTP request latency per attempt.', ('endpoint',), HTTP_BUCKETS)
+HTTP_RESPONSES  = Counter('bot_http_responses_total', 'Outgoing HTTP responses by status code.', ('endpoint', 'status'))
+SQLITE_SECONDS  = Histogram('bot_sqlite_seconds', 'SQLite reads per query and writer batch commits.', ('op',))
+JOB_SECONDS     = Histogram('bot_job_seconds', 'End-to-end job time from button click to result.', ('result',), JOB_BUCKETS)
+WORKER_SECONDS  = Histogram('bot_worker_stage_seconds', 'Stage timings reported by the download worker.', ('stage',), JOB_BUCKETS)
+
+
+def handler(name: str):
+    """Time a Telegram handler, count its exceptions and log slow calls."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(name)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                HANDLER_SECONDS.observe(elapsed, name)
+                if elapsed > SLOW_HANDLER_SECONDS:
+                    logger.warning(f"slow_handler handler={name} seconds={elapsed:.3f}")
+        return wrapper
+    return decorator
@@ -0,0 +1,113 @@
+import os
+import logging
+import subprocess
+import urllib.parse
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from extractor import probe_duration
+
+logger = logging.getLogger(__name__)
+
+SLIDE_SECONDS = 3
+FETCH_WORKERS = int(os.getenv('SLIDESHOW_FETCH_WORKERS', 8))
+# Вписываем все фото в один кадр: ролики TikTok вертикальные
+FRAME_WIDTH, FRAME_HEIGHT = 1080, 1920
+# Кадр меняется раз в SLIDE_SECONDS; держим пару кадров в секунду, чтобы плееры не спотыкались
+OUTPUT_FPS = 2
+
+
+def image_key(url: str) -> str:
+    """Identity of a photo regardless of CDN host, size template and signed query.
+
+    TikTok lists every photo several times, e.g.
+    https://p16-sign.tiktokcdn-us.com/tos-.../<id>~tplv-photomode-image.jpeg?x-expires=...
+    https://p19-sign.tiktokcdn-us.com/tos-.../<id>~tplv-photomode-image-v1:...webp?...
+    """
+    path = urllib.parse.urlparse(url).path
+    return path.rsplit('/', 1)[-1].split('~', 1)[0].rsplit('.', 1)[0]
+
+
+def _is_jpeg(url: str) -> bool:
+    path = urllib.parse.urlparse(url).path.lower()
+    return path.endswith(('.jpg', '.jpeg')) or 'jpeg' in path
+
+
+def image_groups(thumbnails: list) -> list:
+    """Distinct photos in post order, each a list of mirror URLs, JPEG variants first."""
+    groups = {}
+    for thumb in thumbnails:
+        url = thumb.get('url')
+        if url:
+            groups.setdefault(image_key(url), []).append(url)
+    # Весь ролик идёт одним потоком image2pipe, поэтому формат у кадров должен совпадать
+    return [sorted(urls, key=lambda u: not _is_jpeg(u)) for urls in groups.values()]
+
+
+def _session(workers: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_images(groups: list, workers: int = FETCH_WORKERS, headers: dict | None = None) -> list:
+    """Download one variant of every photo concurrently over pooled connections. Order is kept; failures are dropped."""
+    session = _session(workers)
+    if headers:
+        session.headers.update(headers)
+
+    def fetch(urls):
+        for url in urls:
+            try:
+                resp = session.get(url, timeout=30)
+                if resp.status_code == 200 and resp.content:
+                    return resp.content
+            except requests.RequestException as e:
+                logger.info(f"Image fetch failed, trying next mirror: {e}")
+        return None
+
+    with session, concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return [image for image in pool.map(fetch, groups) if image]
+
+
+def encode(images: list, audio: str | None, output: str, seconds: float = SLIDE_SECONDS) -> str:
+    """Stream the photos into ffmpeg through stdin and encode a still-image friendly H.264."""
+    frame = (f"scale={FRAME_WIDTH}:{FRAME_HEIGHT}:force_original_aspect_ratio=decrease,"
+             f"pad={FRAME_WIDTH}:{FRAME_HEIGHT}:(ow-iw)/2:(oh-ih)/2,format=yuv420p")
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+           '-f', 'image2pipe', '-framerate', f'1/{seconds}', '-i', '-']
+    if audio:
+        cmd += ['-i', audio]
+    cmd += ['-vf', frame, '-r', str(OUTPUT_FPS),
+            '-c:v', 'libx264', '-preset', 'veryfast', '-tune', 'stillimage', '-crf', '28',
+            '-g', str(int(OUTPUT_FPS * seconds))]
+    # -shortest неточен при таком низком fps входа — длительность считаем сами
+    duration = len(images) * seconds
+    if audio:
+        cmd += ['-c:a', 'aac', '-b:a', '128k']
+        duration = min(duration, probe_duration(audio) or duration)
+    cmd += ['-t', f'{duration:.2f}']
+    cmd += ['-movflags', '+faststart', output]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for image in images:
+            proc.stdin.write(image)
+    except BrokenPipeError:
+        pass
+    finally:
+        proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg exited with {proc.returncode}")
+    return output
+
+
+def build_slideshow(info: dict, audio: str | None, output: str) -> str | None:
+    """Slideshow of a TikTok photo post from its extracted info. None if no photo could be fetched."""
+    groups = image_groups(info.get('thumbnails') or [])
+    images = fetch_images(groups, headers=info.get('http_headers'))
+    logger.info(f"Slideshow: {len(images)} of {len(groups)} photos fetched")
+    if not images:
+        return None
+    return encode(images, audio, output)
@@ -0,0 +1,450 @@
+import os
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from metrics import SQLITE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов на запись максимум объединяется в одну транзакцию
+WRITE_BATCH_MAX = int(os.getenv('DB_WRITE_BATCH_MAX', 500))
+# PRAGMA user_version базы, в которой роллапы статистики уже посчитаны из истории
+ROLLUPS_VERSION = 1
+
+
+class Storage:
+    """Long-lived SQLite access layer.
+
+    All writes go through one writer thread that drains whatever is queued
+    and commits it as a single transaction, so handlers never wait for the
+    disk and never see "database is locked". Reads use their own per-thread
+    connections; WAL mode lets them run alongside the writer. Each committed
+    batch is appended to the DB sync journal as one entry.
+    """
+
+    def __init__(self, db_name: str, journal=None):
+        self.db_name = db_name
+        self.journal = journal
+        self.known_users = {}
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._writer = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_name, timeout=5, check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout = 5000')
+        return conn
+
+    def init_db(self):
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                chat_id INTEGER PRIMARY KEY,
+                username TEXT,
+                joined_date TEXT,
+                request_count INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS downloads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                url TEXT,
+                quality TEXT,
+                timestamp TEXT,
+                platform TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS file_cache (
+                cache_key TEXT PRIMARY KEY,
+                file_id TEXT,
+                title TEXT,
+                duration INTEGER,
+                thumbnail TEXT,
+                created INTEGER
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS url_tokens (
+                token TEXT PRIMARY KEY,
+                url TEXT,
+                created INTEGER
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_url_tokens_created ON url_tokens (created)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                job_key TEXT,
+                url TEXT,
+                quality TEXT,
+                chat_id INTEGER,
+                message_id INTEGER,
+                inline_message_id TEXT,
+                state TEXT,
+                created INTEGER,
+                dispatched INTEGER,
+                finished INTEGER,
+                error TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY,
+                text TEXT,
+                admin_chat_id INTEGER,
+                status_message_id INTEGER,
+                state TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER,
+                chat_id INTEGER,
+                state TEXT,
+                PRIMARY KEY (broadcast_id, chat_id)
+            ) WITHOUT ROWID
+        ''')
+        # Migrate old schema if needed
+        try:
+            cursor.execute('ALTER TABLE users ADD COLUMN username TEXT')
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute('ALTER TABLE users ADD COLUMN request_count INTEGER DEFAULT 0')
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute('ALTER TABLE downloads ADD COLUMN platform TEXT')
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute('ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0')
+        except sqlite3.OperationalError: pass
+        try:
+            cursor.execute('ALTER TABLE downloads ADD COLUMN ts INTEGER')
+        except sqlite3.OperationalError: pass
+        # Текстовое локальное время -> epoch для старых строк
+        cursor.execute("UPDATE downloads SET ts = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE ts IS NULL")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_downloads_ts ON downloads (ts)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_request_count ON users (request_count)')
+        self._init_rollups(cursor)
+        conn.commit()
+        conn.close()
+
+    def _init_rollups(self, cursor):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_daily (
+                day TEXT,
+                platform TEXT,
+                count INTEGER,
+                PRIMARY KEY (day, platform)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_platform (
+                platform TEXT PRIMARY KEY,
+                count INTEGER
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_hourly (
+                hour INTEGER PRIMARY KEY,
+                count INTEGER
+            )
+        ''')
+        # Первый запуск с роллапами — один раз пересчитываем их из истории. Признак — user_version:
+        # по пустой stats_platform не понять, ведь у старых строк platform бывает NULL
+        if cursor.execute('PRAGMA user_version').fetchone()[0] < ROLLUPS_VERSION:
+            for table in ('stats_daily', 'stats_platform', 'stats_hourly'):
+                cursor.execute(f'DELETE FROM {table}')
+            cursor.execute('''
+                INSERT INTO stats_daily (day, platform, count)
+                SELECT substr(timestamp, 1, 10), platform, COUNT(*) FROM downloads
+                WHERE platform IS NOT NULL GROUP BY 1, 2
+            ''')
+            cursor.execute('''
+                INSERT INTO stats_platform (platform, count)
+                SELECT platform, COUNT(*) FROM downloads WHERE platform IS NOT NULL GROUP BY 1
+            ''')
+            cursor.execute('''
+                INSERT INTO stats_hourly (hour, count)
+                SELECT ts / 3600 * 3600, COUNT(*) FROM downloads WHERE ts IS NOT NULL GROUP BY 1
+            ''')
+            cursor.execute(f'PRAGMA user_version = {ROLLUPS_VERSION}')
+
+    def start(self):
+        """Load the known-users set and start the writer thread. Call after restore."""
+        self.known_users = dict(self._read().execute('SELECT chat_id, username FROM users').fetchall())
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def close(self):
+        if self._writer and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def wait(self):
+        """Block until every queued write is committed."""
+        self._queue.join()
+
+    # --- Writer ---
+
+    def pending_writes(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, ops):
+        """Queue (sql, params) ops to be committed together. Does not block."""
+        self._queue.put(ops)
+
+    def _commit(self, conn, batch):
+        if self.journal is None:
+            with conn:
+                for sql, params in batch:
+                    conn.execute(sql, params)
+            return
+        # Коммит и запись в журнал под локом журнала — снапшот всегда согласован
+        with self.journal.lock:
+            with conn:
+                for sql, params in batch:
+                    conn.execute(sql, params)
+            self.journal.record(batch)
+
+    def _write_loop(self):
+        conn = self._connect()
+        conn.execute('PRAGMA synchronous = NORMAL')
+        stop = False
+        while not stop:
+            items = [self._queue.get()]
+            while len(items) < WRITE_BATCH_MAX:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in items:
+                stop = True
+            groups = [ops for ops in items if ops is not None]
+            try:
+                if groups:
+                    start = time.perf_counter()
+                    self._commit(conn, [op for ops in groups for op in ops])
+                    SQLITE_SECONDS.observe(time.perf_counter() - start, 'write_batch')
+            except sqlite3.Error as e:
+                # Одна битая запись не должна терять весь батч — коммитим по отдельности
+                logger.error(f"DB batch write failed ({e}), retrying one by one.")
+                for ops in groups:
+                    try:
+                        self._commit(conn, ops)
+                    except sqlite3.Error as e:
+                        logger.error(f"DB write dropped: {e}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+        conn.close()
+
+    # --- Reads ---
+
+    def _read(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute('PRAGMA query_only = ON')
+            self._local.conn = conn
+        return conn
+
+    # --- Queries ---
+
+    def register_user(self, chat_id: int, username: str | None = None):
+        # Известный пользователь без изменений — в базу не пишем
+        if chat_id in self.known_users and (username is None or self.known_users[chat_id] == username):
+            return
+        self.known_users[chat_id] = username if username is not None else self.known_users.get(chat_id)
+        self.submit([('''
+            INSERT INTO users (chat_id, username, joined_date)
+            VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET username = COALESCE(excluded.username, username), blocked = 0
+        ''', (chat_id, username, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))])
+
+    def record_download(self, chat_id: int, url: str, quality: str, platform: str):
+        now = datetime.now()
+        ts = int(now.timestamp())
+        self.submit([
+            ('INSERT INTO downloads (chat_id, url, quality, timestamp, platform, ts) VALUES (?, ?, ?, ?, ?, ?)',
+             (chat_id, url, quality, now.strftime("%Y-%m-%d %H:%M:%S"), platform, ts)),
+            ('UPDATE users SET request_count = request_count + 1 WHERE chat_id = ?', (chat_id,)),
+            # Роллапы для /admin обновляются в той же транзакции
+            ('INSERT INTO stats_daily (day, platform, count) VALUES (?, ?, 1) ON CONFLICT(day, platform) DO UPDATE SET count = count + 1',
+             (now.strftime("%Y-%m-%d"), platform)),
+            ('INSERT INTO stats_platform (platform, count) VALUES (?, 1) ON CONFLICT(platform) DO UPDATE SET count = count + 1',
+             (platform,)),
+            ('INSERT INTO stats_hourly (hour, count) VALUES (?, 1) ON CONFLICT(hour) DO UPDATE SET count = count + 1',
+             (ts // 3600 * 3600,)),
+        ])
+
+    def save_file_cache(self, cache_key: str, info: dict):
+        self.submit([('''
+            INSERT OR REPLACE INTO file_cache (cache_key, file_id, title, duration, thumbnail, created)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (cache_key, info['file_id'], info.get('title'), info.get('duration'), info.get('thumbnail'), int(time.time())))])
+
+    def delete_file_cache(self, cache_key: str):
+        self.submit([('DELETE FROM file_cache WHERE cache_key = ?', (cache_key,))])
+
+    @SQLITE_SECONDS.time('load_file_cache')
+    def load_file_cache(self, limit: int, min_created: float):
+        """Newest `limit` entries not older than min_created, oldest first."""
+        rows = self._read().execute('''
+            SELECT cache_key, created, file_id, title, duration, thumbnail FROM file_cache
+            WHERE created >= ? ORDER BY created DESC LIMIT ?
+        ''', (int(min_created), limit)).fetchall()
+        return [(key, created, {'file_id': file_id, 'title': title, 'duration': duration, 'thumbnail': thumbnail})
+                for key, created, file_id, title, duration, thumbnail in reversed(rows)]
+
+    def save_url_token(self, token: str, url: str):
+        self.submit([('INSERT OR REPLACE INTO url_tokens (token, url, created) VALUES (?, ?, ?)',
+                      (token, url, int(time.time())))])
+
+    @SQLITE_SECONDS.time('load_url_token')
+    def load_url_token(self, token: str, min_created: float) -> str | None:
+        row = self._read().execute('SELECT url FROM url_tokens WHERE token = ? AND created >= ?',
+                                   (token, int(min_created))).fetchone()
+        return row[0] if row else None
+
+    def prune_url_tokens(self, max_rows: int, min_created: float):
+        self.submit([
+            ('DELETE FROM url_tokens WHERE created < ?', (int(min_created),)),
+            ('''DELETE FROM url_tokens WHERE token IN (
+                   SELECT token FROM url_tokens ORDER BY created DESC LIMIT -1 OFFSET ?)''', (max_rows,)),
+        ])
+
+    def save_job(self, job: dict):
+        self.submit([('''
+            INSERT OR REPLACE INTO jobs (id, job_key, url, quality, chat_id, message_id, inline_message_id, state, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (job['id'], job['key'], job['url'], job['quality'], job['chat_id'], job.get('message_id'),
+              job.get('inline_message_id'), job['state'], job['created']))])
+
+    def update_job(self, job_id: str, state: str, ts: int, error: str | None = None):
+        if state == 'dispatched':
+            sql, params = 'UPDATE jobs SET state = ?, dispatched = ? WHERE id = ?', (state, ts, job_id)
+        elif state in ('done', 'failed'):
+            sql, params = 'UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?', (state, ts, error, job_id)
+        else:
+            sql, params = 'UPDATE jobs SET state = ? WHERE id = ?', (state, job_id)
+        self.submit([(sql, params)])
+
+    @SQLITE_SECONDS.time('load_active_jobs')
+    def load_active_jobs(self) -> list:
+        cursor = self._read().execute('''
+            SELECT id, job_key, url, quality, chat_id, message_id, inline_message_id, state, created, dispatched
+            FROM jobs WHERE state IN ('queued', 'dispatched', 'running') ORDER BY created
+        ''')
+        columns = ['id', 'key', 'url', 'quality', 'chat_id', 'message_id', 'inline_message_id', 'state', 'created', 'dispatched']
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def prune_jobs(self, before: int):
+        self.submit([("DELETE FROM jobs WHERE state IN ('done', 'failed') AND created < ?", (before,))])
+
+    @SQLITE_SECONDS.time('get_job_wait_times')
+    def get_job_wait_times(self, since: int) -> list:
+        """Queue wait (dispatched - created) in seconds of jobs created after `since`."""
+        return [row[0] for row in self._read().execute(
+            'SELECT dispatched - created FROM jobs WHERE created >= ? AND dispatched IS NOT NULL', (since,))]
+
+    @SQLITE_SECONDS.time('get_stats')
+    def get_stats(self):
+        cursor = self._read().cursor()
+        cursor.execute('SELECT COUNT(*) FROM users')
+        total_users = cursor.fetchone()[0]
+
+        today = datetime.now().strftime("%Y-%m-%d")
+        cursor.execute('SELECT platform, count FROM stats_daily WHERE day = ?', (today,))
+        platform_stats_today = dict(cursor.fetchall())
+        downloads_today = sum(platform_stats_today.values())
+
+        cursor.execute('SELECT platform, count FROM stats_platform')
+        platform_stats_total = dict(cursor.fetchall())
+
+        # Get Top-20 users
+        cursor.execute('SELECT username, chat_id, request_count FROM users ORDER BY request_count DESC LIMIT 20')
+        top_users = cursor.fetchall()
+
+        return total_users, downloads_today, platform_stats_today, platform_stats_total, top_users
+
+    @SQLITE_SECONDS.time('get_trends')
+    def get_trends(self):
+        """Hourly counts for the last 24 hours and totals for the last/previous 7 and 30 days."""
+        cursor = self._read().cursor()
+        current_hour = int(time.time()) // 3600 * 3600
+        cursor.execute('SELECT hour, count FROM stats_hourly WHERE hour > ?', (current_hour - 24 * 3600,))
+        by_hour = dict(cursor.fetchall())
+        hourly = [by_hour.get(current_hour - i * 3600, 0) for i in range(23, -1, -1)]
+
+        def days_total(start: int, end: int) -> int:
+            today = datetime.now().date()
+            first = (today - timedelta(days=end - 1)).isoformat()
+            last = (today - timedelta(days=start)).isoformat()
+            cursor.execute('SELECT COALESCE(SUM(count), 0) FROM stats_daily WHERE day BETWEEN ? AND ?', (first, last))
+            return cursor.fetchone()[0]
+
+        return hourly, (days_total(0, 7), days_total(7, 14)), (days_total(0, 30), days_total(30, 60))
+
+    @SQLITE_SECONDS.time('get_all_users')
+    def get_all_users(self):
+        """Chats that can still receive messages (blocked ones are skipped)."""
+        return [row[0] for row in self._read().execute('SELECT chat_id FROM users WHERE COALESCE(blocked, 0) = 0')]
+
+    # --- Broadcasts ---
+
+    def create_broadcast(self, bc: dict):
+        # Получателей выбираем тем же запросом внутри SQL: в журнал синхронизации уходит
+        # одна строка, а не список всех chat_id
+        ops = [('INSERT INTO broadcasts (id, text, admin_chat_id, status_message_id, state) VALUES (?, ?, ?, ?, ?)',
+                (bc['id'], bc['text'], bc['admin_chat_id'], bc['status_message_id'], 'running'))]
+        ops += [('''
+            INSERT INTO broadcast_recipients (broadcast_id, chat_id, state)
+            SELECT ?, chat_id, 'pending' FROM users WHERE COALESCE(blocked, 0) = 0
+        ''', (bc['id'],))]
+        self.submit(ops)
+
+    def mark_broadcast_recipients(self, broadcast_id: int, state: str, chat_ids: list):
+        ops = []
+        for i in range(0, len(chat_ids), 500):
+            chunk = chat_ids[i:i + 500]
+            ops.append((f"UPDATE broadcast_recipients SET state = ? WHERE broadcast_id = ? AND chat_id IN ({','.join('?' * len(chunk))})",
+                        (state, broadcast_id, *chunk)))
+        self.submit(ops)
+
+    def mark_blocked(self, chat_ids: list):
+        for chat_id in chat_ids:
+            # Если пользователь снова напишет боту, register_user снимет блокировку
+            self.known_users.pop(chat_id, None)
+        ops = []
+        for i in range(0, len(chat_ids), 500):
+            chunk = chat_ids[i:i + 500]
+            ops.append((f"UPDATE users SET blocked = 1 WHERE chat_id IN ({','.join('?' * len(chunk))})", tuple(chunk)))
+        self.submit(ops)
+
+    def finish_broadcast(self, broadcast_id: int):
+        self.submit([("UPDATE broadcasts SET state = 'done' WHERE id = ?", (broadcast_id,))])
+
+    @SQLITE_SECONDS.time('load_unfinished_broadcasts')
+    def load_unfinished_broadcasts(self) -> list:
+        cursor = self._read().execute(
+            "SELECT id, text, admin_chat_id, status_message_id FROM broadcasts WHERE state = 'running' ORDER BY id")
+        return [dict(zip(['id', 'text', 'admin_chat_id', 'status_message_id'], row)) for row in cursor.fetchall()]
+
+    @SQLITE_SECONDS.time('get_broadcast_recipients')
+    def get_broadcast_recipients(self, broadcast_id: int, state: str) -> list:
+        return [row[0] for row in self._read().execute(
+            'SELECT chat_id FROM broadcast_recipients WHERE broadcast_id = ? AND state = ?', (broadcast_id, state))]
+
+    @SQLITE_SECONDS.time('get_broadcast_counts')
+    def get_broadcast_counts(self, broadcast_id: int) -> dict:
+        return dict(self._read().execute(
+            'SELECT state, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY state', (broadcast_id,)).fetchall())
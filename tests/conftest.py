@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import base64
+import asyncio
+import hashlib
+import threading
+import functools
+import subprocess
+import http.server
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Совместимый загрузчик плагинов yt-dlp подменяет sys.modules['extractor'] своим пакетом,
+# а наш модуль называется так же: в одном процессе с YoutubeDL тесты потом не импортируют main
+os.environ['YTDLP_NO_PLUGINS'] = '1'
+
+import http_client  # noqa: E402
+
+INLINE_LIMIT = 1024 * 1024
+
+
+class FakeGitHub:
+    """Contents API in memory: sha checks on PUT, content inlined only up to 1 MB."""
+
+    def __init__(self):
+        self.files = {}  # path -> bytes
+        self.calls = []
+        self.fail = set()  # пути, на которые GET отвечает 500
+
+    @staticmethod
+    def sha(content: bytes) -> str:
+        return hashlib.sha1(content).hexdigest()
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.split('/contents/', 1)[1]
+        accept = request.headers.get('Accept', '')
+        self.calls.append((request.method, path, accept))
+        if request.method == 'GET':
+            if path in self.fail:
+                return httpx.Response(500)
+            if path not in self.files:
+                return httpx.Response(404, json={'message': 'Not Found'})
+            content = self.files[path]
+            if accept == 'application/vnd.github.raw':
+                return httpx.Response(200, content=content)
+            inline = len(content) <= INLINE_LIMIT
+            return httpx.Response(200, json={
+                'type': 'file', 'sha': self.sha(content), 'size': len(content),
+                'encoding': 'base64' if inline else 'none',
+                'content': base64.b64encode(content).decode() if inline else '',
+            })
+        if request.method == 'PUT':
+            body = json.loads(request.content)
+            if path in self.files and body.get('sha') != self.sha(self.files[path]):
+                return httpx.Response(409, json={'message': 'sha mismatch'})
+            self.files[path] = base64.b64decode(body['content'])
+            return httpx.Response(200, json={'content': {'sha': self.sha(self.files[path])}})
+        return httpx.Response(405)
+
+
+class MediaHandler(http.server.SimpleHTTPRequestHandler):
+    """Static files; every request is recorded on the server as (method, path)."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        self.server.requests.append((self.command, self.path))
+        return super().send_head()
+
+
+@pytest.fixture(scope='session')
+def media_server(tmp_path_factory):
+    """Static HTTP server with a 3-second 480p clip, like a direct video link."""
+    root = tmp_path_factory.mktemp('media')
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=3:size=854x480:rate=25',
+                    '-f', 'lavfi', '-i', 'sine=duration=3', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                    '-shortest', str(root / 'clip.mp4')], check=True)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(MediaHandler, directory=str(root)))
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield SimpleNamespace(url=f'http://127.0.0.1:{server.server_address[1]}', size=os.path.getsize(root / 'clip.mp4'),
+                          root=root, requests=server.requests)
+    server.shutdown()
+
+
+@pytest.fixture
+def github(monkeypatch):
+    fake = FakeGitHub()
+    monkeypatch.setattr(http_client, '_client', httpx.AsyncClient(transport=httpx.MockTransport(fake.handler)))
+    monkeypatch.setattr(http_client, '_semaphore', asyncio.Semaphore(http_client.MAX_CONCURRENCY))
+    monkeypatch.setattr(http_client, 'MAX_RETRIES', 0)
+    yield fake
+    monkeypatch.setattr(http_client, '_client', None)
+
+
+@pytest.fixture(scope='session')
+def main_module(tmp_path_factory):
+    """main imported once, in a temporary directory with its own DB and without GitHub."""
+    workdir = tmp_path_factory.mktemp('bot')
+    os.environ.update({
+        'BOT_TOKEN': '123456:TEST', 'PUBLIC_URL': 'http://127.0.0.1', 'DOWNLOAD_BACKEND': 'github',
+        'METADATA_DIR': str(workdir / 'metadata_cache'), 'BATCH_WINDOW': '0.01',
+    })
+    for name in ('GITHUB_TOKEN', 'GITHUB_REPO', 'RENDER_EXTERNAL_URL'):
+        os.environ.pop(name, None)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    import main
+    yield main
+    os.chdir(cwd)
+
+
+class CountingBackend:
+    name = 'test'
+
+    def __init__(self):
+        self.jobs = []
+
+    async def submit(self, job: dict) -> bool:
+        self.jobs.append(job)
+        return True
+
+    async def close(self):
+        pass
+
+
+class Bot:
+    """The real application with Telegram answered locally (bench.py's fake request) and a counting backend."""
+
+    def __init__(self, main):
+        self.main = main
+        self.app = None
+        self.telegram = None
+        self.backend = CountingBackend()
+
+    async def start(self):
+        from telegram.ext import ApplicationBuilder
+        from bench import make_fake_request
+        self.telegram = make_fake_request(0)
+        self.app = self.main.build_application(
+            ApplicationBuilder().token(self.main.TOKEN).request(self.telegram).get_updates_request(self.telegram))
+        await self.app.initialize()
+        await self.main.on_startup(self.app)
+        await self.app.start()
+        self.main.backend = self.backend
+        return self
+
+    async def stop(self):
+        await self.app.stop()
+        await self.main.on_shutdown(self.app)
+        await self.app.shutdown()
+
+
+@pytest.fixture
+def bot(main_module, monkeypatch):
+    import concurrent.futures
+    from jobs import InflightTable, JobScheduler
+    from cache import LRUCache
+    from broadcast import Broadcaster
+    main = main_module
+    # Всё, что привязано к циклу событий или копит состояние, у каждого теста своё
+    monkeypatch.setattr(main, 'inflight', InflightTable())
+    monkeypatch.setattr(main, 'scheduler', JobScheduler(main.storage, main.submit_job, main.on_job_dispatched,
+                                                        main.on_job_expired, inflight=main.inflight))
+    monkeypatch.setattr(main, 'metadata_pool', concurrent.futures.ThreadPoolExecutor(max_workers=main.PREVIEW_WORKERS))
+    monkeypatch.setattr(main, 'preview_slots', asyncio.Semaphore(main.PREVIEW_WORKERS))
+    monkeypatch.setattr(main, 'metadata_fetches', {})
+    monkeypatch.setattr(main, 'inline_results', LRUCache(main.INLINE_CACHE_SIZE, main.INLINE_CACHE_TIME))
+    monkeypatch.setattr(main, 'inline_latest', {})
+    monkeypatch.setattr(main, 'broadcaster', Broadcaster(main.storage))
+    return Bot(main)
@@ -0,0 +1,69 @@
+import os
+import shutil
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from backends import LocalBackend
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+
+
+class FakeBot:
+    def __init__(self):
+        self.videos = []
+        self.messages = []
+
+    async def send_video(self, chat_id, video, **kwargs):
+        self.videos.append((chat_id, len(video.read()), kwargs.get('reply_to_message_id')))
+        return SimpleNamespace(video=SimpleNamespace(file_id=f'file{len(self.videos)}'))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+    async def edit_message_text(self, text, **kwargs):
+        pass
+
+
+def run_jobs(tmp_path, jobs: list) -> tuple[FakeBot, list]:
+    bot = FakeBot()
+    reports = []
+
+    async def scenario():
+        done = asyncio.Event()
+
+        async def on_done(data):
+            reports.append(data)
+            if len(reports) == len(jobs):
+                done.set()
+
+        backend = LocalBackend(bot, on_done, workers=1, download_dir=str(tmp_path / 'downloads'))
+        try:
+            for job in jobs:
+                assert await backend.submit(job)
+            await asyncio.wait_for(done.wait(), 120)
+        finally:
+            await backend.close()
+
+    asyncio.run(scenario())
+    return bot, reports
+
+
+def test_local_backend_downloads_and_reports(media_server, tmp_path):
+    url, size = f'{media_server.url}/clip.mp4', media_server.size
+    bot, reports = run_jobs(tmp_path, [{'id': 'j1', 'url': url, 'quality': '720', 'chat_id': 7, 'message_id': 3}])
+    # Прямая ссылка: файл уходит как есть, без перекодирования
+    assert bot.videos == [(7, size, 3)]
+    assert reports == [{'url': url, 'quality': '720', 'job_id': 'j1', 'file_id': 'file1',
+                        'title': 'clip', 'duration': None, 'thumbnail': None}]
+    # Временный каталог задачи убран
+    assert not os.listdir(tmp_path / 'downloads')
+
+
+def test_local_backend_reports_failure(media_server, tmp_path):
+    url = f'{media_server.url}/missing.mp4'
+    bot, reports = run_jobs(tmp_path, [{'id': 'j2', 'url': url, 'quality': '720', 'chat_id': 8, 'message_id': None}])
+    assert not bot.videos
+    assert bot.messages and bot.messages[0][0] == 8
+    assert reports == [{'url': url, 'quality': '720', 'job_id': 'j2', 'error': 'failed'}]
@@ -0,0 +1,131 @@
+import asyncio
+import sqlite3
+
+import db_sync
+from db_sync import DBSync
+from storage import Storage
+
+MESSAGES = 1000
+FLUSH_EVERY = 100  # сообщений между тиками SYNC_INTERVAL
+
+
+def make_db(path, rows: int = 0, blob: bytes = b'') -> bytes:
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, data BLOB)')
+        for i in range(rows):
+            conn.execute('INSERT INTO t (data) VALUES (?)', (blob,))
+    conn.close()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_api_calls_per_1000_messages(github, tmp_path):
+    db_name = str(tmp_path / 'bot.db')
+    sync = DBSync(db_name, 'owner/repo', 'token')
+    storage = Storage(db_name, journal=sync)
+
+    async def scenario():
+        await sync.download_snapshot()
+        storage.init_db()
+        await sync.replay_journal()
+        storage.start()
+        for i in range(MESSAGES):
+            chat_id = 1000 + i % 50
+            storage.register_user(chat_id, f'user{chat_id}')
+            storage.record_download(chat_id, f'https://youtu.be/{i:011d}', '720', 'YouTube')
+            if (i + 1) % FLUSH_EVERY == 0:
+                await asyncio.to_thread(storage.wait)
+                await sync.flush()
+        storage.close()
+        await sync.close()
+
+    asyncio.run(scenario())
+    flushes = MESSAGES // FLUSH_EVERY
+    # Старый путь — GET sha + PUT базы на каждое сообщение, т.е. 2000 вызовов
+    assert sync.api_calls == len(github.calls)
+    assert sync.api_calls <= 2 * flushes + 4
+    assert not sync.entries or max(e['seq'] for e in sync.entries) == sync.seq
+
+
+def test_journal_restores_into_fresh_instance(github, tmp_path, monkeypatch):
+    first = tmp_path / 'a'
+    second = tmp_path / 'b'
+    first.mkdir()
+    second.mkdir()
+
+    async def write(db_name):
+        sync = DBSync(db_name, 'owner/repo', 'token')
+        storage = Storage(db_name, journal=sync)
+        storage.init_db()
+        storage.start()
+        for chat_id in range(5):
+            storage.register_user(chat_id, f'user{chat_id}')
+        storage.close()
+        await sync.flush(compact=True)
+        storage = Storage(db_name, journal=sync)
+        storage.start()
+        storage.register_user(99, 'late')
+        storage.close()
+        await sync.close()
+
+    async def read(db_name):
+        sync = DBSync(db_name, 'owner/repo', 'token')
+        await sync.download_snapshot()
+        Storage(db_name, journal=sync).init_db()
+        await sync.replay_journal()
+
+    # Имя файла на GitHub — это DB_NAME, поэтому обе копии бота живут под одним именем
+    monkeypatch.chdir(first)
+    asyncio.run(write('bot_database.db'))
+    monkeypatch.chdir(second)
+    asyncio.run(read('bot_database.db'))
+    conn = sqlite3.connect('bot_database.db')
+    users = {row[0] for row in conn.execute('SELECT chat_id FROM users')}
+    conn.close()
+    assert users == {0, 1, 2, 3, 4, 99}
+
+
+def test_snapshot_over_1mb_is_fetched_raw(github, tmp_path):
+    remote = make_db(str(tmp_path / 'remote.db'), rows=40, blob=b'x' * 40_000)
+    assert len(remote) > 1024 * 1024
+    db_name = str(tmp_path / 'bot.db')
+    github.files[db_name] = remote
+    sync = DBSync(db_name, 'owner/repo', 'token')
+    asyncio.run(sync.download_snapshot())
+    with open(db_name, 'rb') as f:
+        assert f.read() == remote
+    assert [accept for _, _, accept in github.calls] == ['application/vnd.github.object', 'application/vnd.github.raw']
+    assert sync.api_calls == 2
+    assert sync.enabled
+
+
+def test_failed_download_keeps_local_db_and_stops_sync(github, tmp_path):
+    db_name = str(tmp_path / 'bot.db')
+    local = make_db(db_name, rows=3)
+    github.files[db_name] = b''
+    sync = DBSync(db_name, 'owner/repo', 'token')
+    asyncio.run(sync.download_snapshot())
+    with open(db_name, 'rb') as f:
+        assert f.read() == local
+    assert not sync.enabled
+
+    github.files.pop(db_name)
+    github.fail.add(db_name)
+    sync = DBSync(db_name, 'owner/repo', 'token')
+    asyncio.run(sync.download_snapshot())
+    with open(db_name, 'rb') as f:
+        assert f.read() == local
+    assert not sync.enabled
+    # Неполная база не уходит на GitHub
+    sync.record([('INSERT INTO t (data) VALUES (?)', (b'',))])
+    asyncio.run(sync.close())
+    assert db_name not in github.files
+
+
+def test_record_without_sync_keeps_no_journal(tmp_path):
+    sync = DBSync(str(tmp_path / 'bot.db'), None, None)
+    for _ in range(db_sync.COMPACT_ENTRIES * 2):
+        sync.record([('SELECT 1', ())])
+    assert sync.entries == []
+    assert sync.seq == 0
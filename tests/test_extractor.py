@@ -0,0 +1,121 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from extractor import REENCODE_MAX_DURATION, SIZE_BUDGET, choose_formats, probe_duration, reencode, reencode_plan, summarize
+
+MB = 1024 * 1024
+
+
+def video(format_id, height, vcodec='avc1.4d401f', size=None, tbr=None, ext='mp4'):
+    return {'format_id': format_id, 'height': height, 'vcodec': vcodec, 'acodec': 'none', 'ext': ext,
+            'filesize': size, 'tbr': tbr}
+
+
+def audio(format_id, abr, size=None, tbr=None, ext='m4a'):
+    return {'format_id': format_id, 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'ext': ext, 'abr': abr,
+            'filesize': size, 'tbr': tbr}
+
+
+def progressive(format_id, height, size=None, tbr=None):
+    return {'format_id': format_id, 'height': height, 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2', 'ext': 'mp4',
+            'filesize': size, 'tbr': tbr}
+
+
+YOUTUBE = [
+    progressive('18', 360, size=12 * MB),
+    video('134', 360, size=6 * MB), video('396', 360, vcodec='av01.0.01M.08', size=4 * MB),
+    video('136', 720, size=32 * MB), video('398', 720, vcodec='av01.0.05M.08', size=20 * MB),
+    video('247', 720, vcodec='vp9', size=24 * MB, ext='webm'),
+    video('137', 1080, size=80 * MB), video('399', 1080, vcodec='av01.0.08M.08', size=60 * MB),
+    audio('139', 48, size=1 * MB), audio('140', 129, size=2 * MB), audio('251', 160, size=3 * MB, ext='webm'),
+]
+
+
+def test_highest_height_that_fits():
+    spec, merge, size = choose_formats(YOUTUBE, 600, 1080)
+    assert (spec, merge, size) == ('136+140', 'mp4', 34 * MB)
+    assert choose_formats(YOUTUBE, 600, 480)[0] == '18'
+
+
+def test_h264_beats_smaller_av1_at_same_height():
+    # AV1 398+140 (22 МБ) меньше, но H.264 136+140 (34 МБ) тоже влезает и играется везде
+    assert choose_formats(YOUTUBE, 600, 720)[0] == '136+140'
+    # H.264 не влезает — берём AV1 той же высоты, а не H.264 ниже
+    assert choose_formats(YOUTUBE, 600, 720, budget=30 * MB)[0] == '398+140'
+
+
+def test_larger_file_wins_among_same_codec():
+    formats = [progressive('a', 720, size=10 * MB), progressive('b', 720, size=30 * MB), progressive('c', 720, size=60 * MB)]
+    assert choose_formats(formats, 600, 720) == ('b', None, 30 * MB)
+
+
+def test_audio_is_downgraded_to_fit():
+    formats = [video('136', 720, size=SIZE_BUDGET - 1 * MB - 1), audio('139', 48, size=1 * MB), audio('140', 129, size=2 * MB)]
+    assert choose_formats(formats, 600, 720)[0] == '136+139'
+
+
+def test_unknown_duration():
+    # Без длительности размер по tbr не оценить — такие форматы пропускаются
+    formats = [progressive('22', 720, tbr=2000), progressive('18', 360, size=8 * MB)]
+    assert choose_formats(formats, None, 720) == ('18', None, 8 * MB)
+    assert choose_formats(formats, 100, 720) == ('22', None, 25_000_000)
+    assert choose_formats([progressive('22', 720, tbr=2000)], None, 720) is None
+
+
+def test_nothing_fits():
+    assert choose_formats([progressive('22', 720, size=80 * MB)], 600, 720) is None
+    assert choose_formats([], 600, 720) is None
+
+
+def test_reencode_plan():
+    assert reencode_plan(None) is None
+    assert reencode_plan(0) is None
+    assert reencode_plan(REENCODE_MAX_DURATION + 1) is None
+    kbps, height = reencode_plan(120)
+    assert height == 720 and kbps > 1500
+    assert reencode_plan(400)[1] == 480
+    assert reencode_plan(800)[1] == 360
+    assert reencode_plan(1500)[1] == 240
+    # Ниже минимального битрейта видео смотреть невозможно
+    assert reencode_plan(2400) is None
+    for duration in (60, 400, 800, 1500):
+        kbps, _ = reencode_plan(duration)
+        assert (kbps + 64) * 1000 / 8 * duration <= SIZE_BUDGET
+
+
+def test_summarize_sizes_follow_choice():
+    meta = summarize({'id': 'x', 'title': 't', 'duration': 600, 'formats': YOUTUBE})
+    assert meta['sizes'] == {'720': 34 * MB, '480': 12 * MB}
+
+
+def test_open_ydl_leaves_cookie_file_alone(tmp_path, monkeypatch):
+    from extractor import open_ydl
+    monkeypatch.chdir(tmp_path)
+    cookies = '# Netscape HTTP Cookie File\n.youtube.com\tTRUE\t/\tTRUE\t2147483647\tPREF\tf6=40000000\n'
+    (tmp_path / 'cookies.txt').write_text(cookies)
+    with open_ydl('https://youtu.be/dQw4w9WgXcQ') as ydl:
+        assert ydl.params['cookiefile'] == 'cookies.txt'
+        assert [c.name for c in ydl.cookiejar] == ['PREF']
+    # Без защиты yt-dlp перезаписал бы файл своим заголовком при закрытии
+    assert (tmp_path / 'cookies.txt').read_text() == cookies
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+def test_reencode_fits_generated_clip_into_budget(tmp_path):
+    src = str(tmp_path / 'clip.mp4')
+    # Шумный ролик почти без сжатия — заведомо больше бюджета
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=duration=4:size=640x360:rate=25',
+                    '-f', 'lavfi', '-i', 'sine=duration=4', '-vf', 'noise=alls=40:allf=t', '-c:v', 'libx264',
+                    '-preset', 'ultrafast', '-crf', '12', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', src], check=True)
+    budget = MB // 4
+    assert os.path.getsize(src) > 3 * budget
+
+    out = reencode(src, None, budget=budget)
+
+    assert os.path.getsize(out) <= budget
+    assert abs(probe_duration(out) - 4) < 0.5
+    # Остались только исходник и результат: логи двух проходов x264 убраны
+    assert sorted(os.listdir(tmp_path)) == ['clip.fit.mp4', 'clip.mp4']
@@ -0,0 +1,206 @@
+import asyncio
+
+from jobs import InflightTable, JobScheduler
+
+
+class MemoryStorage:
+    """Just enough of Storage for the scheduler: job rows in a dict."""
+
+    def __init__(self, jobs=()):
+        self.jobs = {job['id']: dict(job) for job in jobs}
+
+    def save_job(self, job: dict):
+        self.jobs[job['id']] = dict(job)
+
+    def update_job(self, job_id: str, state: str, ts: int, error: str | None = None):
+        self.jobs[job_id].update(state=state, error=error)
+
+    def load_active_jobs(self) -> list:
+        return [dict(job) for job in self.jobs.values() if job['state'] in ('queued', 'dispatched', 'running')]
+
+
+def make_job(chat_id, key=None, message_id=1) -> dict:
+    return {'key': key or f'url{chat_id}|720', 'chat_id': chat_id, 'message_id': message_id,
+            'url': f'https://youtu.be/{chat_id}', 'quality': '720'}
+
+
+async def never_reports(job):
+    return True
+
+
+async def ignore(job, ok):
+    pass
+
+
+def test_expired_job_frees_slot_and_notifies_waiters():
+    inflight = InflightTable()
+    expired = []
+
+    async def on_expired(job):
+        expired.append((job['id'], job['waiters']))
+
+    async def scenario():
+        scheduler = JobScheduler(MemoryStorage(), never_reports, ignore, on_expired, max_running=1, ttl=0.2,
+                                 inflight=inflight)
+        job = make_job(1)
+        inflight.attach(job['key'], 1, 10)
+        inflight.attach(job['key'], 2, 20)
+        scheduler.enqueue(job)
+        inflight.bind(job['key'], job['id'])
+        scheduler.start()
+        await asyncio.sleep(0.1)
+        assert len(scheduler.running) == 1
+        # Никто не отчитался: через ttl слот свободен, а оба ждущих получили ошибку
+        await asyncio.sleep(0.3)
+        scheduler.stop()
+        assert not scheduler.running
+        assert scheduler.storage.jobs[job['id']]['error'] == 'timeout'
+        return job
+
+    job = asyncio.run(scenario())
+    assert expired == [(job['id'], [(1, 10), (2, 20)])]
+    assert not len(inflight)
+
+
+def test_restore_merges_duplicates_and_keys_running_by_id():
+    rows = [
+        dict(make_job(1, key='A'), id='run1', state='running', created=1, dispatched=2),
+        dict(make_job(2, key='A'), id='run2', state='dispatched', created=2, dispatched=3),
+        dict(make_job(3, key='A'), id='q1', state='queued', created=3, dispatched=None),
+        dict(make_job(4, key='B'), id='q2', state='queued', created=4, dispatched=None),
+    ]
+    storage = MemoryStorage(rows)
+    inflight = InflightTable()
+    scheduler = JobScheduler(storage, never_reports, ignore, inflight=inflight)
+    # То же, что делает main.on_startup
+    for job in scheduler.restore():
+        if inflight.attach(job['key'], job['chat_id'], job['message_id']):
+            inflight.bind(job['key'], job['id'])
+        elif job['state'] == 'queued':
+            scheduler.drop(job)
+
+    assert set(scheduler.running) == {'run1', 'run2'}
+    assert scheduler.depth() == 1
+    assert storage.jobs['q1']['state'] == 'done' and storage.jobs['q1']['error'] == 'merged'
+    # Отчёт второй задачи с тем же ключом освобождает именно её слот, а ждущие остаются у первой
+    assert scheduler.finish('A', job_id='run2')['waiters'] == []
+    assert scheduler.finish('A', job_id='run2') is None
+    assert scheduler.finish('B', job_id='run1') is None
+    job = scheduler.finish('A')
+    assert job['id'] == 'run1'
+    assert job['waiters'] == [(1, 1), (2, 1), (3, 1)]
+    # Осталась только запись задачи B, она ещё в очереди
+    assert len(inflight) == 1
+
+
+def test_inflight_entry_lives_as_long_as_its_job():
+    inflight = InflightTable()
+    scheduler = JobScheduler(MemoryStorage(), never_reports, ignore, rate_per_min=1, burst=1, inflight=inflight)
+    first, second = make_job(1, key='A'), make_job(1, key='B')
+    for job in (first, second):
+        assert inflight.attach(job['key'], 1, job['message_id'])
+        scheduler.enqueue(job, now=0)
+        inflight.bind(job['key'], job['id'])
+    scheduler.step(now=0)
+    # Вторая задача чата ждёт токен сколько угодно долго — новый клик всё равно встаёт в ждущие
+    assert not inflight.attach('B', 2, 20)
+    # Отчёт о чужой задаче с тем же ключом запись не трогает
+    assert inflight.finish('B', 'stale') == []
+    scheduler.step(now=60)
+    job = scheduler.finish('B', job_id=second['id'])
+    assert job['waiters'] == [(1, 1), (2, 20)]
+    assert len(inflight) == 1
+
+
+def p95(values: list) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+def skewed_load():
+    """One chat sends 60 links at once, 20 other chats send one link each over the next ~3 minutes."""
+    arrivals = [(0.0, make_job(1, key=f'heavy{i}')) for i in range(60)]
+    arrivals += [(5.0 + 10 * i, make_job(100 + i)) for i in range(20)]
+    return arrivals
+
+
+def simulate(arrivals: list, slots: int, job_seconds: float, fair: bool) -> dict:
+    """Dispatch wait of each light job on simulated time, 1-second ticks."""
+    scheduler = JobScheduler(MemoryStorage(), never_reports, ignore, max_running=slots)
+    fifo, running, waits = [], [], {}
+    pending = sorted(arrivals, key=lambda a: a[0])
+    now = 0.0
+    while pending or fifo or running or scheduler.depth():
+        while pending and pending[0][0] <= now:
+            arrived, job = pending.pop(0)
+            job['arrived'] = arrived
+            scheduler.enqueue(job, now) if fair else fifo.append(job)
+        for job in [j for j in running if j['done_at'] <= now]:
+            running.remove(job)
+            if fair:
+                scheduler.finish(job['key'], job_id=job['id'])
+        if fair:
+            started = scheduler.step(now)
+        else:
+            started = [fifo.pop(0) for _ in range(min(slots - len(running), len(fifo)))]
+        for job in started:
+            job['done_at'] = now + job_seconds
+            running.append(job)
+            if job['chat_id'] != 1:
+                waits[job['chat_id']] = now - job['arrived']
+        now += 1.0
+    return waits
+
+
+def test_light_users_are_not_starved_by_a_heavy_one():
+    fair = simulate(skewed_load(), slots=6, job_seconds=30, fair=True)
+    fifo = simulate(skewed_load(), slots=6, job_seconds=30, fair=False)
+    assert len(fair) == len(fifo) == 20
+    # В порядке поступления лёгкие пользователи ждут, пока выкачаются все 60 ссылок тяжёлого
+    assert p95(fifo.values()) > 200
+    # Тяжёлый упирается в свой лимит, и лёгкий ждёт не дольше одной задачи
+    assert p95(fair.values()) <= 30
+
+
+def test_shutdown_dispatches_batch_window_and_records_state(monkeypatch):
+    import http_client
+    from backends import GitHubActionsBackend
+    dispatched = []
+    notified = []
+
+    async def fake_dispatch(repo, token, workflow, inputs):
+        await asyncio.sleep(0.05)
+        dispatched.append(inputs['jobs'])
+        return 204
+
+    async def on_dispatched(job, ok):
+        notified.append(ok)
+
+    monkeypatch.setattr(http_client, 'github_dispatch', fake_dispatch)
+
+    async def scenario():
+        backend = GitHubActionsBackend('o/r', 't', 'b', window=60)
+        scheduler = JobScheduler(MemoryStorage(), backend.submit, on_dispatched)
+        job = make_job(1)
+        scheduler.enqueue(job)
+        scheduler.start()
+        await asyncio.sleep(0.05)
+        # Задача ждёт окна пакета, а бот останавливается — так же, как в main.on_shutdown
+        scheduler.stop()
+        await backend.close()
+        await scheduler.drain()
+        return scheduler.storage.jobs[job['id']]['state']
+
+    assert asyncio.run(scenario()) == 'running'
+    assert len(dispatched) == 1
+    assert notified == [True]
+
+
+def test_inflight_ttl_outlives_workflow_timeout():
+    import os
+    import jobs
+    with open(os.path.join(os.path.dirname(__file__), '..', '.github', 'workflows', 'download.yml')) as f:
+        workflow = f.read()
+    # Запасное значение в воркфлоу — то же, что бот передаёт по умолчанию
+    assert f"github.event.inputs.timeout_minutes || '{jobs.WORKFLOW_TIMEOUT_MINUTES}'" in workflow
+    assert jobs.INFLIGHT_TTL > jobs.WORKFLOW_TIMEOUT_MINUTES * 60
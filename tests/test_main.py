@@ -0,0 +1,171 @@
+import asyncio
+
+from bench import make_update
+
+URL = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+def test_concurrent_identical_requests_dispatch_once(bot):
+    main = bot.main
+
+    async def scenario():
+        await bot.start()
+        try:
+            token = main.url_tokens.issue(URL)
+            updates = [make_update('callback', i, URL, 20_000 + i, token) for i in range(1, 51)]
+            await asyncio.gather(*(bot.app.process_update(main.Update.de_json(u, bot.app.bot)) for u in updates))
+            await asyncio.sleep(0.2)
+            assert len(bot.backend.jobs) == 1
+            job = bot.backend.jobs[0]
+            # Воркер прислал видео владельцу задачи, остальные 49 получают его от бота
+            bot.telegram.calls.clear()
+            await main.complete_job({'url': job['url'], 'quality': job['quality'], 'file_id': 'FILE', 'job_id': job['id']})
+            assert bot.telegram.calls['sendVideo'] == 49
+            assert not main.scheduler.running
+        finally:
+            await bot.stop()
+
+    asyncio.run(scenario())
+
+
+def test_inline_burst_fetches_metadata_once(bot, monkeypatch, tmp_path):
+    import time
+    from extractor import MetadataCache
+    main = bot.main
+    fetched = []
+
+    def fake_fetch(url, cache):
+        fetched.append(url)
+        time.sleep(0.3)
+        meta = {'id': 'dQw4w9WgXcQ', 'title': 'Never Gonna', 'uploader': 'Rick', 'duration': 213,
+                'thumbnail': None, 'sizes': {'720': 20_000_000}}
+        cache.put(url, meta)
+        return meta
+
+    monkeypatch.setattr(main, 'fetch_metadata', fake_fetch)
+    monkeypatch.setattr(main, 'metadata', MetadataCache(str(tmp_path)))
+    monkeypatch.setattr(main, 'PREVIEW_METADATA', True)
+    monkeypatch.setattr(main, 'INLINE_DEBOUNCE', 0.05)
+    forms = ['youtu.be/dQw4w9WgXcQ', 'https://youtu.be/dQw4w9WgXcQ?si=x', URL, 'm.youtube.com/shorts/dQw4w9WgXcQ']
+
+    async def burst(first, count):
+        updates = [make_update('inline', i, forms[i % len(forms)], 40_000 + i, '') for i in range(first, first + count)]
+        await asyncio.gather(*(bot.app.process_update(main.Update.de_json(u, bot.app.bot)) for u in updates))
+
+    async def scenario():
+        await bot.start()
+        try:
+            bot.telegram.calls.clear()
+            await burst(1, 40)
+            await asyncio.sleep(0.6)
+            first = bot.telegram.calls['answerInlineQuery']
+            # Вторая волна — уже из кэша ответов, без ожидания и извлечения
+            await burst(41, 20)
+            return first, bot.telegram.calls['answerInlineQuery']
+        finally:
+            await bot.stop()
+
+    first, total = asyncio.run(scenario())
+    assert fetched == [main.canonicalize(URL)]
+    assert first == 40
+    assert total == 60
+
+
+def test_shutdown_saves_broadcast_progress(bot):
+    main = bot.main
+
+    async def scenario():
+        await bot.start()
+        for chat_id in range(30_000, 30_100):
+            main.storage.register_user(chat_id)
+        await asyncio.to_thread(main.storage.wait)
+        bot.telegram.calls.clear()
+        assert await main.broadcaster.start('привет', 1)
+        await asyncio.sleep(0.5)
+        await bot.stop()
+        # Одно сообщение — статус для админа, остальные — получателям
+        return bot.telegram.calls['sendMessage'] - 1
+
+    sent = asyncio.run(scenario())
+    assert 0 < sent < 100
+    bc = main.storage.load_unfinished_broadcasts()[-1]
+    counts = main.storage.get_broadcast_counts(bc['id'])
+    # Отметки рассылки записаны до закрытия базы — после рестарта она продолжится с оставшихся
+    assert counts.get('sent') == sent
+    assert counts.get('pending') == 100 - sent
+
+
+def test_webhook_answers_503_when_backlog_is_full(main_module, monkeypatch):
+    from types import SimpleNamespace
+    from aiohttp.test_utils import TestClient, TestServer
+    from updates import ChatOrderedProcessor
+    main = main_module
+    headers = {'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET}
+    update = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': 'hi', 'chat': {'id': 5, 'type': 'private'}}}
+
+    async def scenario():
+        queue = asyncio.Queue()
+        app = SimpleNamespace(running=True, update_queue=queue, bot=None,
+                              update_processor=ChatOrderedProcessor(concurrency=1, backlog=3))
+        monkeypatch.setattr(main, 'bot_app', app)
+        statuses = []
+        async with TestClient(TestServer(main.make_web_app())) as client:
+            for _ in range(5):
+                resp = await client.post(main.WEBHOOK_PATH, json=update, headers=headers)
+                statuses.append(resp.status)
+        return statuses, queue.qsize()
+
+    statuses, queued = asyncio.run(scenario())
+    assert statuses == [200, 200, 200, 503, 503]
+    assert queued == 3
+
+
+def test_handlers_stay_fast_when_github_is_slow(bot, monkeypatch):
+    import time
+    import http_client
+    from backends import GitHubActionsBackend
+    from bench import GitHubStub, start_github_stub
+    main = bot.main
+    monkeypatch.setattr(http_client, 'GITHUB_API', start_github_stub(3.0))
+    monkeypatch.setattr(main, 'GH_REPO', 'bench/bot')
+    monkeypatch.setattr(main, 'GH_TOKEN', 'bench')
+    GitHubStub.calls.clear()
+
+    def document(i):
+        return {'update_id': 100 + i, 'message': {
+            'message_id': 100 + i, 'date': int(time.time()), 'caption': '/update_cookie',
+            'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'Admin'},
+            'document': {'file_id': f'doc{i}', 'file_unique_id': f'u{i}', 'file_name': 'cookies.txt'}}}
+
+    async def timed(data):
+        started = time.perf_counter()
+        await bot.app.process_update(main.Update.de_json(data, bot.app.bot))
+        return time.perf_counter() - started
+
+    async def scenario():
+        await bot.start()
+        try:
+            main.backend = GitHubActionsBackend('bench/bot', 'bench', main.TOKEN, None, 'http://127.0.0.1/report', window=0.01)
+            callbacks = []
+            for i in range(1, 21):
+                url = f'https://youtu.be/slowgh{i:05d}'
+                callbacks.append(make_update('callback', i, url, 50_000 + i, main.url_tokens.issue(url)))
+            callback_seconds = await asyncio.gather(*(timed(u) for u in callbacks))
+            document_seconds = [await timed(document(i)) for i in range(5)]
+            # Запросы к GitHub идут в фоне и всё-таки доходят
+            for _ in range(100):
+                if GitHubStub.calls['PUT contents'] == 5 and GitHubStub.calls['POST dispatch']:
+                    break
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.2)
+            return callback_seconds, document_seconds, bot.telegram.calls['editMessageText']
+        finally:
+            await bot.stop()
+
+    callback_seconds, document_seconds, edits = asyncio.run(scenario())
+    assert GitHubStub.calls['PUT contents'] == 5 and GitHubStub.calls['POST dispatch'] >= 1
+    # На GitHub уходит по 3 с на запрос, обработчики же отвечают за миллисекунды
+    assert sorted(callback_seconds)[18] < 0.2
+    assert sorted(document_seconds)[-1] < 0.2
+    # Статус под каждой кнопкой и итог каждой загрузки cookies
+    assert edits >= 25
@@ -0,0 +1,25 @@
+import sqlite3
+
+from bench import LEGACY_SCHEMA
+from storage import Storage
+
+
+def test_init_db_twice_on_legacy_db(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    for sql in LEGACY_SCHEMA:
+        conn.execute(sql)
+    # Старые строки без platform — ровно для них когда-то добавляли столбец
+    conn.executemany('INSERT INTO downloads (chat_id, url, quality, timestamp) VALUES (?, ?, ?, ?)',
+                     [(1, 'https://youtu.be/x', '720', '2024-03-01 10:15:00'),
+                      (2, 'https://youtu.be/y', '480', '2024-03-01 10:45:00')])
+    conn.commit()
+    conn.close()
+
+    Storage(path).init_db()
+    Storage(path).init_db()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT SUM(count) FROM stats_hourly').fetchone()[0] == 2
+    assert conn.execute('SELECT COUNT(*) FROM stats_platform').fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from bench import link_corpus
+from urls import canonicalize, classify, find_link
+
+# (сообщение, ожидаемые (платформа, вид, id, каноническая ссылка) или None, есть ли схема в тексте)
+CORPUS = link_corpus(random.Random(1), 20_000)
+
+
+@pytest.mark.parametrize('url', [
+    'https://[www.youtube.com/x',
+    'https://[youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://www.tiktok.com]/@user/video/7300000000000000000',
+    'https://[::1/x',
+    'https://a﹫vimeo.com/channel/staff',
+])
+def test_malformed_host_is_not_a_link(url):
+    assert classify(url) is None
+    assert find_link(f'смотри {url} !') is None
+    assert canonicalize(url)
+
+
+def test_lookalike_hosts_are_not_links():
+    assert classify('https://box.com/s/1') is None
+    assert classify('https://youtube.com.evil.io/watch?v=dQw4w9WgXcQ') is None
+    assert classify('https://m.youtube.com/shorts/dQw4w9WgXcQ').canonical == 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+
+
+def test_corpus_links_are_classified():
+    wrong = []
+    for text, expected, _ in CORPUS:
+        link = find_link(text, require_scheme=False)
+        got = (link.platform, link.kind, link.media_id, link.canonical) if link else None
+        if got != expected:
+            wrong.append(f'{text!r}: {got} != {expected}')
+    assert not wrong, wrong[:10]
+
+
+def test_corpus_canonical_form_is_a_fixed_point():
+    for text, expected, _ in CORPUS:
+        if expected:
+            link = classify(expected[3])
+            assert canonicalize(expected[3]) == expected[3], text
+            assert link is not None and (link.platform, link.kind, link.media_id, link.canonical) == expected, text
+
+
+def test_corpus_scheme_rule():
+    # Без https:// ссылку видим только в inline-режиме, со схемой — в любом
+    for text, expected, with_scheme in CORPUS:
+        if expected and not with_scheme:
+            assert find_link(text) is None, text
+        elif with_scheme:
+            assert find_link(text) == find_link(text, require_scheme=False), text
@@ -0,0 +1,93 @@
+import re
+import json
+import shutil
+import hashlib
+import threading
+import http.server
+import urllib.parse
+
+import pytest
+
+import worker
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+
+BOT_TOKEN = '123456:WORKER'
+
+
+class TelegramStub(http.server.BaseHTTPRequestHandler):
+    """Bot API methods the worker calls, plus the bot's /report; every call is recorded on the server."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path == '/report':
+            self.server.reports.append((self.headers.get('X-Report-Token'), json.loads(body)))
+            result = {}
+        else:
+            method = self.path.rsplit('/', 1)[-1]
+            if self.headers.get('Content-Type', '').startswith('multipart/'):
+                fields = dict(re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)', body))
+                fields = {k.decode(): v.decode() for k, v in fields.items()}
+            else:
+                fields = dict(urllib.parse.parse_qsl(body.decode()))
+            self.server.calls.append((method, fields))
+            result = {'ok': True, 'result': {'video': {'file_id': f'F{len(self.server.calls)}'}} if method == 'sendVideo' else {}}
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TelegramStub)
+    server.calls, server.reports = [], []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    monkeypatch.setattr(worker, 'TELEGRAM_API', server.url)
+    yield server
+    server.shutdown()
+
+
+def test_batch_delivers_and_reports_each_job(telegram, media_server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    good, missing = f'{media_server.url}/clip.mp4', f'{media_server.url}/missing.mp4'
+    environ = {
+        'BOT_TOKEN': BOT_TOKEN, 'ADMIN_ID': '99', 'REPORT_URL': f'{telegram.url}/report',
+        'JOBS': json.dumps([{'job_id': 'j1', 'url': good, 'quality': '720', 'chat_id': 7, 'message_id': 3},
+                            {'job_id': 'j2', 'url': missing, 'quality': '480', 'chat_id': 8, 'message_id': ''}]),
+    }
+
+    assert worker.run_batch(worker.load_jobs(environ), parallelism=2) == 0
+
+    sends = sorted((method, fields['chat_id'], fields.get('reply_to_message_id')) for method, fields in telegram.calls)
+    # Видео — владельцу первой задачи, ошибка — только второму чату и админу
+    assert sends == [('sendMessage', '8', None), ('sendMessage', '99', None), ('sendVideo', '7', '3')]
+    secret = hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+    assert {token for token, _ in telegram.reports} == {secret}
+    reports = {report['job_id']: report for _, report in telegram.reports}
+    assert set(reports) == {'j1', 'j2'}
+    assert reports['j1']['url'] == good and reports['j1']['file_id'].startswith('F')
+    assert reports['j2'] == {'url': missing, 'quality': '480', 'job_id': 'j2', 'error': 'failed'}
+    # Шаг Notify on failure смотрит сюда и не трогает уже завершённые задачи
+    with open(worker.FINISHED_FILE) as f:
+        assert sorted(f.read().split()) == ['0', '1']
+
+
+def test_each_job_extracts_once_and_downloads_once(telegram, media_server, tmp_path):
+    url = f'{media_server.url}/clip.mp4'
+    for i in range(3):
+        media_server.requests.clear()
+        env = {'BOT_TOKEN': BOT_TOKEN, 'ADMIN_ID': '', 'REPORT_URL': f'{telegram.url}/report', 'JOB_ID': f'j{i}',
+               'URL': url, 'QUALITY': '720', 'CHAT_ID': str(i), 'MESSAGE_ID': ''}
+        assert worker.run(env, str(tmp_path / str(i))) == 0
+        # Один запрос на извлечение (generic смотрит ссылку) и один на сам файл: размер,
+        # формат, превью и подпись берутся из того же info, повторного извлечения нет
+        assert media_server.requests == [('GET', '/clip.mp4'), ('GET', '/clip.mp4')]
+    assert [method for method, _ in telegram.calls] == ['sendVideo'] * 3
+    assert [report['job_id'] for _, report in telegram.reports] == ['j0', 'j1', 'j2']
@@ -0,0 +1,73 @@
+import os
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько обработчиков работает одновременно и сколько апдейтов можно держать принятыми
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 32))
+UPDATE_BACKLOG     = int(os.getenv('UPDATE_BACKLOG', 512))
+
+
+def chat_key(update: object):
+    """Updates with the same key are handled in arrival order: the chat, or the user for inline queries."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return None
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Handles updates of different chats concurrently and updates of one chat one after another.
+
+    PTB's own semaphore (backlog) bounds how many updates are taken from the
+    queue at once. Inside it an update first waits for its chat and only then
+    for one of the `concurrency` handler slots, so a chat with a long backlog
+    queues behind itself without holding slots other chats need.
+    """
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, backlog: int = UPDATE_BACKLOG):
+        super().__init__(max(concurrency, backlog))
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self._slots = asyncio.Semaphore(concurrency)
+        self._chats = {}  # key -> [lock, апдейтов этого чата внутри]
+        self.running = 0
+
+    @property
+    def pending(self) -> int:
+        """Updates taken from the queue that wait for their chat or a free slot."""
+        return self.current_concurrent_updates - self.running
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = chat_key(update)
+        if key is None:
+            async with self._slots:
+                await self._run(coroutine)
+            return
+        chat = self._chats.get(key)
+        if chat is None:
+            chat = self._chats[key] = [asyncio.Lock(), 0]
+        chat[1] += 1
+        try:
+            async with chat[0], self._slots:
+                await self._run(coroutine)
+        finally:
+            chat[1] -= 1
+            if not chat[1]:
+                del self._chats[key]
+
+    async def _run(self, coroutine):
+        self.running += 1
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
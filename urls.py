@@ -0,0 +1,227 @@
+import urllib.parse
+from typing import NamedTuple
+
+# Параметры, которые не влияют на то, какое видео будет скачано
+TRACKING_PARAMS = {
+    'si', 'feature', 'pp', 'ab_channel', 'igshid', 'igsh', 'fbclid', 'gclid', 'ref', 'ref_src',
+    'ref_url', 's', 'share_id', 'is_from_webapp', 'sender_device', 'web_id', 'mibextid', 'context',
+}
+
+YOUTUBE_ID_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-'
+# Что отрезаем по краям ссылки без схемы и с конца любой, прилипшее из текста сообщения
+LEADING  = '([{<«"\''
+TRAILING = '.,;:!?)]}>»"\'…'
+
+
+class Link(NamedTuple):
+    """What a supported URL points to.
+
+    media_id is the platform's id of the item (video id, clip slug, channel
+    for a live stream) or None when the path names no single item; hints
+    tell the downloader how to extract it (cookies file, PO token, slideshow).
+    """
+
+    platform: str
+    canonical: str
+    media_id: str | None
+    kind: str  # video | clip | photo | live
+    hints: dict
+
+    @property
+    def downloadable(self) -> bool:
+        # С Twitch берём только клипы: трансляции и записи не влезут в лимит Telegram
+        if self.platform == 'Twitch':
+            return self.kind == 'clip'
+        return self.kind != 'live'
+
+
+def _host(netloc: str) -> str:
+    host = netloc.lower().rsplit('@', 1)[-1].split(':', 1)[0].rstrip('.')
+    for prefix in ('www.', 'm.', 'mobile.', 'music.'):
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
+
+# Разборщики пути возвращают (media_id, kind, canonical) или None, если путь не про одно видео
+
+def _youtube(host, parts, query):
+    if host == 'youtu.be':
+        video_id = parts[0] if parts else None
+    elif parts[:1] in (['shorts'], ['embed'], ['live'], ['v']):
+        video_id = parts[1] if len(parts) > 1 else None
+    else:
+        video_id = urllib.parse.parse_qs(query).get('v', [None])[0]
+    # Ровно 11 символов из алфавита id — без регулярки
+    if video_id and len(video_id) == 11 and not video_id.strip(YOUTUBE_ID_CHARS):
+        # /live/<id> — почти всегда уже законченный эфир, он качается как обычное видео
+        return video_id, 'video', f'https://www.youtube.com/watch?v={video_id}'
+    return None
+
+
+def _instagram(host, parts, query):
+    if len(parts) >= 2 and parts[0] in ('p', 'reel', 'reels', 'tv'):
+        return parts[1], 'video', f'https://www.instagram.com/p/{parts[1]}/'
+    return None
+
+
+def _tiktok(host, parts, query):
+    # https://www.tiktok.com/@user/video/123 и /@user/photo/123
+    if len(parts) >= 3 and parts[0].startswith('@') and parts[1] in ('video', 'photo') and parts[2].isdigit():
+        kind = 'photo' if parts[1] == 'photo' else 'video'
+        return parts[2], kind, f'https://www.tiktok.com/{parts[0]}/{parts[1]}/{parts[2]}'
+    return None
+
+
+def _twitter(host, parts, query):
+    if len(parts) >= 3 and parts[1] == 'status' and parts[2].isdigit():
+        return parts[2], 'video', f'https://x.com/i/status/{parts[2]}'
+    return None
+
+
+def _rutube(host, parts, query):
+    if len(parts) >= 2 and parts[0] in ('video', 'shorts'):
+        return parts[1], 'video', f'https://rutube.ru/video/{parts[1]}/'
+    return None
+
+
+def _twitch(host, parts, query):
+    if host == 'clips.twitch.tv' and parts:
+        return parts[0], 'clip', f'https://clips.twitch.tv/{parts[0]}'
+    if len(parts) >= 3 and parts[1] == 'clip':
+        return parts[2], 'clip', f'https://clips.twitch.tv/{parts[2]}'
+    if len(parts) >= 2 and parts[0] == 'videos' and parts[1].isdigit():
+        return parts[1], 'video', f'https://www.twitch.tv/videos/{parts[1]}'
+    if len(parts) == 1:
+        return parts[0].lower(), 'live', f'https://www.twitch.tv/{parts[0].lower()}'
+    return None
+
+
+def _vimeo(host, parts, query):
+    if parts and parts[0].isdigit():
+        return parts[0], 'video', f'https://vimeo.com/{parts[0]}'
+    return None
+
+
+# Платформа -> (домены, включая все поддомены; разбор пути; подсказки загрузчику)
+PLATFORMS = {
+    'YouTube':    (('youtube.com', 'youtu.be'), _youtube, {'cookies': 'cookies.txt', 'po_token': True}),
+    'Instagram':  (('instagram.com',), _instagram, {'cookies': 'insta_cookies.txt'}),
+    'TikTok':     (('tiktok.com',), _tiktok, {}),
+    'Twitter/X':  (('twitter.com', 'x.com'), _twitter, {}),
+    'Rutube':     (('rutube.ru',), _rutube, {}),
+    'Twitch':     (('twitch.tv',), _twitch, {}),
+    'Vimeo':      (('vimeo.com',), _vimeo, {}),
+    'SoundCloud': (('soundcloud.com',), None, {}),
+    'Facebook':   (('facebook.com', 'fb.watch'), None, {}),
+}
+HOST_SUFFIXES = {host: platform for platform, (hosts, _, _) in PLATFORMS.items() for host in hosts}
+
+
+def platform_of_host(host: str) -> str | None:
+    """Match the host and then each parent domain against HOST_SUFFIXES: box.com is not x.com."""
+    while True:
+        platform = HOST_SUFFIXES.get(host)
+        if platform is not None:
+            return platform
+        dot = host.find('.')
+        if dot < 0:
+            return None
+        host = host[dot + 1:]
+
+
+def _clean(parsed) -> str:
+    params = sorted(
+        (k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith('utm_')
+    )
+    return urllib.parse.urlunsplit((
+        'https', parsed.netloc.lower(), parsed.path.rstrip('/') or '/', urllib.parse.urlencode(params), ''
+    ))
+
+
+def _classify(netloc: str, path: str, query: str, parsed=None) -> Link | None:
+    # Квадратные скобки бывают только у IPv6-адресов, у поддерживаемых платформ их нет
+    if '[' in netloc or ']' in netloc:
+        return None
+    host = _host(netloc)
+    platform = platform_of_host(host)
+    if platform is None:
+        return None
+    _, parse_path, hints = PLATFORMS[platform]
+    parts = [p for p in path.split('/') if p]
+    item = parse_path(host, parts, query) if parse_path else None
+    if item is None:
+        try:
+            parsed = parsed or urllib.parse.urlsplit(f'https://{netloc}{path}?{query}')
+        except ValueError:
+            # Хост, который после NFKC-нормализации меняет смысл (a﹫youtube.com) — ссылка битая
+            return None
+        item = None, 'video', _clean(parsed)
+    media_id, kind, canonical = item
+    if kind == 'photo':
+        hints = {**hints, 'slideshow': True}
+    return Link(platform, canonical, media_id, kind, hints)
+
+
+def classify(url: str) -> Link | None:
+    """Link for a URL of a supported platform, None for anything else.
+
+    The URL is cut into host, path and query with str.partition/find only;
+    urlsplit is used just for the rare links whose path names no single item.
+    """
+    _, sep, rest = url.strip().partition('://')
+    if not sep:
+        return None
+    end = len(rest)
+    for ch in '/?#':
+        i = rest.find(ch, 0, end)
+        if i >= 0:
+            end = i
+    if not end:
+        return None
+    path, _, query = rest[end:].partition('#')[0].partition('?')
+    return _classify(rest[:end], path, query)
+
+
+def platform_name(url: str) -> str:
+    link = classify(url)
+    return link.platform if link else 'Other'
+
+
+def iter_urls(text: str, require_scheme: bool = True):
+    """URL candidates in a message, one per word. Without require_scheme "youtu.be/x" counts too."""
+    for word in text.split():
+        start = word.find('http://')
+        if start < 0:
+            start = word.find('https://')
+        if start >= 0:
+            yield word[start:].rstrip(TRAILING)
+        elif not require_scheme and '.' in word:
+            yield 'https://' + word.lstrip(LEADING).rstrip(TRAILING)
+
+
+def find_link(text: str, require_scheme: bool = True) -> Link | None:
+    """First link to a supported platform in a message."""
+    for url in iter_urls(text, require_scheme):
+        link = classify(url)
+        if link is not None:
+            return link
+    return None
+
+
+def canonicalize(url: str) -> str:
+    """Return one stable URL for every link that points to the same media.
+
+    youtu.be/X, m.youtube.com/watch?v=X&si=... and youtube.com/shorts/X all
+    become https://www.youtube.com/watch?v=X. Unknown forms keep their path
+    and lose only the fragment and tracking parameters.
+    """
+    try:
+        parsed = urllib.parse.urlsplit(url.strip())
+    except ValueError:
+        return url
+    if not parsed.netloc:
+        return url
+    link = _classify(parsed.netloc, parsed.path, parsed.query, parsed)
+    return link.canonical if link else _clean(parsed)
@@ -0,0 +1,195 @@
+"""Download worker run by download.yml.
+
+Extracts the URL once and reuses the info dict for everything else: the
+size check, format selection, the thumbnail, the download itself, the
+TikTok slideshow and the caption. Inputs come from the environment:
+BOT_TOKEN, ADMIN_ID and REPORT_URL are shared; JOBS is a JSON list of
+{job_id, url, quality, chat_id, message_id} processed BATCH_PARALLELISM at a
+time, or a single job is given as URL, QUALITY, CHAT_ID and MESSAGE_ID.
+Every job is delivered, reported and, on error, notified on its own.
+"""
+import os
+import sys
+import time
+import copy
+import json
+import glob
+import html
+import hashlib
+import logging
+import threading
+import concurrent.futures
+import requests
+from extractor import TooLarge, open_ydl, download_fitting, summarize
+from slideshow import build_slideshow
+from urls import classify, iter_urls
+
+OUT_DIR = 'downloads'
+TELEGRAM_API = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+BATCH_PARALLELISM = int(os.getenv('BATCH_PARALLELISM', 3))
+# Номера завершённых задач пакета — шаг Notify on failure не трогает их при падении воркера
+FINISHED_FILE = os.path.join(OUT_DIR, 'finished.txt')
+ERROR_TEXT = "❌ Ошибка при скачивании. Попробуй другое видео или качество."
+
+
+def telegram(token: str, method: str, **kw) -> dict:
+    resp = requests.post(f"{TELEGRAM_API}/bot{token}/{method}", timeout=120, **kw)
+    print(resp.text[:300])
+    try:
+        return resp.json()
+    except ValueError:
+        return {}
+
+
+def send_message(env: dict, text: str):
+    data = {'chat_id': env['CHAT_ID'], 'text': text, 'parse_mode': 'HTML'}
+    if env.get('MESSAGE_ID'):
+        data['reply_to_message_id'] = env['MESSAGE_ID']
+    telegram(env['BOT_TOKEN'], 'sendMessage', data=data)
+
+
+def report(env: dict, payload: dict):
+    # Сообщаем боту результат — повторные запросы этого видео он отдаст сам, без воркера
+    if not env.get('REPORT_URL'):
+        return
+    secret = hashlib.sha256(env['BOT_TOKEN'].encode()).hexdigest()
+    payload = {'url': env['URL'], 'quality': env['QUALITY'], 'job_id': env.get('JOB_ID') or None, **payload}
+    try:
+        requests.post(env['REPORT_URL'], json=payload, headers={'X-Report-Token': secret}, timeout=30)
+    except requests.RequestException as e:
+        print(f"Report failed: {e}")
+
+
+def caption(meta: dict) -> str:
+    lines = [f"🎬 <b>{html.escape(meta['title'])}</b>", f"👤 {html.escape(meta['uploader'])}"]
+    if meta.get('duration'):
+        lines.append(f"⏱ {meta['duration'] // 60}:{meta['duration'] % 60:02d}")
+    return '\n'.join(lines)
+
+
+def download_audio(info: dict, url: str, out_dir: str) -> str | None:
+    """bestaudio of an already extracted info — no second extraction."""
+    try:
+        with open_ydl(url, ['-f', 'bestaudio', '-o', f'{out_dir}/audio.%(ext)s']) as ydl:
+            audio = ydl.process_ie_result(copy.deepcopy(info), download=True)
+        return audio['requested_downloads'][0]['filepath']
+    except Exception as e:
+        print(f"No audio for slideshow: {e}")
+        return None
+
+
+def run(env: dict, out_dir: str = OUT_DIR) -> int:
+    # Извлекаем чистый URL — убираем всё лишнее (эмодзи, текст и т.д.)
+    url = next(iter_urls(env['URL']), None)
+    if not url:
+        raise ValueError(f"No URL in {env['URL']!r}")
+    print(f"Clean URL: {url}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Формат выбирается после извлечения: лучший, что влезает в 50 МБ, кнопка качества — лишь потолок
+    args = ['-o', f'{out_dir}/%(id)s.%(ext)s', '--write-thumbnail', '--convert-thumbnails', 'jpg']
+    link = classify(url)
+    is_slideshow = link is not None and link.hints.get('slideshow', False)
+
+    # Время этапов уходит боту вместе с результатом — в /metrics
+    timings = {}
+    started = time.monotonic()
+
+    def lap(stage):
+        nonlocal started
+        now = time.monotonic()
+        timings[stage] = round(now - started, 3)
+        started = now
+
+    # Параллельные задачи пакета делят cookies.txt — open_ydl не перезаписывает его при закрытии
+    with open_ydl(url, args) as ydl:
+        info = ydl.extract_info(url, download=False)
+        meta = summarize(info)
+        lap('extract')
+
+        path = None
+        if is_slideshow:
+            path = build_slideshow(info, download_audio(info, url, out_dir), os.path.join(out_dir, 'tiktok_slideshow.mp4'))
+        if path is None:
+            if is_slideshow:
+                print("No photos found, trying normal download...")
+            try:
+                info, path = download_fitting(ydl, info, url, env['QUALITY'])
+            except TooLarge as e:
+                print(f"File is too large (~{e.size_mb}MB) even after re-encoding, giving up.")
+                send_message(env, f"⚠️ <b>Ошибка:</b> Видео не удалось уложить в лимит Telegram в 50 МБ (Ожидаемый вес: ~{e.size_mb} МБ).")
+                report(env, {'error': 'too_large', 'meta': meta, 'timings': timings})
+                return 0
+        lap('download')
+
+    thumbs = [t['filepath'] for t in info.get('thumbnails') or [] if t.get('filepath') and os.path.exists(t['filepath'])]
+    thumbs = thumbs or sorted(glob.glob(os.path.join(out_dir, '*.jpg')))
+    data = {'chat_id': env['CHAT_ID'], 'supports_streaming': 'true', 'caption': caption(meta), 'parse_mode': 'HTML'}
+    if env.get('MESSAGE_ID'):
+        data['reply_to_message_id'] = env['MESSAGE_ID']
+    with open(path, 'rb') as video:
+        files = {'video': video}
+        if thumbs:
+            files['thumbnail'] = open(thumbs[0], 'rb')
+        try:
+            resp = telegram(env['BOT_TOKEN'], 'sendVideo', data=data, files=files)
+        finally:
+            if 'thumbnail' in files:
+                files['thumbnail'].close()
+
+    lap('upload')
+    file_id = ((resp.get('result') or {}).get('video') or {}).get('file_id')
+    if not file_id:
+        raise RuntimeError(f"sendVideo failed: {resp.get('description')}")
+    report(env, {'file_id': file_id, 'title': meta['title'], 'duration': meta['duration'],
+                 'thumbnail': meta['thumbnail'], 'meta': meta, 'timings': timings})
+    return 0
+
+
+def fail(env: dict, error: Exception):
+    print(f"Job failed for {env['URL']}: {error}")
+    send_message(env, ERROR_TEXT)
+    report(env, {'error': 'failed'})
+    if env.get('ADMIN_ID'):
+        telegram(env['BOT_TOKEN'], 'sendMessage', data={
+            'chat_id': env['ADMIN_ID'], 'parse_mode': 'HTML',
+            'text': f"🚨 <b>Ошибка загрузки!</b>\n👤 User: <code>{env['CHAT_ID']}</code>\n🔗 URL: {html.escape(env['URL'])}",
+        })
+
+
+def load_jobs(environ) -> list:
+    shared = {k: environ.get(k, '') for k in ('BOT_TOKEN', 'ADMIN_ID', 'REPORT_URL')}
+    jobs = json.loads(environ.get('JOBS') or '[]') or [{
+        'url': environ.get('URL', ''), 'quality': environ.get('QUALITY', ''),
+        'chat_id': environ.get('CHAT_ID', ''), 'message_id': environ.get('MESSAGE_ID', ''),
+    }]
+    return [{**shared, 'JOB_ID': job.get('job_id') or environ.get('JOB_ID', ''), 'URL': job['url'], 'QUALITY': str(job['quality']), 'CHAT_ID': str(job['chat_id']),
+             'MESSAGE_ID': str(job.get('message_id') or '')} for job in jobs]
+
+
+def run_batch(envs: list, parallelism: int = BATCH_PARALLELISM) -> int:
+    """Run every job in its own directory; a failing job is notified and reported alone."""
+    os.makedirs(OUT_DIR, exist_ok=True)
+    lock = threading.Lock()
+
+    def run_one(index):
+        env = envs[index]
+        try:
+            run(env, os.path.join(OUT_DIR, str(index)))
+            ok = True
+        except Exception as e:
+            fail(env, e)
+            ok = False
+        with lock, open(FINISHED_FILE, 'a') as f:
+            f.write(f"{index}\n")
+        return ok
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(envs)))) as pool:
+        results = list(pool.map(run_one, range(len(envs))))
+    print(f"Batch done: {sum(results)} of {len(results)} jobs succeeded")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sys.exit(run_batch(load_jobs(os.environ)))